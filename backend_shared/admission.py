@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Queue names shared by the backends, in priority order
+INTERACTIVE = "interactive" # /chat conversations
+EXTRACTION = "extraction" # /process-receipt and /process-income-document
+BACKGROUND = "background" # smart-assistant insights
+
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+ADMISSION_MAX_QUEUE_LENGTH = int(os.getenv("ADMISSION_MAX_QUEUE_LENGTH", "64"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "20"))
+
+QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds",
+    "Time requests spend queued before being admitted.",
+    ["service", "queue"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0),
+)
+QUEUE_LENGTH = Gauge("admission_queue_length", "Requests currently waiting for admission.", ["service", "queue"])
+IN_FLIGHT = Gauge("admission_in_flight", "Requests currently admitted and running.", ["service"])
+REJECTED = Counter("admission_rejected", "Requests turned away by admission control.", ["service", "queue", "reason"])
+
+@dataclass
+class QueueConfig:
+    weight: int # Share of freed slots this queue receives while others are also waiting
+    max_length: int # Waiting requests beyond this are rejected immediately with 429
+    max_wait_seconds: float # Requests still queued after this long are rejected with 503
+
+def default_queue_configs() -> Dict[str, QueueConfig]:
+    return {
+        INTERACTIVE: QueueConfig(weight=6, max_length=ADMISSION_MAX_QUEUE_LENGTH, max_wait_seconds=ADMISSION_MAX_WAIT_SECONDS),
+        EXTRACTION: QueueConfig(weight=3, max_length=ADMISSION_MAX_QUEUE_LENGTH, max_wait_seconds=ADMISSION_MAX_WAIT_SECONDS),
+        BACKGROUND: QueueConfig(weight=1, max_length=max(1, ADMISSION_MAX_QUEUE_LENGTH // 4), max_wait_seconds=ADMISSION_MAX_WAIT_SECONDS),
+    }
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; rendered as 429/503 with a Retry-After header."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+class AdmissionController:
+    """
+    Caps the number of LLM-bound requests running at once and queues the rest per priority class.
+    Freed slots go to waiting queues by smooth weighted round-robin, so interactive chat is served
+    first without starving background work. Full queues fail fast with 429 and requests that wait
+    too long get 503, both carrying a Retry-After estimated from recent service times.
+    """
+
+    def __init__(self, service_name: str, max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+                 queues: Optional[Dict[str, QueueConfig]] = None):
+        self.service_name = service_name
+        self.max_concurrency = max_concurrency
+        self.queues = queues or default_queue_configs()
+        self._waiters: Dict[str, deque] = {name: deque() for name in self.queues}
+        self._wrr_current: Dict[str, int] = {name: 0 for name in self.queues}
+        self._active = 0
+        self._avg_service_seconds = 1.0 # EWMA of admitted request durations, for Retry-After
+
+    def _retry_after(self, queued: int) -> int:
+        return max(1, math.ceil((queued + 1) * self._avg_service_seconds / self.max_concurrency))
+
+    def _pick_next_queue(self) -> Optional[str]:
+        """Smooth weighted round-robin over the queues that currently have waiters."""
+        candidates = [name for name, waiters in self._waiters.items() if waiters]
+        if not candidates:
+            return None
+        total_weight = 0
+        for name in candidates:
+            self._wrr_current[name] += self.queues[name].weight
+            total_weight += self.queues[name].weight
+        chosen = max(candidates, key=lambda name: self._wrr_current[name])
+        self._wrr_current[chosen] -= total_weight
+        return chosen
+
+    def _release(self):
+        self._active -= 1
+        while self._active < self.max_concurrency:
+            queue_name = self._pick_next_queue()
+            if queue_name is None:
+                break
+            waiter = self._waiters[queue_name].popleft()
+            QUEUE_LENGTH.labels(self.service_name, queue_name).set(len(self._waiters[queue_name]))
+            if waiter.done(): # Cancelled or timed out while queued
+                continue
+            self._active += 1
+            waiter.set_result(None)
+        IN_FLIGHT.labels(self.service_name).set(self._active)
+
+    @asynccontextmanager
+    async def admit(self, queue_name: str):
+        """Holds one concurrency slot for the duration of the block, queueing for it if necessary."""
+        config = self.queues[queue_name]
+        waiters = self._waiters[queue_name]
+        queued_at = time.perf_counter()
+
+        if self._active < self.max_concurrency and not any(self._waiters.values()):
+            self._active += 1
+        else:
+            if len(waiters) >= config.max_length:
+                REJECTED.labels(self.service_name, queue_name, "queue_full").inc()
+                logger.warning(f"Rejecting {queue_name} request: {len(waiters)} already queued (limit {config.max_length}).")
+                raise AdmissionRejected(429, f"Too many pending {queue_name} requests. Please retry shortly.",
+                                        self._retry_after(sum(len(w) for w in self._waiters.values())))
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            QUEUE_LENGTH.labels(self.service_name, queue_name).set(len(waiters))
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout=config.max_wait_seconds)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    self._release() # Admitted at the same moment we gave up; hand the slot on
+                else:
+                    waiter.cancel()
+                    waiters.remove(waiter)
+                    QUEUE_LENGTH.labels(self.service_name, queue_name).set(len(waiters))
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                REJECTED.labels(self.service_name, queue_name, "wait_timeout").inc()
+                logger.warning(f"Rejecting {queue_name} request after waiting {config.max_wait_seconds}s for admission.")
+                raise AdmissionRejected(503, f"Server is busy; {queue_name} request was not admitted within {config.max_wait_seconds:.0f}s.",
+                                        self._retry_after(sum(len(w) for w in self._waiters.values())))
+
+        admitted_at = time.perf_counter()
+        QUEUE_WAIT.labels(self.service_name, queue_name).observe(admitted_at - queued_at)
+        IN_FLIGHT.labels(self.service_name).set(self._active)
+        try:
+            yield
+        finally:
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * (time.perf_counter() - admitted_at)
+            self._release()
+
+    def dependency(self, queue_name: str):
+        """FastAPI dependency that admits the request into `queue_name` for the handler's duration."""
+        async def admission_dependency():
+            async with self.admit(queue_name):
+                yield
+        return admission_dependency
@@ -0,0 +1,226 @@
+"""
+Request deadlines shared by the receipt and income backends.
+
+A request gets one time budget, from its X-Request-Timeout header (seconds) or the default.
+The Deadline is held in a context variable for the request's duration, so every stage and the
+LLM client underneath it can see how much time is left without it being passed through each
+call: upstream calls are bounded by the remaining time, and stages that would not fit are cut
+(skipped or answered with a cheaper result) and recorded in the response.
+
+The items of a batch (receipts of one upload, pages of one statement) each get a budget of
+their own from Deadline.branch(). Its clock runs only while the item is being worked on: it
+starts when the item takes its first stage slot and stops while it waits for one (stage_slot),
+so items queued behind the rest of the batch are not cut for waiting.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Dict, Iterator, List, Optional
+
+from fastapi import Header, HTTPException
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+# Budget for requests without the header, and the most a client may ask for
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "90"))
+REQUEST_DEADLINE_MAX_SECONDS = float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", "300"))
+# Least time worth starting an LLM call with; with less left, the stage is cut instead
+DEADLINE_MIN_LLM_CALL_SECONDS = float(os.getenv("DEADLINE_MIN_LLM_CALL_SECONDS", "3"))
+
+STAGES_CUT = Counter("deadline_stages_cut", "Pipeline stages skipped or degraded to meet the request deadline.", ["service", "stage"])
+DEADLINES_EXCEEDED = Counter("deadline_exceeded", "Requests that ran out of time before producing any result.", ["service"])
+
+class DeadlineExceeded(Exception):
+    """Raised when the request deadline passes before a stage finishes. Not a TimeoutError, so it is never retried."""
+
+class Deadline:
+    """A time budget starting now (for batch items, not counting time queued for a stage), plus the stages cut so far to stay within it."""
+
+    def __init__(self, seconds: float, service_name: str, parent: Optional["Deadline"] = None):
+        self.seconds = seconds
+        self.service_name = service_name
+        self.parent = parent
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+        self.cut_stages: List[str] = []
+        # Batch items only: waiting for a stage slot pauses the clock
+        self.queueing_exempt = parent is not None
+        self.queued_seconds = 0.0
+        self._paused_at: Optional[float] = None
+
+    def branch(self) -> "Deadline":
+        """
+        A budget of the same length for one item of a batch. Its clock is paused until the item
+        takes its first stage slot; the stages it cuts are also recorded on this deadline.
+        """
+        item = Deadline(self.seconds, self.service_name, parent=self)
+        item.pause()
+        return item
+
+    def pause(self):
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+
+    def resume(self):
+        if self._paused_at is not None:
+            paused_for = time.monotonic() - self._paused_at
+            self.expires_at += paused_for
+            self.queued_seconds += paused_for
+            self._paused_at = None
+
+    def remaining(self) -> float:
+        now = self._paused_at if self._paused_at is not None else time.monotonic()
+        return max(0.0, self.expires_at - now)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def cut(self, stage: str, reason: str):
+        if stage in self.cut_stages:
+            return
+        self.cut_stages.append(stage)
+        if self.parent is not None and stage not in self.parent.cut_stages:
+            self.parent.cut_stages.append(stage)
+        STAGES_CUT.labels(self.service_name, stage).inc()
+        logger.warning(f"Cutting stage '{stage}' ({reason}); {self.remaining():.2f}s left of {self.seconds:.1f}s.")
+
+    def summary(self) -> Dict[str, Any]:
+        now = self._paused_at if self._paused_at is not None else time.monotonic()
+        summary = {
+            "budget_seconds": self.seconds,
+            "elapsed_seconds": round(now - self.started_at - self.queued_seconds, 3),
+            "cut_stages": list(self.cut_stages),
+        }
+        if self.queueing_exempt:
+            summary["queued_seconds"] = round(self.queued_seconds + time.monotonic() - now, 3)
+        return summary
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("request_deadline", default=None)
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """Makes `deadline` the current one; tasks created inside inherit it. None runs without a deadline."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+def remaining_time(cap: Optional[float] = None) -> Optional[float]:
+    """Seconds left on the current deadline, at most `cap`; just `cap` outside a deadline."""
+    deadline = current_deadline()
+    if deadline is None:
+        return cap
+    return deadline.remaining() if cap is None else min(cap, deadline.remaining())
+
+def time_allows(seconds: float) -> bool:
+    deadline = current_deadline()
+    return deadline is None or deadline.remaining() >= seconds
+
+def deadline_expired() -> bool:
+    """True once the current deadline has passed; always False outside a deadline."""
+    deadline = current_deadline()
+    return deadline is not None and deadline.expired
+
+def cut_stage(stage: str, reason: str):
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.cut(stage, reason)
+
+def cut_stages() -> List[str]:
+    """Stages cut so far under the current deadline."""
+    deadline = current_deadline()
+    return list(deadline.cut_stages) if deadline is not None else []
+
+async def within_deadline(awaitable: Awaitable, stage: str) -> Any:
+    """Awaits `awaitable`, cancelling it and raising DeadlineExceeded if the current deadline passes first."""
+    deadline = current_deadline()
+    if deadline is None:
+        return await awaitable
+    if deadline.expired:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded(f"Request deadline reached before {stage}.")
+    task = asyncio.ensure_future(awaitable)
+    try:
+        # Waited in steps rather than with one wait_for: a paused batch-item deadline moves its expiry out
+        while not task.done() and not deadline.expired:
+            await asyncio.wait({task}, timeout=deadline.remaining())
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not task.done():
+        task.cancel()
+        await asyncio.wait({task})
+        if task.cancelled():
+            raise DeadlineExceeded(f"Request deadline reached during {stage}.")
+    return task.result()
+
+@asynccontextmanager
+async def stage_slot(slots: asyncio.Semaphore, stage: str) -> AsyncIterator[None]:
+    """
+    Holds one of `slots`, a pipeline stage's concurrency limit, for the body of the `with`. A batch
+    item's deadline is paused while it waits; any other deadline keeps running, and passing it
+    while still queued raises DeadlineExceeded.
+    """
+    deadline = current_deadline()
+    if deadline is not None and deadline.queueing_exempt:
+        deadline.pause()
+        try:
+            await slots.acquire()
+        finally:
+            deadline.resume()
+    else:
+        await within_deadline(slots.acquire(), f"the wait for {stage}")
+    try:
+        yield
+    finally:
+        slots.release()
+
+async def without_deadline(awaitable: Awaitable) -> Any:
+    """Runs `awaitable` outside any request deadline; for tasks shared between requests, whose waiters bound their own wait."""
+    with deadline_scope(None):
+        return await awaitable
+
+class DeadlinePolicy:
+    """Builds each request's Deadline; `dependency` reads the X-Request-Timeout header."""
+
+    def __init__(self, service_name: str, default_seconds: float = REQUEST_DEADLINE_SECONDS,
+                 max_seconds: float = REQUEST_DEADLINE_MAX_SECONDS):
+        self.service_name = service_name
+        self.default_seconds = default_seconds
+        self.max_seconds = max_seconds
+
+        # One function object, so FastAPI caches it per request when it is listed more than once
+        async def deadline_dependency(x_request_timeout: Optional[str] = Header(None)) -> Deadline:
+            return self.new(self.parse_header(x_request_timeout))
+        self.dependency = deadline_dependency
+
+    def parse_header(self, value: Optional[str]) -> float:
+        if value is None or not value.strip():
+            return self.default_seconds
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = float("nan")
+        if not seconds > 0:
+            raise HTTPException(status_code=400, detail=f"{REQUEST_TIMEOUT_HEADER} must be a positive number of seconds.")
+        return min(seconds, self.max_seconds)
+
+    def new(self, seconds: Optional[float] = None) -> Deadline:
+        return Deadline(seconds or self.default_seconds, self.service_name)
+
+    def exceeded(self, deadline: Deadline, filename: str, error: DeadlineExceeded) -> dict:
+        """The 504 payload for a request that produced nothing before its deadline."""
+        DEADLINES_EXCEEDED.labels(self.service_name).inc()
+        logger.warning(f"Request for '{filename}' exceeded its {deadline.seconds:.1f}s deadline: {error}")
+        return {"filename": filename, "detail": f"{error} Retry with a larger {REQUEST_TIMEOUT_HEADER} or use the job endpoint."}
@@ -0,0 +1,395 @@
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpx
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Submissions beyond this many queued jobs are refused with 429
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))
+# Finished jobs (and their results) are kept this long for polling, then deleted
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(24 * 3600)))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+JOB_CALLBACK_TIMEOUT_SECONDS = float(os.getenv("JOB_CALLBACK_TIMEOUT_SECONDS", "10"))
+JOB_CALLBACK_ATTEMPTS = int(os.getenv("JOB_CALLBACK_ATTEMPTS", "3"))
+# Comma-separated hosts callbacks may be sent to; empty disables callbacks
+JOB_CALLBACK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+# Callback hosts must resolve to public addresses; set for allowlisted hosts on an internal network
+JOB_CALLBACK_ALLOW_PRIVATE_ADDRESSES = os.getenv("JOB_CALLBACK_ALLOW_PRIVATE_ADDRESSES", "false").lower() == "true"
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+JOBS_SUBMITTED = Counter("jobs_submitted", "Jobs accepted by the job queue.", ["service"])
+JOBS_FINISHED = Counter("jobs_finished", "Jobs finished, by final status.", ["service", "status"])
+JOB_QUEUE_DEPTH = Gauge("job_queue_depth", "Jobs waiting for a worker.", ["service"])
+JOB_TURNAROUND = Histogram(
+    "job_turnaround_seconds",
+    "Time from submission to a finished job.",
+    ["service"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0),
+)
+CALLBACKS = Counter("job_callbacks", "Completion callbacks, by outcome.", ["service", "outcome"])
+
+# handler(payload, metadata) -> (status_code, result body); status codes >= 400 mark the job failed
+JobHandler = Callable[[bytes, Dict[str, Any]], Awaitable[Tuple[int, Dict[str, Any]]]]
+
+class JobQueueFull(Exception):
+    """Raised by submit() when JOB_MAX_QUEUED jobs are already waiting."""
+
+class InvalidCallbackURL(ValueError):
+    """Raised by submit() for callback URLs that are not http(s), not on the allowed host list, or resolve to non-public addresses."""
+
+class IdempotencyKeyConflict(Exception):
+    """Raised by submit() when an idempotency key is reused with a different upload."""
+
+@dataclass
+class Job:
+    job_id: str
+    status: str
+    idempotency_key: Optional[str]
+    metadata: Dict[str, Any]
+    callback_url: Optional[str]
+    attempts: int
+    status_code: Optional[int]
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    callback_status: Optional[str]
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        del data["idempotency_key"], data["callback_url"]
+        return data
+
+_COLUMNS = ("job_id, status, idempotency_key, metadata, callback_url, attempts, status_code, result, error, "
+            "callback_status, created_at, started_at, finished_at")
+
+def _row_to_job(row) -> Job:
+    (job_id, status, idempotency_key, metadata, callback_url, attempts, status_code, result, error,
+     callback_status, created_at, started_at, finished_at) = row
+    return Job(job_id, status, idempotency_key, json.loads(metadata), callback_url, attempts, status_code,
+               json.loads(result) if result is not None else None, error, callback_status, created_at, started_at, finished_at)
+
+def _public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+async def validate_callback_url(url: str):
+    """
+    Callbacks go only to allowlisted hosts, and only while every address the host resolves to is
+    public (not loopback, private, link-local or reserved), so a submitted callback_url cannot make
+    the backend call internal services. Checked on submit and again before each delivery attempt.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise InvalidCallbackURL("callback_url must be an absolute http(s) URL.")
+    if not JOB_CALLBACK_ALLOWED_HOSTS:
+        raise InvalidCallbackURL("Callbacks are disabled on this server; poll the job status URL instead.")
+    host = parsed.hostname.lower()
+    if host not in JOB_CALLBACK_ALLOWED_HOSTS:
+        raise InvalidCallbackURL(f"callback_url host '{parsed.hostname}' is not allowed.")
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as e:
+        raise InvalidCallbackURL(f"callback_url host '{parsed.hostname}' could not be resolved: {e}")
+    if not JOB_CALLBACK_ALLOW_PRIVATE_ADDRESSES:
+        blocked = sorted({info[4][0] for info in addresses if not _public_address(info[4][0])})
+        if blocked:
+            raise InvalidCallbackURL(f"callback_url host '{parsed.hostname}' resolves to a non-public address ({', '.join(blocked)}).")
+
+def payload_digest(payload) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+def scoped_idempotency_key(idempotency_key: Optional[str], owner: str) -> Optional[str]:
+    """Idempotency keys are per owner. The prefixes (and the length of the user id) keep anonymous
+    keys and each user's keys apart, whatever characters the key or the user id contain."""
+    if not idempotency_key:
+        return None
+    return f"user:{len(owner)}:{owner}:{idempotency_key}" if owner else f"anon:{idempotency_key}"
+
+class JobQueue:
+    """
+    Durable submit/poll job queue backed by a local SQLite file, drained by a pool of asyncio workers.
+
+    Jobs carry the uploaded bytes and survive restarts: anything still marked running when the
+    queue starts was interrupted and is queued again, up to `max_attempts`. A job submitted again
+    with the same idempotency key and the same upload returns the existing job instead of doing the
+    work twice; the same key with a different upload is refused (409). Jobs belong to the owner they
+    were submitted for (the X-User-Id header, "" when anonymous): idempotency keys are per owner and
+    get() only returns the owner's own jobs. When a job finishes, its
+    status is POSTed to the optional callback URL, and finished jobs are deleted after
+    `result_ttl_seconds`.
+    """
+
+    def __init__(self, service_name: str, db_path: str, handler: JobHandler, workers: int = JOB_WORKERS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, max_queued: int = JOB_MAX_QUEUED,
+                 result_ttl_seconds: float = JOB_RESULT_TTL_SECONDS):
+        self.service_name = service_name
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self.result_ttl_seconds = result_ttl_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._worker_tasks: List[asyncio.Task] = []
+        self._callback_tasks: set = set()
+        self._http: Optional[httpx.AsyncClient] = None
+        self._last_purge = 0.0
+
+    # --- SQLite access; every method below runs in a worker thread under the lock ---
+
+    def _open(self):
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, idempotency_key TEXT UNIQUE, metadata TEXT NOT NULL,"
+            " callback_url TEXT, attempts INTEGER NOT NULL DEFAULT 0, status_code INTEGER, result TEXT, error TEXT,"
+            " callback_status TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, payload BLOB,"
+            " payload_sha256 TEXT)")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "payload_sha256" not in columns:
+            # Databases created before idempotency keys were tied to the upload
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN payload_sha256 TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        with self._lock:
+            now = time.time()
+            # Jobs a previous process was running when it stopped
+            failed = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, payload = NULL WHERE status = ? AND attempts >= ?",
+                (FAILED, "Interrupted by a restart too many times.", now, RUNNING, self.max_attempts)).rowcount
+            requeued = self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING)).rowcount
+            self._conn.commit()
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+        JOB_QUEUE_DEPTH.labels(self.service_name).set(queued)
+        logger.info(f"Job queue '{self.service_name}' opened at {self.db_path}: {queued} queued "
+                    f"({requeued} resumed after a restart, {failed} given up).")
+
+    def _get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def _submit(self, payload: bytes, metadata: Dict[str, Any], idempotency_key: Optional[str],
+                callback_url: Optional[str]) -> Tuple[Job, bool]:
+        digest = payload_digest(payload)
+        with self._lock:
+            if idempotency_key:
+                row = self._conn.execute(f"SELECT {_COLUMNS}, payload_sha256 FROM jobs WHERE idempotency_key = ?",
+                                         (idempotency_key,)).fetchone()
+                if row:
+                    if row[-1] != digest:
+                        raise IdempotencyKeyConflict("This Idempotency-Key was already used for a different upload.")
+                    return _row_to_job(row[:-1]), False
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise JobQueueFull(f"{queued} jobs are already queued.")
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, idempotency_key, metadata, callback_url, created_at, payload, payload_sha256)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, idempotency_key, json.dumps(metadata), callback_url, time.time(), payload, digest))
+            self._conn.commit()
+            row = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        JOB_QUEUE_DEPTH.labels(self.service_name).set(queued + 1)
+        return _row_to_job(row), True
+
+    def _claim(self) -> Optional[Tuple[Job, bytes]]:
+        """Marks the oldest queued job as running and returns it with its payload."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_COLUMNS}, payload FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self._conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ? WHERE job_id = ?",
+                               (RUNNING, now, row[0]))
+            self._conn.commit()
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+        JOB_QUEUE_DEPTH.labels(self.service_name).set(queued)
+        job = _row_to_job(row[:-1])
+        job.status, job.attempts, job.started_at = RUNNING, job.attempts + 1, now
+        return job, row[-1]
+
+    def _finish(self, job_id: str, status: str, status_code: Optional[int], result: Optional[Dict[str, Any]], error: Optional[str]):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, status_code = ?, result = ?, error = ?, finished_at = ?, payload = NULL WHERE job_id = ?",
+                (status, status_code, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+            self._conn.commit()
+
+    def _requeue(self, job_id: str, error: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, error = ? WHERE job_id = ?", (QUEUED, error, job_id))
+            self._conn.commit()
+
+    def _set_callback_status(self, job_id: str, callback_status: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET callback_status = ? WHERE job_id = ?", (callback_status, job_id))
+            self._conn.commit()
+
+    def _purge(self) -> int:
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                                         (SUCCEEDED, FAILED, time.time() - self.result_ttl_seconds)).rowcount
+            self._conn.commit()
+        return deleted
+
+    # --- Public API ---
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+        # Redirects are not followed: they could lead to a host that was never checked
+        self._http = httpx.AsyncClient(timeout=JOB_CALLBACK_TIMEOUT_SECONDS, follow_redirects=False)
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def close(self):
+        """Stops the workers. Jobs they were running stay marked running and are resumed on the next start."""
+        for task in self._worker_tasks + list(self._callback_tasks):
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, *self._callback_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def submit(self, payload: bytes, metadata: Dict[str, Any], idempotency_key: Optional[str] = None,
+                     callback_url: Optional[str] = None, owner: str = "") -> Tuple[Job, bool]:
+        """
+        Queues a job for `owner`, recorded as metadata["owner"]. Returns (job, created); created is
+        False when the idempotency key matched an existing job of the same owner for the same upload.
+        Raises IdempotencyKeyConflict for a different upload.
+        """
+        if callback_url:
+            await validate_callback_url(callback_url)
+        job, created = await asyncio.to_thread(self._submit, payload, {**metadata, "owner": owner},
+                                               scoped_idempotency_key(idempotency_key, owner), callback_url)
+        if created:
+            JOBS_SUBMITTED.labels(self.service_name).inc()
+            self._wakeup.set()
+        return job, created
+
+    async def get(self, job_id: str, owner: str = "") -> Optional[Job]:
+        """The job, or None when it does not exist or belongs to another owner."""
+        job = await asyncio.to_thread(self._get, job_id)
+        return job if job and job.metadata.get("owner", "") == owner else None
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                self._wakeup.clear()
+                claimed = await asyncio.to_thread(self._claim)
+                if claimed is None:
+                    await self._idle()
+                    continue
+                await self._run(*claimed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep the worker alive through database hiccups
+                logger.exception(f"Job worker {index} of '{self.service_name}' failed: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+    async def _idle(self):
+        if time.monotonic() - self._last_purge > 60:
+            self._last_purge = time.monotonic()
+            deleted = await asyncio.to_thread(self._purge)
+            if deleted:
+                logger.info(f"Deleted {deleted} expired jobs from '{self.service_name}'.")
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self, job: Job, payload: bytes):
+        logger.info(f"Job {job.job_id} started (attempt {job.attempts}/{self.max_attempts}).")
+        try:
+            status_code, result = await self.handler(payload, job.metadata)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts < self.max_attempts:
+                logger.warning(f"Job {job.job_id} attempt {job.attempts} failed ({error}); requeueing.")
+                await asyncio.sleep(min(30.0, random.uniform(0, 2 ** job.attempts)))
+                await asyncio.to_thread(self._requeue, job.job_id, error)
+                self._wakeup.set()
+                return
+            logger.error(f"Job {job.job_id} failed after {job.attempts} attempts: {error}")
+            job.status, job.status_code, job.result, job.error = FAILED, None, None, error
+        else:
+            job.status = SUCCEEDED if status_code < 400 else FAILED
+            job.status_code, job.result, job.error = status_code, result, None
+        job.finished_at = time.time()
+        await asyncio.to_thread(self._finish, job.job_id, job.status, job.status_code, job.result, job.error)
+        JOBS_FINISHED.labels(self.service_name, job.status).inc()
+        JOB_TURNAROUND.labels(self.service_name).observe(job.finished_at - job.created_at)
+        logger.info(f"Job {job.job_id} {job.status} in {job.finished_at - job.created_at:.2f}s.")
+        if job.callback_url:
+            task = asyncio.create_task(self._deliver_callback(job))
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+
+    async def _deliver_callback(self, job: Job):
+        for attempt in range(1, JOB_CALLBACK_ATTEMPTS + 1):
+            try:
+                # DNS may have changed since the job was submitted
+                await validate_callback_url(job.callback_url)
+            except InvalidCallbackURL as e:
+                logger.warning(f"Callback for job {job.job_id} not sent: {e}")
+                CALLBACKS.labels(self.service_name, "blocked").inc()
+                await asyncio.to_thread(self._set_callback_status, job.job_id, "blocked")
+                return
+            try:
+                response = await self._http.post(job.callback_url, json=job.to_dict())
+                if response.status_code < 300:
+                    CALLBACKS.labels(self.service_name, "delivered").inc()
+                    await asyncio.to_thread(self._set_callback_status, job.job_id, "delivered")
+                    return
+                reason = f"HTTP {response.status_code}"
+            except httpx.HTTPError as e:
+                reason = f"{type(e).__name__}: {e}"
+            logger.warning(f"Callback for job {job.job_id} failed (attempt {attempt}): {reason}")
+            if attempt < JOB_CALLBACK_ATTEMPTS:
+                await asyncio.sleep(random.uniform(0, 2 ** attempt))
+        CALLBACKS.labels(self.service_name, "failed").inc()
+        await asyncio.to_thread(self._set_callback_status, job.job_id, "failed")
+
+async def job_queue_full_handler(request: Request, exc: JobQueueFull):
+    return JSONResponse(status_code=429, content={"detail": f"Job queue is full: {exc}"}, headers={"Retry-After": "30"})
+
+async def invalid_callback_url_handler(request: Request, exc: InvalidCallbackURL):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+async def idempotency_key_conflict_handler(request: Request, exc: IdempotencyKeyConflict):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+from huggingface_hub import AsyncInferenceClient
+from prometheus_client import Counter, Gauge, Histogram
+
+from backend_shared.deadline import DEADLINE_MIN_LLM_CALL_SECONDS, time_allows, within_deadline
+
+logger = logging.getLogger(__name__)
+
+# Points every backend's text-generation calls at another TGI-compatible server (e.g. the local stub)
+LLM_ENDPOINT_URL = os.getenv("LLM_ENDPOINT_URL")
+# A duplicate request is sent once the first has run longer than this percentile of recent latencies...
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+# ...until enough samples exist, this fixed delay is used instead
+LLM_HEDGE_INITIAL_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_INITIAL_DELAY_SECONDS", "5"))
+# Hedges are capped at this fraction of calls so a slow upstream is not hit with double the load
+LLM_HEDGE_MAX_FRACTION = float(os.getenv("LLM_HEDGE_MAX_FRACTION", "0.1"))
+# Retries for timeouts, connection errors, 429 and 5xx, with full-jitter exponential backoff
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", "0.25"))
+LLM_RETRY_MAX_DELAY_SECONDS = float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", "4"))
+# Consecutive failed calls that open the circuit, and how long it stays open before a probe is let through
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+UPSTREAM_LATENCY = Histogram(
+    "llm_upstream_duration_seconds",
+    "Latency of successful upstream text-generation calls (time to first token when streaming).",
+    ["service"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+HEDGES = Counter("llm_hedged_requests", "Duplicate upstream requests sent after the hedge delay.", ["service", "winner"])
+RETRIES = Counter("llm_retries", "Upstream calls retried after a transient error.", ["service"])
+FALLBACKS = Counter("llm_fallbacks", "Calls answered from the last-good response cache or failed fast.", ["service", "reason"])
+CIRCUIT_STATE = Gauge("llm_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open.", ["service"])
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Timeouts, dropped connections, 429 and 5xx are worth retrying; other errors (bad requests, auth) are not."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    if type(exc).__name__ == "OverloadedError":
+        return True
+    response = getattr(exc, "response", None)
+    status_code = getattr(response, "status_code", None) or getattr(exc, "status", None)
+    return status_code in TRANSIENT_STATUS_CODES
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class CircuitBreaker:
+    """
+    Closed until `failure_threshold` consecutive calls fail, then open (calls fail fast) for
+    `reset_seconds`. After that a single half-open probe is allowed; its outcome closes the
+    circuit again or re-opens it for another period.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, service_name: str, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.service_name = service_name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        CIRCUIT_STATE.labels(service_name).set(self.state)
+
+    def _set_state(self, state: int):
+        if state != self.state:
+            logger.warning(f"LLM circuit breaker for {self.service_name}: {self._state_name(self.state)} -> {self._state_name(state)}")
+        self.state = state
+        CIRCUIT_STATE.labels(self.service_name).set(state)
+
+    @staticmethod
+    def _state_name(state: int) -> str:
+        return {0: "closed", 1: "half-open", 2: "open"}[state]
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def release_probe(self):
+        """Frees the half-open probe slot when a call ends without a verdict (e.g. a non-transient error)."""
+        self._probe_in_flight = False
+
+class ResilientLLMClient:
+    """
+    Wraps AsyncInferenceClient.text_generation with hedging, retries and a circuit breaker.
+
+    - A call still running after the p95 of recent latencies gets a duplicate; whichever returns
+      first wins and the other is cancelled (for streams, the race is to the first token).
+    - Transient errors are retried with full-jitter exponential backoff.
+    - Repeated failures open the circuit: calls then fail fast with CircuitOpenError, unless the
+      same prompt succeeded recently, in which case that last-good answer is served instead.
+    - Inside a request deadline (backend_shared.deadline), each attempt is bounded by the time
+      left and no retry is started that could not finish in time; running out raises DeadlineExceeded.
+    """
+
+    def __init__(self, service_name: str, model: str, token: Optional[str] = None, timeout: Optional[float] = None,
+                 client: Any = None, breaker: Optional[CircuitBreaker] = None, max_retries: int = LLM_MAX_RETRIES,
+                 hedge_enabled: bool = LLM_HEDGE_ENABLED, last_good_max_entries: int = 500):
+        self.service_name = service_name
+        self.model = LLM_ENDPOINT_URL or model
+        self._client = client or AsyncInferenceClient(model=self.model, token=token, timeout=timeout)
+        self.breaker = breaker or CircuitBreaker(service_name)
+        self.max_retries = max_retries
+        self.hedge_enabled = hedge_enabled
+        self.latency = LatencyTracker()
+        self._calls = 0
+        self._hedges_sent = 0
+        self._last_good: "OrderedDict[str, str]" = OrderedDict()
+        self._last_good_max_entries = last_good_max_entries
+
+    async def close(self):
+        await self._client.close()
+
+    # --- Last-good responses, served while the upstream is unhealthy ---
+
+    @staticmethod
+    def _prompt_key(prompt: str, kwargs: dict) -> str:
+        return hashlib.sha256(f"{prompt}\x00{sorted(kwargs.items())}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, text: str):
+        self._last_good[key] = text
+        self._last_good.move_to_end(key)
+        while len(self._last_good) > self._last_good_max_entries:
+            self._last_good.popitem(last=False)
+
+    def _fallback(self, key: str, reason: str, error: BaseException) -> str:
+        cached = self._last_good.get(key)
+        if cached is None:
+            FALLBACKS.labels(self.service_name, f"{reason}_no_cache").inc()
+            raise error
+        FALLBACKS.labels(self.service_name, f"{reason}_cached").inc()
+        logger.warning(f"Serving last-good LLM response for {self.service_name} ({reason}).")
+        return cached
+
+    # --- Hedging ---
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge_enabled or self._hedges_sent >= LLM_HEDGE_MAX_FRACTION * self._calls:
+            return None
+        observed = self.latency.percentile(LLM_HEDGE_PERCENTILE)
+        if observed is None:
+            return LLM_HEDGE_INITIAL_DELAY_SECONDS
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, observed)
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[Any]],
+                      discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        """Runs `attempt`, racing a second copy if the first is slower than the hedge delay."""
+        self._calls += 1
+        started = time.perf_counter()
+        primary = asyncio.create_task(attempt())
+        tasks = [primary]
+        try:
+            delay = self._hedge_delay()
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self._hedges_sent += 1
+                tasks.append(asyncio.create_task(attempt()))
+
+            pending = set(tasks)
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    last_error = next(iter(done)).exception()
+                    continue
+                winner = winners[0]
+                for extra in winners[1:]: # Both copies finished in the same tick; release the unused one
+                    if discard:
+                        await discard(extra.result())
+                if len(tasks) > 1:
+                    HEDGES.labels(self.service_name, "primary" if winner is primary else "hedge").inc()
+                elapsed = time.perf_counter() - started
+                self.latency.record(elapsed)
+                UPSTREAM_LATENCY.labels(self.service_name).observe(elapsed)
+                return winner.result()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _with_retries(self, attempt: Callable[[], Awaitable[Any]],
+                            discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"LLM upstream for {self.service_name} is unavailable (circuit open).")
+        for attempt_number in range(self.max_retries + 1):
+            try:
+                result = await within_deadline(self._hedged(attempt, discard), "the LLM call")
+                self.breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                if not is_transient_error(e):
+                    self.breaker.release_probe()
+                    raise
+                if attempt_number == self.max_retries or self.breaker.state == CircuitBreaker.HALF_OPEN:
+                    self.breaker.record_failure()
+                    raise
+                backoff = random.uniform(0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt_number))
+                if not time_allows(backoff + DEADLINE_MIN_LLM_CALL_SECONDS):
+                    # A retry could not finish before the request deadline; fail now with the real error
+                    self.breaker.record_failure()
+                    raise
+                logger.warning(f"Transient LLM error for {self.service_name} ({type(e).__name__}: {e}); retrying in {backoff:.2f}s.")
+                RETRIES.labels(self.service_name).inc()
+                await asyncio.sleep(backoff)
+
+    # --- Public API, mirroring AsyncInferenceClient.text_generation ---
+
+    async def text_generation(self, prompt: str, **kwargs) -> str:
+        """Non-streaming generation; returns the generated text."""
+        key = self._prompt_key(prompt, kwargs)
+        try:
+            text = await self._with_retries(lambda: self._client.text_generation(prompt=prompt, **kwargs))
+        except CircuitOpenError as e:
+            return self._fallback(key, "circuit_open", e)
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            return self._fallback(key, "upstream_error", e)
+        self._remember(key, text)
+        return text
+
+    async def _open_stream(self, prompt: str, kwargs: dict):
+        """Starts a streamed generation and waits for its first token; returns (stream, first_token)."""
+        stream = await self._client.text_generation(prompt=prompt, stream=True, **kwargs)
+        try:
+            first_token = await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+        except BaseException:
+            await _close_stream(stream)
+            raise
+        return stream, first_token
+
+    async def stream_text_generation(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """
+        Streaming generation. Hedging and retries apply until the first token arrives; after that
+        the winning stream is consumed to the end. Closing this generator closes the upstream stream.
+        """
+        key = self._prompt_key(prompt, kwargs)
+        try:
+            stream, first_token = await self._with_retries(
+                lambda: self._open_stream(prompt, kwargs),
+                discard=lambda opened: _close_stream(opened[0]),
+            )
+        except CircuitOpenError as e:
+            yield self._fallback(key, "circuit_open", e)
+            return
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            yield self._fallback(key, "upstream_error", e)
+            return
+
+        chunks = []
+        try:
+            if first_token is not None:
+                chunks.append(first_token)
+                yield first_token
+            async for token_text in stream:
+                chunks.append(token_text)
+                yield token_text
+        except Exception as e:
+            if is_transient_error(e):
+                self.breaker.record_failure()
+            raise
+        finally:
+            await _close_stream(stream)
+        self._remember(key, "".join(chunks))
+
+async def _close_stream(stream):
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
@@ -0,0 +1,71 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Root level for every backend; DEBUG also enables the retrievers' verbose traces
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Large payloads (prompts, raw LLM output, OCR text) are truncated to this many characters...
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+# ...and only logged for this fraction of calls (1.0 logs every payload, 0 disables them)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+
+_listener = None
+
+def setup_logging(service_name: str, log_dir: str) -> logging.handlers.QueueListener:
+    """
+    Routes all logging through a QueueHandler so request handlers only enqueue records.
+    A background QueueListener thread does the formatting-to-disk work for a size-capped
+    rotating file (<log_dir>/<service_name>.log) and the console.
+    Safe to call more than once; the first call wins.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    os.makedirs(log_dir, exist_ok=True)
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, f"{service_name}.log"), maxBytes=10*1024*1024, backupCount=5
+    )
+    file_handler.setFormatter(log_formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+    console_handler.setLevel(logging.INFO)
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return _listener
+
+def shutdown_logging():
+    """Flushes queued records and stops the listener thread (registered with atexit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def log_payload(logger: logging.Logger, label: str, payload, level: int = logging.INFO):
+    """
+    Logs a potentially large payload truncated to LOG_PAYLOAD_MAX_CHARS, so full prompts and
+    OCR dumps never dominate request latency. Below WARNING only a LOG_PAYLOAD_SAMPLE_RATE
+    fraction of calls is logged; payloads attached to warnings and errors are always kept.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    text = payload if isinstance(payload, str) else str(payload)
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... [truncated, {len(text)} chars total]"
+    logger.log(level, f"{label}: {text}")
@@ -0,0 +1,259 @@
+"""
+Parsing of LLM extraction replies shared by the receipt and income backends: the JSON object
+in a model reply, dates and money amounts.
+
+All patterns are compiled once at import. Dates are matched against a small set of patterns,
+each covering a family of formats (any separator, optional time, 2- or 4-digit year), instead
+of trying strptime format after format; the pattern that matched last is tried first, since one
+model tends to answer in one format. Ambiguous numeric dates are read day-first, as Malaysian
+documents are printed (the same rule as the receipt layout extractor).
+
+Check consistency and speed with `python parsing_benchmark.py` (see that file).
+"""
+import json
+import logging
+import math
+import re
+from datetime import date
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Values models use for "no value"; parsed as missing rather than as text
+NOT_PROVIDED = frozenset({"", "n/a", "na", "none", "null", "nil", "-", "unknown", "not provided", "not specified",
+                          "not found", "not available"})
+
+_MONTHS = {name: number for number, names in enumerate([
+    ("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",), ("jun", "june"),
+    ("jul", "july"), ("aug", "august"), ("sep", "sept", "september"), ("oct", "october"), ("nov", "november"),
+    ("dec", "december")], 1) for name in names}
+_MONTH_ALTERNATIVES = "|".join(sorted(_MONTHS, key=len, reverse=True))
+_WEEKDAY_PREFIX = r"(?:(?:mon|tue|wed|thu|fri|sat|sun)[a-z]*\.?,?\s+)?"
+# Trailing time: "T13:42:00Z", " 13:42", "T13:42:00.123+08:00"
+_TIME_SUFFIX = r"(?:[T\s]+\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?\s*(?:[AaPp][Mm])?\s*(?:Z|[+-]\d{2}:?\d{2})?)?"
+
+def _year(text: str) -> int:
+    year = int(text)
+    if len(text) <= 2:
+        # strptime's %y rule
+        year += 2000 if year < 69 else 1900
+    return year
+
+def _ymd(m: re.Match, day_first: bool) -> Tuple[int, int, int]:
+    year, first, second = int(m["y"]), int(m["a"]), int(m["b"])
+    # YYYY-DD-MM only when the middle part cannot be a month
+    return (year, second, first) if first > 12 >= second else (year, first, second)
+
+def _numeric(m: re.Match, day_first: bool) -> Tuple[int, int, int]:
+    first, second, year = int(m["a"]), int(m["b"]), _year(m["y"])
+    if first > 12 >= second:
+        day_first = True
+    elif second > 12 >= first:
+        day_first = False
+    return (year, second, first) if day_first else (year, first, second)
+
+def _compact(m: re.Match, day_first: bool) -> Tuple[int, int, int]:
+    return int(m["y"]), int(m["m"]), int(m["d"])
+
+def _day_month_name(m: re.Match, day_first: bool) -> Tuple[int, int, int]:
+    return _year(m["y"]), _MONTHS[m["mon"].lower()], int(m["d"])
+
+_DATE_PATTERNS: List[Tuple[re.Pattern, Callable[[re.Match, bool], Tuple[int, int, int]]]] = [
+    # 2025-03-14, 2025/03/14, 2025.3.14, ISO 8601 with time
+    (re.compile(rf"(?P<y>\d{{4}})[-/.](?P<a>\d{{1,2}})[-/.](?P<b>\d{{1,2}}){_TIME_SUFFIX}"), _ymd),
+    # 14/03/2025, 03-14-2025, 14.03.25
+    (re.compile(rf"(?P<a>\d{{1,2}})[-/.](?P<b>\d{{1,2}})[-/.](?P<y>\d{{4}}|\d{{2}}){_TIME_SUFFIX}"), _numeric),
+    # 14 Mar 2025, 14-March-2025, 14th March, 2025
+    (re.compile(rf"{_WEEKDAY_PREFIX}(?P<d>\d{{1,2}})(?:st|nd|rd|th)?[\s\-/.]*(?P<mon>{_MONTH_ALTERNATIVES})\.?[\s\-/.,]*(?P<y>\d{{4}}|\d{{2}}){_TIME_SUFFIX}",
+                re.IGNORECASE), _day_month_name),
+    # Mar 14, 2025, March 14th 2025
+    (re.compile(rf"{_WEEKDAY_PREFIX}(?P<mon>{_MONTH_ALTERNATIVES})\.?[\s\-/.]*(?P<d>\d{{1,2}})(?:st|nd|rd|th)?[\s,]+(?P<y>\d{{4}}){_TIME_SUFFIX}",
+                re.IGNORECASE), _day_month_name),
+    # 20250314
+    (re.compile(r"(?P<y>\d{4})(?P<m>\d{2})(?P<d>\d{2})"), _compact),
+]
+
+class DateParser:
+    """Single-pass date parsing over _DATE_PATTERNS, starting with the pattern that matched last."""
+
+    def __init__(self, day_first: bool = True):
+        self.day_first = day_first
+        # Index into _DATE_PATTERNS; shared between threads, a stale value only changes the order tried
+        self._last = 0
+
+    def parse(self, text: Any) -> Optional[date]:
+        """The date `text` holds (the whole string, surrounding whitespace and punctuation aside), or None."""
+        if not isinstance(text, str):
+            return None
+        text = text.strip().strip(",;")
+        if text.lower() in NOT_PROVIDED:
+            return None
+        last = self._last
+        order = [last] + [i for i in range(len(_DATE_PATTERNS)) if i != last]
+        for index in order:
+            pattern, to_parts = _DATE_PATTERNS[index]
+            m = pattern.fullmatch(text)
+            if m is None:
+                continue
+            year, month, day = to_parts(m, self.day_first)
+            try:
+                parsed = date(year, month, day)
+            except ValueError:
+                continue
+            self._last = index
+            return parsed
+        return None
+
+_default_date_parser = DateParser()
+
+def parse_date(text: Any) -> Optional[date]:
+    return _default_date_parser.parse(text)
+
+def normalize_date(value: Any) -> str:
+    """YYYY-MM-DD when `value` is a recognizable date, "" when it is missing, otherwise the original text."""
+    if value is None:
+        return ""
+    text = str(value).strip()
+    if text.lower() in NOT_PROVIDED:
+        return ""
+    parsed = parse_date(text)
+    if parsed is None:
+        logger.warning(f"Date '{text}' is not in a recognized format. Leaving it as is.")
+        return text
+    return parsed.isoformat()
+
+# The first number in the text: digits in groups of three ("1,234", "1.234.567", "1 234") or plain
+# digits, each with an optional decimal part, after an optional currency. A sign counts only when
+# attached ("-RM 5", "RM -5", "(25.00)"), so the dash in "Consultation - RM 150" is not a minus
+_NUMBER = re.compile(
+    r"(?P<sign>[-\u2212(])?(?:RM|MYR|USD|SGD|EUR|GBP|[$\u20ac\u00a3])?\s*(?P<sign_after>[-\u2212])?"
+    r"(?P<number>\d{1,3}(?:[,.'\u00a0 ]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?|\.\d+)",
+    re.IGNORECASE)
+_PLAIN_NUMBER = re.compile(r"\s*-?\d+(?:\.\d+)?\s*")
+
+def parse_amount(value: Any) -> Optional[float]:
+    """
+    A money amount from a number or text such as "RM 1,234.50", "1.234,50", "12,50", "MYR 300"
+    or "(25.00)". A separator followed by exactly three digits groups thousands, except a lone
+    "." ("1.234" is read as a decimal, as models write amounts); any other last separator is
+    the decimal point. Returns None for missing or unparseable values.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else None
+    if not isinstance(value, str):
+        return None
+    if _PLAIN_NUMBER.fullmatch(value):
+        # Most replies are a plain number already
+        amount = float(value)
+        return amount if math.isfinite(amount) else None
+    if value.strip().lower() in NOT_PROVIDED:
+        return None
+    m = _NUMBER.search(value)
+    if m is None:
+        return None
+    number = m["number"]
+    separators = [i for i, char in enumerate(number) if not char.isdigit()]
+    digits = [char for char in number if char.isdigit()]
+    if separators:
+        last = separators[-1]
+        decimals = len(number) - last - 1
+        lone_dot = len(separators) == 1 and number[last] == "."
+        if decimals != 3 or lone_dot or len({number[i] for i in separators}) > 1:
+            digits.insert(len(digits) - decimals, ".")
+    amount = float("".join(digits))
+    if not math.isfinite(amount):
+        return None
+    return -amount if m["sign"] or m["sign_after"] else amount
+
+_TRUE = frozenset({"true", "yes", "y", "1"})
+_FALSE = frozenset({"false", "no", "n", "0"})
+
+def parse_bool(value: Any, default: bool = False) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return bool(value)
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in _TRUE:
+            return True
+        if lowered in _FALSE:
+            return False
+    if value is not None:
+        logger.warning(f"Boolean value {value!r} is not true/false. Using {default}.")
+    return default
+
+_decoder = json.JSONDecoder()
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_TYPOGRAPHIC_QUOTES = str.maketrans({"“": '"', "”": '"'})
+# Objects tried before giving up; a reply rarely has more than one or two '{' before the real object
+_MAX_OBJECT_CANDIDATES = 8
+
+def _matching_brace(text: str, start: int) -> int:
+    """Index just past the '}' closing the object that opens at `start`, or -1 when it never closes."""
+    depth, in_string, escaped = 0, False, False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+def extract_json_object(text: Any) -> Optional[dict]:
+    """
+    The first JSON object in a model reply, or None. A clean reply is parsed directly; otherwise
+    the object is decoded in place from each '{' on, which skips markdown fences and prose around
+    it without rewriting the string. Trailing commas and typographic quotes are repaired as a
+    last resort.
+    """
+    if not isinstance(text, str):
+        return None
+    stripped = text.strip()
+    if stripped.startswith("{") and stripped.endswith("}"):
+        try:
+            value = json.loads(stripped)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            pass
+    start = stripped.find("{")
+    for _ in range(_MAX_OBJECT_CANDIDATES):
+        if start == -1:
+            return None
+        try:
+            value, _end = _decoder.raw_decode(stripped, start)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            end = _matching_brace(stripped, start)
+            if end != -1:
+                repaired = _TRAILING_COMMA.sub(r"\1", stripped[start:end].translate(_TYPOGRAPHIC_QUOTES))
+                try:
+                    value = json.loads(repaired)
+                    if isinstance(value, dict):
+                        return value
+                except json.JSONDecodeError:
+                    pass
+        start = stripped.find("{", start + 1)
+    return None
+
+def clean_text(value: Any, default: str = "") -> str:
+    """A string field: stripped text, or `default` for missing values (None, "", "N/A" stays as written)."""
+    if value is None:
+        return default
+    text = str(value).strip()
+    return text if text else default
@@ -0,0 +1,170 @@
+"""
+Consistency, fuzz and speed checks for backend_shared/parsing.py.
+
+    python parsing_benchmark.py                 # corpus check, 5000 fuzz cases, micro-benchmarks
+    python parsing_benchmark.py --fuzz 100000 --seed 7 --no-bench
+
+1. Every entry of parsing_corpus.jsonl ({"kind": "date" | "amount" | "json", "input", "expected"})
+   must parse to its expected value. Add an entry whenever a model reply was parsed wrongly.
+2. Fuzzing mutates the corpus inputs (truncation, random characters, fences and prose around
+   JSON, padding, very long strings) and checks that the parsers never raise, return the
+   documented types, and give the same answer for a JSON reply however it is wrapped.
+3. Micro-benchmarks time each parser on the corpus against the strptime-loop / regex-cleanup
+   approach the backends used before, in microseconds per call.
+
+Exits with status 1 when a check or fuzz case fails.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import timeit
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_shared.parsing import extract_json_object, normalize_date, parse_amount, parse_date
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parsing_corpus.jsonl")
+
+def load_corpus(path: str = CORPUS_PATH) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def actual_value(kind: str, value):
+    if kind == "date":
+        return normalize_date(value)
+    if kind == "amount":
+        return parse_amount(value)
+    return extract_json_object(value)
+
+def check_corpus(corpus: list) -> int:
+    failures = 0
+    for entry in corpus:
+        actual = actual_value(entry["kind"], entry["input"])
+        expected = entry["expected"]
+        same = math.isclose(actual, expected) if isinstance(expected, float) and isinstance(actual, float) else actual == expected
+        if not same:
+            failures += 1
+            print(f"MISMATCH {entry['kind']} {entry['input']!r}: expected {expected!r}, got {actual!r}")
+    print(f"Corpus: {len(corpus) - failures}/{len(corpus)} entries parse as expected.")
+    return failures
+
+def mutate(rng: random.Random, text: str) -> str:
+    operation = rng.randrange(7)
+    if operation == 0 and text:
+        return text[:rng.randrange(len(text))]
+    if operation == 1:
+        i = rng.randrange(len(text) + 1)
+        return text[:i] + rng.choice(["{", "}", "\"", "\\", ",", "-", ".", "/", "```", " ", "−", "\x00", "RM"]) + text[i:]
+    if operation == 2 and text:
+        i = rng.randrange(len(text))
+        return text[:i] + text[i + 1:]
+    if operation == 3:
+        return rng.choice(["  ", "\n", "\t"]) + text + rng.choice(["", " ", ",", ";"])
+    if operation == 4:
+        return text * rng.randint(2, 50)
+    if operation == 5:
+        return "".join(rng.choice("0123456789.,-/: {}\"abcRMT") for _ in range(rng.randint(0, 40)))
+    return text.upper() if rng.random() < 0.5 else text.lower()
+
+def wrap_json(rng: random.Random, text: str) -> str:
+    return rng.choice([
+        "```json\n{}\n```", "```\n{}\n```", "Here is the result:\n{}", "{}\nHope this helps!",
+        "Sure! ```json\n{}\n``` Let me know.", "  {}  ",
+    ]).replace("{}", text, 1)
+
+def fuzz(corpus: list, cases: int, seed: int) -> int:
+    rng = random.Random(seed)
+    strings = [entry for entry in corpus if isinstance(entry["input"], str)]
+    objects = [entry for entry in corpus if entry["kind"] == "json" and entry["expected"] is not None]
+    failures = 0
+    for case in range(cases):
+        entry = rng.choice(strings)
+        text = mutate(rng, entry["input"])
+        try:
+            parsed_date = parse_date(text)
+            assert parsed_date is None or isinstance(parsed_date, date), f"parse_date returned {parsed_date!r}"
+            normalized = normalize_date(text)
+            assert normalized == "" or normalized == text.strip() or re.fullmatch(r"\d{4}-\d{2}-\d{2}", normalized), \
+                f"normalize_date returned {normalized!r}"
+            amount = parse_amount(text)
+            assert amount is None or (isinstance(amount, float) and math.isfinite(amount)), f"parse_amount returned {amount!r}"
+            value = extract_json_object(text)
+            assert value is None or isinstance(value, dict), f"extract_json_object returned {value!r}"
+            source = rng.choice(objects)
+            wrapped = wrap_json(rng, source["input"])
+            assert extract_json_object(wrapped) == source["expected"], f"wrapped reply parsed differently: {wrapped!r}"
+        except Exception as e:
+            failures += 1
+            if failures <= 20:
+                print(f"FUZZ FAILURE (case {case}, from {entry['input']!r}): {text!r}: {type(e).__name__}: {e}")
+    print(f"Fuzz: {cases - failures}/{cases} mutated inputs handled (seed {seed}).")
+    return failures
+
+# --- The approach parsing.py replaced, kept as the benchmark baseline ---
+REFERENCE_DATE_FORMATS = [
+    "%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%m-%d-%Y", "%d-%m-%Y",
+    "%Y/%m/%d", "%m/%d/%y", "%d/%m/%y", "%d %b %Y", "%d %B %Y",
+    "%b %d, %Y", "%B %d, %Y", "%Y%m%d", "%d.%m.%Y",
+    "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S",
+]
+
+def reference_date(text: str) -> str:
+    for fmt in REFERENCE_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return text
+
+def reference_amount(text: str):
+    cleaned = re.sub(r"[^\d.]", "", text.lower().strip())
+    try:
+        return float(cleaned) if cleaned and cleaned != "." else None
+    except ValueError:
+        return None
+
+def reference_json(text: str):
+    match = re.search(r"```(?:json)?\s*(.*?)\s*```", text, re.DOTALL | re.IGNORECASE)
+    try:
+        return json.loads(match.group(1).strip() if match else text.strip())
+    except json.JSONDecodeError:
+        return None
+
+def benchmark(corpus: list, number: int):
+    workloads = {
+        "date": ([e["input"] for e in corpus if e["kind"] == "date" and isinstance(e["input"], str)], normalize_date, reference_date),
+        "amount": ([e["input"] for e in corpus if e["kind"] == "amount" and isinstance(e["input"], str)], parse_amount, reference_amount),
+        "json": ([e["input"] for e in corpus if e["kind"] == "json"], extract_json_object, reference_json),
+    }
+    # One model answering in one date format is the common case the last-match memory is for
+    iso_dates = [f"2025-{month:02d}-{day:02d}" for month in range(1, 13) for day in (1, 15, 28)]
+    workloads["date (ISO only)"] = (iso_dates, normalize_date, reference_date)
+    print(f"\n{'workload':<18}{'inputs':>8}{'parsing.py us':>15}{'previous us':>14}{'speedup':>10}")
+    for name, (inputs, current, reference) in workloads.items():
+        current_seconds = min(timeit.repeat(lambda: [current(i) for i in inputs], number=number, repeat=3))
+        reference_seconds = min(timeit.repeat(lambda: [reference(i) for i in inputs], number=number, repeat=3))
+        per_call = 1e6 / (number * len(inputs))
+        print(f"{name:<18}{len(inputs):>8}{current_seconds * per_call:>15.2f}{reference_seconds * per_call:>14.2f}"
+              f"{reference_seconds / current_seconds:>9.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check, fuzz and benchmark the shared LLM output parsers.")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--fuzz", type=int, default=5000, help="Number of mutated inputs to try.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--number", type=int, default=200, help="Passes over the corpus per benchmark timing.")
+    parser.add_argument("--no-bench", action="store_true")
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.ERROR)
+    corpus = load_corpus(args.corpus)
+    failures = check_corpus(corpus) + fuzz(corpus, args.fuzz, args.seed)
+    if not args.no_bench:
+        benchmark(corpus, args.number)
+    sys.exit(1 if failures else 0)
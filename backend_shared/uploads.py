@@ -0,0 +1,165 @@
+"""
+Upload handling that keeps per-request memory flat as files and concurrency grow.
+
+- UploadSizeLimitMiddleware rejects oversized request bodies with 413 before they are parsed:
+  immediately from Content-Length, or as soon as a chunked body passes the limit.
+- Multipart file parts larger than UPLOAD_SPOOL_MAX_BYTES are spooled to a temporary file
+  instead of being held in memory (configure_upload_spooling).
+- upload_buffer() exposes an upload without copying it: a memoryview of the in-memory spool,
+  or a read-only mmap of the spooled file. cv2.imdecode, hashlib and sqlite3 accept either.
+- base64_data_url() encodes a buffer in chunks into one preallocated output instead of
+  building the bytes, the base64 bytes and the data URL string as separate full copies.
+"""
+import binascii
+import json
+import logging
+import mmap
+import os
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+from fastapi import UploadFile
+from prometheus_client import Counter
+from starlette.formparsers import MultiPartParser
+
+logger = logging.getLogger(__name__)
+
+# Request bodies larger than this are rejected with 413 (a batch upload counts as one body)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+# Uploaded files larger than this are spooled to disk while the request is parsed
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(256 * 1024)))
+# Bytes encoded per step by base64_data_url; a multiple of 3 so no padding appears mid-stream
+BASE64_CHUNK_BYTES = 3 * 256 * 1024
+
+UPLOADS_REJECTED = Counter("uploads_rejected", "Request bodies rejected for exceeding the upload size limit.", ["service"])
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+def configure_upload_spooling(max_bytes: int = UPLOAD_SPOOL_MAX_BYTES):
+    """Sets the size above which Starlette spools multipart file parts to disk (its default is 1MB)."""
+    MultiPartParser.spool_max_size = max_bytes
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware capping the request body size. A body over the limit is cut off by
+    reporting a client disconnect to the application, and whatever response the application
+    produces for the truncated body is replaced by a 413.
+    """
+
+    def __init__(self, app, service_name: str, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.app = app
+        self.service_name = service_name
+        self.max_bytes = max_bytes
+
+    async def _reject(self, send):
+        UPLOADS_REJECTED.labels(service=self.service_name).inc()
+        body = json.dumps({"detail": f"Upload too large; the limit is {self.max_bytes} bytes."}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    break
+                if declared > self.max_bytes:
+                    logger.warning(f"Rejected a {declared} byte upload to {scope['path']}; the limit is {self.max_bytes}.")
+                    await self._reject(send)
+                    return
+                break
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    logger.warning(f"Upload to {scope['path']} passed the {self.max_bytes} byte limit; cutting it off.")
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if exceeded:
+                if not response_started:
+                    response_started = True
+                    await self._reject(send)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+        if exceeded and not response_started:
+            await self._reject(send)
+
+@contextmanager
+def upload_buffer(file: UploadFile) -> Iterator[Buffer]:
+    """
+    The upload's bytes without copying them: a memoryview while the file is still in memory,
+    a read-only mmap once it has been spooled to disk. Valid only inside the `with` block;
+    do not keep numpy arrays or other views of it beyond that.
+    """
+    spooled = file.file
+    spooled.seek(0, os.SEEK_END)
+    size = spooled.tell()
+    spooled.seek(0)
+    if size == 0:
+        yield b""
+        return
+    in_memory = getattr(spooled, "_file", None)
+    if not getattr(spooled, "_rolled", True) and hasattr(in_memory, "getbuffer"):
+        view = in_memory.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+    try:
+        mapped = mmap.mmap(spooled.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # Not backed by a real file; fall back to a copy
+        yield spooled.read()
+        return
+    try:
+        yield mapped
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # A view is still alive somewhere; the mapping is released when it is collected
+            logger.debug("Upload mmap still referenced; leaving it to be released on collection.")
+
+def base64_data_url(contents: Buffer, content_type: str, chunk_bytes: int = BASE64_CHUNK_BYTES) -> str:
+    """
+    `data:<content_type>;base64,<...>`, encoding `chunk_bytes` of input at a time into one preallocated
+    bytearray instead of concatenating per-chunk strings. Returning a str costs one more copy of the
+    encoded size (the final decode), so peak memory is about twice the encoded length.
+    """
+    prefix = f"data:{content_type};base64,".encode("ascii")
+    source = memoryview(contents)
+    try:
+        encoded = bytearray(len(prefix) + 4 * ((len(source) + 2) // 3))
+        encoded[:len(prefix)] = prefix
+        position = len(prefix)
+        for start in range(0, len(source), chunk_bytes):
+            chunk = binascii.b2a_base64(source[start:start + chunk_bytes], newline=False)
+            encoded[position:position + len(chunk)] = chunk
+            position += len(chunk)
+    finally:
+        source.release()
+    return encoded.decode("ascii")
@@ -1,32 +1,120 @@
 import os
-import base64
+import sys
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+import httpx
+from openai import AsyncOpenAI, APITimeoutError
+from fastapi import FastAPI, File, Form, Header, UploadFile, HTTPException, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import re
 import mimetypes
-import json 
-from datetime import datetime 
+import json
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.append(project_root)
 dotenv_path = os.path.join(project_root, '.env')
 load_dotenv(dotenv_path=dotenv_path)
 
+from backend_shared.logging_setup import setup_logging, log_payload
+from backend_shared.admission import AdmissionController, AdmissionRejected, admission_rejected_handler, EXTRACTION
+from backend_shared.job_queue import (JobQueue, JobQueueFull, InvalidCallbackURL, IdempotencyKeyConflict, job_queue_full_handler,
+                                      invalid_callback_url_handler, idempotency_key_conflict_handler)
+from backend_shared.uploads import UploadSizeLimitMiddleware, base64_data_url, configure_upload_spooling, upload_buffer
+from backend_shared.parsing import clean_text, extract_json_object, normalize_date, parse_amount
+from backend_shared.deadline import (Deadline, DeadlineExceeded, DeadlinePolicy, DEADLINE_MIN_LLM_CALL_SECONDS, cut_stage,
+                                     deadline_expired, deadline_scope, remaining_time, stage_slot, time_allows, within_deadline)
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from pdf_text import (PDF_TEXT_LAYER_ENABLED, TEXT_SOURCE, PageLimitExceeded, PdfPage, extract_pdf_text, is_pdf,
+                      split_pdf_pages, text_bearing)
+from page_records import RecordDeduplicator
+
+# Queue-based logging: request handlers only enqueue records, a listener thread writes them out
+setup_logging('income_document_processing', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'))
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 API_KEY = os.getenv("DASHSCOPE_API_KEY")
-BASE_URL = "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"
+# Overridable so the backend can be pointed at another OpenAI-compatible server (e.g. the local load-test stub)
+BASE_URL = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope-intl.aliyuncs.com/compatible-mode/v1")
 MODEL_NAME_VL = "qwen-vl-plus"  # For image and initial text extraction
 MODEL_NAME_TEXT = "qwen-turbo" # For structured data extraction from text (can also be qwen-vl-plus)
+# Longest a single DashScope call may take; within a request, the time left on its deadline when shorter
+LLM_CALL_TIMEOUT_SECONDS = float(os.getenv("LLM_CALL_TIMEOUT_SECONDS", "85"))
+# Connection pool of the shared DashScope client; each document makes two sequential calls, so
+# max connections roughly bounds the documents in flight against DashScope at once
+DASHSCOPE_MAX_CONNECTIONS = int(os.getenv("DASHSCOPE_MAX_CONNECTIONS", "32"))
+DASHSCOPE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("DASHSCOPE_MAX_KEEPALIVE_CONNECTIONS", "16"))
+DASHSCOPE_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("DASHSCOPE_KEEPALIVE_EXPIRY_SECONDS", "60"))
+DASHSCOPE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("DASHSCOPE_CONNECT_TIMEOUT_SECONDS", "10"))
+# HTTP/2 multiplexes concurrent calls over one connection; used when the h2 package is installed
+DASHSCOPE_HTTP2_ENABLED = os.getenv("DASHSCOPE_HTTP2_ENABLED", "true").lower() == "true"
+# Pages of one document extracted at once by /process-income-statement, and the most pages it accepts
+INCOME_PAGE_CONCURRENCY = int(os.getenv("INCOME_PAGE_CONCURRENCY", "4"))
+INCOME_MAX_PAGES = int(os.getenv("INCOME_MAX_PAGES", "100"))
+# Jobs have no client waiting on them, so they get a longer budget than interactive requests
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "300"))
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3"))
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def create_dashscope_client() -> AsyncOpenAI:
+    """One AsyncOpenAI client for the process, so uploads share warm (keep-alive, TLS-resumed) connections."""
+    http2 = DASHSCOPE_HTTP2_ENABLED and http2_available()
+    http_client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(max_connections=DASHSCOPE_MAX_CONNECTIONS,
+                            max_keepalive_connections=DASHSCOPE_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=DASHSCOPE_KEEPALIVE_EXPIRY_SECONDS),
+        timeout=httpx.Timeout(LLM_CALL_TIMEOUT_SECONDS, connect=DASHSCOPE_CONNECT_TIMEOUT_SECONDS),
+    )
+    logger.info(f"DashScope client created for {BASE_URL} (HTTP/2 {'on' if http2 else 'off'}, "
+                f"up to {DASHSCOPE_MAX_CONNECTIONS} connections).")
+    return AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL, http_client=http_client)
+
+dashscope_client: Optional[AsyncOpenAI] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global dashscope_client
+    if API_KEY:
+        dashscope_client = create_dashscope_client()
+    await income_jobs.start()
+    yield
+    await income_jobs.close()
+    if dashscope_client is not None:
+        await dashscope_client.close()
+        dashscope_client = None
+        logger.info("DashScope client closed.")
 
 app = FastAPI(
     title="Income Document Processing API",
     description="Processes income documents (invoices, payslips, etc.) using Alibaba Cloud OCR and LLM structuring.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+app.add_exception_handler(JobQueueFull, job_queue_full_handler)
+app.add_exception_handler(InvalidCallbackURL, invalid_callback_url_handler)
+app.add_exception_handler(IdempotencyKeyConflict, idempotency_key_conflict_handler)
+# Bounds concurrent extraction work; excess uploads queue briefly, then get 429/503 with Retry-After
+admission_controller = AdmissionController("income_document_processing")
+# Per-request time budget (X-Request-Timeout header or the default) shared by both DashScope calls
+request_deadlines = DeadlinePolicy("income_document_processing")
+# Oversized bodies get 413 before they are parsed; larger file parts are spooled to disk, not held in memory
+app.add_middleware(UploadSizeLimitMiddleware, service_name="income_document_processing")
+configure_upload_spooling()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -37,82 +125,75 @@ app.add_middleware(
 
 SUPPORTED_IMAGE_MIMETYPES = ["image/jpeg", "image/png", "image/webp", "image/bmp", "application/pdf"] # Added PDF
 
+# Structured fields when the model's reply is unusable, or when structuring was cut by the deadline
+DEFAULT_INCOME_FIELDS = {
+    "date": "", "source": "", "amount": 0.0,
+    "type": "Other Income", "description": "", "document_reference": ""
+}
+
 def parse_llm_json_output(llm_json_text: str):
     """
     Parses the JSON output from the second LLM call for income documents.
-    Handles potential markdown code block ```json ... ```
-    Ensures date is in YYYY-MM-DD format.
+    Tolerates markdown code fences and text around the object; dates come back as YYYY-MM-DD.
     """
-    raw_data = {}
-    try:
-        # Remove markdown code block fences if present
-        if llm_json_text.strip().startswith("```json"):
-            llm_json_text = llm_json_text.strip()[7:]
-            if llm_json_text.strip().endswith("```"):
-                llm_json_text = llm_json_text.strip()[:-3]
+    default_response = dict(DEFAULT_INCOME_FIELDS)
+    raw_data = extract_json_object(llm_json_text)
+    if raw_data is None:
+        logger.error("No JSON object found in the LLM output.")
+        log_payload(logger, "Problematic JSON string", llm_json_text, level=logging.ERROR)
+        return default_response
+    return normalize_income_record(raw_data)
 
-        raw_data = json.loads(llm_json_text)
-        
-        # Date formatting
-        date_str = str(raw_data.get("date", ""))
-        formatted_date = ""
-        if date_str:
-            try:
-                # Attempt to parse common date formats
-                common_formats = ["%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d", 
-                                  "%m-%d-%Y", "%d-%m-%Y", "%Y-%d-%m", # Added YYYY-DD-MM
-                                  "%b %d, %Y", "%d %b %Y",
-                                  "%B %d, %Y", "%d %B %Y",
-                                  "%Y%m%d"] # Added YYYYMMDD
-                parsed = False
-                for fmt in common_formats:
-                    try:
-                        dt_obj = datetime.strptime(date_str, fmt)
-                        formatted_date = dt_obj.strftime("%Y-%m-%d")
-                        parsed = True
-                        break
-                    except ValueError:
-                        continue
-                if not parsed and re.match(r"^\\d{4}-\\d{2}-\\d{2}$", date_str): # Already YYYY-MM-DD
-                    formatted_date = date_str
-                elif not parsed:
-                    # Try to infer if it's a less common but valid date string the LLM might produce
-                    # This part can be expanded with more complex date inference if needed
-                    print(f"Warning: Date '{date_str}' from LLM could not be parsed with common formats. Leaving as is or empty.")
-                    formatted_date = date_str # Or set to "" if strict YYYY-MM-DD is required
-
-            except Exception as date_e:
-                print(f"Error parsing date string '{date_str}': {date_e}")
-                formatted_date = date_str # Fallback to original string if complex parsing fails
+def normalize_income_record(raw_data: dict) -> dict:
+    """One income record from the model, with the amount parsed and the date as YYYY-MM-DD."""
+    amount = parse_amount(raw_data.get("amount"))
+    if amount is None and raw_data.get("amount") is not None:
+        logger.warning(f"Could not parse amount {raw_data.get('amount')!r}. Using 0.0.")
+    return {
+        "date": normalize_date(raw_data.get("date")),
+        "source": clean_text(raw_data.get("source")), # e.g., Client Name, Employer
+        "amount": amount if amount is not None else DEFAULT_INCOME_FIELDS["amount"],
+        "type": clean_text(raw_data.get("type"), DEFAULT_INCOME_FIELDS["type"]), # e.g., Salary, Freelance, Sales
+        "description": clean_text(raw_data.get("description")), # Optional
+        "document_reference": clean_text(raw_data.get("document_reference")) # Optional, e.g., Invoice ID
+    }
 
-        return {
-            "date": formatted_date,
-            "source": str(raw_data.get("source", "")), # e.g., Client Name, Employer
-            "amount": float(raw_data.get("amount", 0.0)),
-            "type": str(raw_data.get("type", "Other Income")), # e.g., Salary, Freelance, Sales
-            "description": str(raw_data.get("description", "")), # Optional
-            "document_reference": str(raw_data.get("document_reference", "")) # Optional, e.g., Invoice ID
-        }
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from LLM: {e}")
-        print(f"Problematic JSON string: {llm_json_text}")
-        return {
-            "date": "", "source": "", "amount": 0.0,
-            "type": "Other Income", "description": "", "document_reference": ""
-        }
-    except Exception as e:
-        print(f"Unexpected error parsing LLM JSON output: {e}. Raw data: {raw_data}")
-        return {
-            "date": "", "source": "", "amount": 0.0,
-            "type": "Other Income", "description": "", "document_reference": ""
-        }
+def parse_page_records_output(llm_json_text: str) -> List[dict]:
+    """
+    Parses {"records": [...]} from the per-page structuring call. A single record object is
+    accepted as well; records with neither an amount nor a payer are dropped.
+    """
+    raw_data = extract_json_object(llm_json_text)
+    if raw_data is None:
+        logger.error("No JSON object found in the LLM output for a page.")
+        log_payload(logger, "Problematic JSON string", llm_json_text, level=logging.ERROR)
+        return []
+    raw_records = raw_data.get("records")
+    if not isinstance(raw_records, list):
+        raw_records = [raw_data] if "amount" in raw_data else []
+    records = [normalize_income_record(raw) for raw in raw_records if isinstance(raw, dict)]
+    return [record for record in records if record["amount"] or record["source"]]
 
-@app.post("/process-income-document")
-async def process_income_document(file: UploadFile = File(...)):
+def ensure_api_key():
     if not API_KEY:
-        print("API key not configured. Please set DASHSCOPE_API_KEY env var.")
+        logger.error("API key not configured. Please set DASHSCOPE_API_KEY env var.")
         raise HTTPException(status_code=500, detail="API key not configured.")
 
+async def chat_completion(model: str, messages: list, stage: str):
+    """
+    A chat completion on the shared client. The SDK retries transient errors; each attempt is
+    capped at the time left, and the call as a whole, retries included, ends at the request deadline.
+    """
+    try:
+        return await within_deadline(
+            dashscope_client.chat.completions.create(model=model, messages=messages, timeout=remaining_time(LLM_CALL_TIMEOUT_SECONDS)),
+            stage)
+    except APITimeoutError:
+        if deadline_expired():
+            raise DeadlineExceeded(f"Request deadline reached during {stage}.") from None
+        raise
+
+def resolve_content_type(file: UploadFile) -> str:
     file_content_type = file.content_type
     # Basic validation for PDFs and images
     if not (file_content_type in SUPPORTED_IMAGE_MIMETYPES or (file.filename and file.filename.lower().endswith('.pdf'))):
@@ -123,42 +204,72 @@ async def process_income_document(file: UploadFile = File(...)):
                 detail=f"Unsupported file type: {file_content_type or guessed_type or 'unknown'}. Please upload a JPG, PNG, WEBP, BMP image, or a PDF document."
             )
         file_content_type = guessed_type # Trust guessed type if it's supported and original was not
+    return file_content_type
+
+async def vision_extract_text(image_data_urls: List[str]) -> str:
+    """
+    Vision LLM "OCR" of the document, given as one data URL (image or PDF) or the images of its
+    scanned pages. The encoded images live only in this frame, so they are freed before the second call.
+    """
+    if not image_data_urls:
+        raise ValueError("vision_extract_text() needs at least one image or document.")
+    vision_user_prompt_text = "Extract all relevant text from this income document (e.g., invoice, payslip, bank statement, payment confirmation, sales receipt). Focus on details like names, dates, amounts, services or goods provided, payment terms, and any reference numbers."
+
+    vision_messages = [
+        {
+            "role": "system",
+            "content": "You are an OCR assistant specialized in extracting text from various financial documents. Organize the extracted information clearly."
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": vision_user_prompt_text},
+                *({"type": "image_url", "image_url": {"url": url}} for url in image_data_urls)
+            ]
+        }
+    ]
 
+    if not time_allows(DEADLINE_MIN_LLM_CALL_SECONDS):
+        raise DeadlineExceeded("Request deadline reached before text extraction.")
+    completion_vision = await chat_completion(MODEL_NAME_VL, vision_messages, "text extraction")
+
+    if not (completion_vision.choices and completion_vision.choices[0].message and completion_vision.choices[0].message.content):
+        raise HTTPException(status_code=500, detail="Vision model returned an empty or invalid response for income document.")
+    return completion_vision.choices[0].message.content
+
+async def process_income_upload(filename: str, file_content_type: str, contents) -> dict:
+    """
+    Text extraction followed by structured extraction; `contents` may be any buffer. Raises HTTPException on failure.
+    PDFs with a text layer are read locally and skip the Vision LLM; only scanned pages are sent to it.
+    Each call's timeout is the time left on the request deadline. Without time for the structuring
+    call, the extracted text is returned with empty fields ("structuring" is cut); running out before
+    the vision call finishes raises DeadlineExceeded.
+    """
     try:
-        contents = await file.read()
-        image_b64 = base64.b64encode(contents).decode('utf-8')
-        
-        client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-        
-        # --- Step 1: Extract text from document image/pdf using Vision LLM ---
-        print(f"Step 1: Sending request to Vision LLM ('{MODEL_NAME_VL}') for initial text extraction from income document...")
-        
-        vision_user_prompt_text = "Extract all relevant text from this income document (e.g., invoice, payslip, bank statement, payment confirmation, sales receipt). Focus on details like names, dates, amounts, services or goods provided, payment terms, and any reference numbers."
-        
-        vision_messages = [
-            {
-                "role": "system",
-                "content": "You are an OCR assistant specialized in extracting text from various financial documents. Organize the extracted information clearly."
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": vision_user_prompt_text},
-                    {"type": "image_url", "image_url": {"url": f"data:{file_content_type};base64,{image_b64}"}}
-                ]
-            }
-        ]
-        
-        completion_vision = client.chat.completions.create(model=MODEL_NAME_VL, messages=vision_messages, timeout=85.0) 
-        
-        if not (completion_vision.choices and completion_vision.choices[0].message and completion_vision.choices[0].message.content):
-            raise HTTPException(status_code=500, detail="Vision model returned an empty or invalid response for income document.")
-        
-        extracted_text_from_vision = completion_vision.choices[0].message.content
-        print(f"\\n--- LLM Vision Extracted Text (Income Document) --- \\n{extracted_text_from_vision}\\n---------------------------------")
+        pdf_text = None
+        if PDF_TEXT_LAYER_ENABLED and is_pdf(file_content_type, filename):
+            pdf_text = await asyncio.to_thread(extract_pdf_text, contents)
+
+        # --- Step 1: The document's text, from the PDF text layer where it has one, otherwise from the Vision LLM ---
+        if pdf_text is not None and not pdf_text.needs_vision and text_bearing(pdf_text.text):
+            logger.info(f"Step 1: Using the text layer of all {len(pdf_text.page_texts)} PDF page(s); skipping the Vision LLM.")
+            TEXT_SOURCE.labels(source="text_layer").inc()
+            extracted_text = pdf_text.text
+        elif pdf_text is not None and pdf_text.needs_vision and pdf_text.images_complete and pdf_text.page_images:
+            text_pages = sum(1 for text in pdf_text.page_texts if text)
+            logger.info(f"Step 1: {text_pages} PDF page(s) have a text layer; sending the images of "
+                        f"{len(pdf_text.image_pages)} scanned or mixed page(s) to the Vision LLM ('{MODEL_NAME_VL}')...")
+            TEXT_SOURCE.labels(source="mixed" if text_pages else "page_images").inc()
+            scanned_text = await vision_extract_text([base64_data_url(data, mimetype) for data, mimetype in pdf_text.page_images])
+            extracted_text = "\n\n".join(text for text in (pdf_text.text, scanned_text) if text)
+        else:
+            logger.info(f"Step 1: Sending request to Vision LLM ('{MODEL_NAME_VL}') for initial text extraction from income document...")
+            TEXT_SOURCE.labels(source="vision").inc()
+            extracted_text = await vision_extract_text([base64_data_url(contents, file_content_type)])
+        log_payload(logger, "Extracted Text (Income Document)", extracted_text)
 
         # --- Step 2: Extract structured data from the text using another LLM call ---
-        print(f"Step 2: Sending request to Text LLM ('{MODEL_NAME_TEXT}') for structured income data extraction...")
+        logger.info(f"Step 2: Sending request to Text LLM ('{MODEL_NAME_TEXT}') for structured income data extraction...")
         
         text_prompt = f"""
 Based on the following text extracted from an income document, please extract the specified information and provide it strictly in JSON format.
@@ -172,7 +283,7 @@ The JSON object should have these exact keys:
 
 Extracted text:
 ---
-{extracted_text_from_vision}
+{extracted_text}
 ---
 
 JSON Output (ensure valid JSON, do not add any text before or after the JSON object itself):
@@ -183,31 +294,236 @@ JSON Output (ensure valid JSON, do not add any text before or after the JSON obj
             {"role": "user", "content": text_prompt}
         ]
         
-        completion_text = client.chat.completions.create(model=MODEL_NAME_TEXT, messages=text_messages, timeout=85.0)
+        completion_text = None
+        if not time_allows(DEADLINE_MIN_LLM_CALL_SECONDS):
+            cut_stage("structuring", "not enough time left for the structuring call")
+        else:
+            try:
+                completion_text = await chat_completion(MODEL_NAME_TEXT, text_messages, "the structuring call")
+            except DeadlineExceeded as e:
+                cut_stage("structuring", str(e))
 
-        if not (completion_text.choices and completion_text.choices[0].message and completion_text.choices[0].message.content):
-            raise HTTPException(status_code=500, detail="Text structuring model returned an empty or invalid response for income data.")
+        if completion_text is None:
+            # OCR-only result: the extracted text is still returned for the client to structure or retry
+            final_extracted_data = dict(DEFAULT_INCOME_FIELDS)
+        else:
+            if not (completion_text.choices and completion_text.choices[0].message and completion_text.choices[0].message.content):
+                raise HTTPException(status_code=500, detail="Text structuring model returned an empty or invalid response for income data.")
 
-        structured_data_json_text = completion_text.choices[0].message.content
-        print(f"\n--- LLM Text Structured JSON Output (Income) --- \n{structured_data_json_text}\n---------------------------------------")
-        
-        final_extracted_data = parse_llm_json_output(structured_data_json_text)
-        print(f"--- Parsed Structured Income Data --- \n{final_extracted_data}\n-----------------------------------------")
+            structured_data_json_text = completion_text.choices[0].message.content
+            log_payload(logger, "LLM Text Structured JSON Output (Income)", structured_data_json_text)
+
+            final_extracted_data = parse_llm_json_output(structured_data_json_text)
+            log_payload(logger, "Parsed Structured Income Data", final_extracted_data)
             
-        response_data = {
-            "filename": file.filename,
-            "ocr_text": extracted_text_from_vision,
+        return {
+            "filename": filename,
+            "ocr_text": extracted_text,
             **final_extracted_data
         }
-        return JSONResponse(content=response_data)
             
+    except (HTTPException, DeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"Error processing income document: {e}")
+        logger.error(f"Error processing income document: {e}", exc_info=True)
         error_message = str(e)
         if "401" in error_message: 
             raise HTTPException(status_code=401, detail="Authentication failed. Please verify your API key for DashScope.")
         raise HTTPException(status_code=500, detail=f"Error processing income document: {str(e)}")
 
+async def process_income_within(deadline: Deadline, filename: str, file_content_type: str, contents) -> Tuple[int, dict]:
+    """process_income_upload under `deadline`; the payload gets a "deadline" entry listing the stages cut to meet it."""
+    with deadline_scope(deadline):
+        try:
+            status_code, payload = 200, await process_income_upload(filename, file_content_type, contents)
+        except DeadlineExceeded as e:
+            status_code, payload = 504, request_deadlines.exceeded(deadline, filename, e)
+    return status_code, {**payload, "deadline": deadline.summary()}
+
+# The deadline dependency is listed before admission so time spent queued counts against the budget
+@app.post("/process-income-document", dependencies=[Depends(request_deadlines.dependency), Depends(admission_controller.dependency(EXTRACTION))])
+async def process_income_document(file: UploadFile = File(...), deadline: Deadline = Depends(request_deadlines.dependency)):
+    ensure_api_key()
+    file_content_type = resolve_content_type(file)
+    with upload_buffer(file) as contents:
+        status_code, response_data = await process_income_within(deadline, file.filename, file_content_type, contents)
+    return JSONResponse(status_code=status_code, content=response_data)
+
+async def structure_page_records(page_text: str, page_number: int, page_count: int) -> List[dict]:
+    """Structuring call for one page of a multi-page document; returns every income record on the page."""
+    text_prompt = f"""
+The following text was extracted from page {page_number} of {page_count} of an income document (e.g., a bank statement, a bundle of payslips, invoices or payment confirmations).
+List every income record on this page and provide them strictly in JSON format as {{"records": [...]}}, where each record has these exact keys:
+- "date" (string, format YYYY-MM-DD ONLY. The transaction date, invoice date, payment received date, or payslip period end date.)
+- "source" (string, the name of the client, employer, platform, or payer who provided the income.)
+- "amount" (float, the income amount received or invoiced; the net amount for a payslip.)
+- "type" (string, categorize the income. Examples: "Salary", "Freelance Project", "Sales Revenue", "Consulting Fee", "Dividend", "Rental Income", "Interest Income", "Royalty", "Commission", "Government Benefit", "Other Income")
+- "description" (string, a brief description of the income or the transaction narrative. Use empty string if not clear.)
+- "document_reference" (string, any reference number like Invoice ID, Payslip ID or Transaction ID. Use empty string if not found.)
+
+For a bank statement, list only credits (money received); ignore debits, fees, balances, and brought-forward or carried-forward lines.
+If the page has no income records (e.g., terms and conditions, a cover page), return {{"records": []}}.
+
+Extracted text:
+---
+{page_text}
+---
+
+JSON Output (ensure valid JSON, do not add any text before or after the JSON object itself):
+"""
+    text_messages = [
+        {"role": "system", "content": "You are an expert data extraction assistant. Your task is to extract specific fields from the provided text and return them ONLY as a valid JSON object according to the user's specified schema."},
+        {"role": "user", "content": text_prompt}
+    ]
+    completion_text = await chat_completion(MODEL_NAME_TEXT, text_messages, f"structuring page {page_number}")
+    if not (completion_text.choices and completion_text.choices[0].message and completion_text.choices[0].message.content):
+        raise HTTPException(status_code=500, detail=f"Text structuring model returned an empty or invalid response for page {page_number}.")
+    log_payload(logger, f"LLM Text Structured JSON Output (Income, page {page_number})", completion_text.choices[0].message.content)
+    return parse_page_records_output(completion_text.choices[0].message.content)
+
+async def process_income_page(page: PdfPage, page_count: int) -> Tuple[int, dict]:
+    """
+    Text (from the text layer or the Vision LLM) and income records for one page.
+    Returns (status_code, {"records": [...]} or {"detail": ...}); with no time left for the
+    structuring call, the page's text is returned as "ocr_text" with status 504.
+    """
+    page_text = ""
+    try:
+        if page.needs_vision:
+            # A page needing vision always has its images or, failing those, the page as a PDF
+            urls = [base64_data_url(data, mimetype) for data, mimetype in page.images] or [base64_data_url(page.pdf, "application/pdf")]
+            logger.info(f"Page {page.number}/{page_count}: sending {len(urls)} image(s) to the Vision LLM.")
+            # A mixed page keeps its text layer (e.g. a header) next to what the vision model reads from its images
+            page_text = "\n\n".join(text for text in (page.text, await vision_extract_text(urls)) if text)
+        else:
+            page_text = page.text
+        if not page_text.strip():
+            return 200, {"records": []}
+        if not time_allows(DEADLINE_MIN_LLM_CALL_SECONDS):
+            raise DeadlineExceeded(f"Request deadline reached before structuring page {page.number}.")
+        return 200, {"records": await structure_page_records(page_text, page.number, page_count)}
+    except DeadlineExceeded as e:
+        cut_stage("structuring" if page_text else "text_extraction", str(e))
+        return 504, {"detail": str(e), "ocr_text": page_text}
+    except HTTPException as http_exc:
+        return http_exc.status_code, {"detail": http_exc.detail}
+    except Exception as e:
+        logger.error(f"Error processing page {page.number}: {e}", exc_info=True)
+        return 500, {"detail": f"Error processing page {page.number}: {str(e)}"}
+
+def split_income_document(filename: str, file_content_type: str, contents) -> List[PdfPage]:
+    """The pages of an upload: a PDF's pages, or an image as a single page. Raises HTTPException(413) over the page limit."""
+    if not is_pdf(file_content_type, filename):
+        return [PdfPage(number=1, images=[(bytes(contents), file_content_type)])]
+    try:
+        pages = split_pdf_pages(contents, INCOME_MAX_PAGES)
+    except PageLimitExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if pages is None:
+        # Unreadable or password protected: the vision model gets the whole document, as one page
+        return [PdfPage(number=1, pdf=bytes(contents))]
+    return pages
+
+@app.post("/process-income-statement", dependencies=[Depends(request_deadlines.dependency), Depends(admission_controller.dependency(EXTRACTION))])
+async def process_income_statement(file: UploadFile = File(...), deadline: Deadline = Depends(request_deadlines.dependency)):
+    """
+    Multi-page variant of /process-income-document for bank statements and payslip bundles.
+    Pages are extracted concurrently (INCOME_PAGE_CONCURRENCY at a time) and every income record
+    is streamed as an NDJSON line as soon as its page finishes, leaving out records already
+    returned for another page:
+        {"page": 3, "status_code": 200, "date": ..., "source": ..., "amount": ..., ...}
+    A page that fails gets {"page": ..., "status_code": ..., "detail": ...} instead, and the last
+    line summarises the document:
+        {"done": true, "pages": ..., "records": ..., "duplicates_dropped": ..., "failed_pages": [...], "deadline": {...}}
+    Each page gets the request's budget (X-Request-Timeout or the default) to itself, starting
+    when it gets one of the INCOME_PAGE_CONCURRENCY slots, so a long statement takes about
+    pages / INCOME_PAGE_CONCURRENCY times its slowest page and may run past the budget as a whole.
+    The summary's "deadline" lists every stage cut on any page.
+    """
+    ensure_api_key()
+    file_content_type = resolve_content_type(file)
+    with upload_buffer(file) as contents:
+        pages = await asyncio.to_thread(split_income_document, file.filename, file_content_type, contents)
+    text_pages = sum(1 for page in pages if not page.needs_vision)
+    logger.info(f"Processing '{file.filename}' page by page: {len(pages)} page(s), {text_pages} with a text layer.")
+    page_slots = asyncio.Semaphore(INCOME_PAGE_CONCURRENCY)
+
+    async def process_page(page: PdfPage) -> Tuple[PdfPage, int, dict]:
+        with deadline_scope(deadline.branch()):
+            async with stage_slot(page_slots, f"page {page.number}"):
+                status_code, payload = await process_income_page(page, len(pages))
+        return page, status_code, payload
+
+    async def ndjson_rows():
+        tasks = [asyncio.create_task(process_page(page)) for page in pages]
+        deduplicator = RecordDeduplicator()
+        records, failed_pages = 0, []
+        try:
+            for next_finished in asyncio.as_completed(tasks):
+                page, status_code, payload = await next_finished
+                if status_code != 200:
+                    failed_pages.append(page.number)
+                    yield json.dumps({"page": page.number, "status_code": status_code, **payload}) + "\n"
+                    continue
+                for record in deduplicator.new_records(payload["records"]):
+                    records += 1
+                    yield json.dumps({"page": page.number, "status_code": 200, **record}) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        logger.info(f"'{file.filename}': {records} income record(s) from {len(pages)} page(s); "
+                    f"{deduplicator.duplicates} duplicate(s) dropped, {len(failed_pages)} page(s) failed.")
+        yield json.dumps({"done": True, "pages": len(pages), "records": records, "duplicates_dropped": deduplicator.duplicates,
+                          "failed_pages": sorted(failed_pages), "deadline": deadline.summary()}) + "\n"
+
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
+
+async def run_income_job(contents: bytes, metadata: dict) -> Tuple[int, dict]:
+    try:
+        return await process_income_within(request_deadlines.new(JOB_DEADLINE_SECONDS), metadata["filename"],
+                                           metadata["content_type"], contents)
+    except HTTPException as http_exc:
+        return http_exc.status_code, {"filename": metadata["filename"], "detail": http_exc.detail}
+
+# Submit/poll mode: uploads are stored durably and processed by background workers, so the
+# result survives a dropped client connection
+income_jobs = JobQueue("income_document_processing", JOB_DB_PATH, run_income_job)
+
+@app.post("/jobs/process-income-document", status_code=202)
+async def submit_income_job(response: Response, file: UploadFile = File(...), callback_url: Optional[str] = Form(None),
+                            idempotency_key: Optional[str] = Header(None), x_user_id: Optional[str] = Header(None)):
+    """
+    Queues an income document for processing and returns immediately with a job id. Poll
+    GET /jobs/{job_id} for the result, or pass callback_url to have the finished job POSTed there.
+    Resubmitting with the same Idempotency-Key header returns the original job (200); reusing the
+    key for a different file is refused (409). The job belongs to the X-User-Id it was submitted
+    with: keys are per user, and only that user can read the job.
+    """
+    ensure_api_key()
+    file_content_type = resolve_content_type(file)
+    with upload_buffer(file) as contents:
+        job, created = await income_jobs.submit(contents, {"filename": file.filename, "content_type": file_content_type},
+                                                idempotency_key, callback_url, owner=x_user_id or "")
+    if not created:
+        response.status_code = 200
+    return {**job.to_dict(), "status_url": f"/jobs/{job.job_id}"}
+
+@app.get("/jobs/{job_id}")
+async def get_income_job(job_id: str, x_user_id: Optional[str] = Header(None)):
+    """
+    Job status; once finished, status_code and result hold what /process-income-document would have returned.
+    Jobs of another X-User-Id are reported as not found.
+    """
+    job = await income_jobs.get(job_id, owner=x_user_id or "")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found. Finished jobs are kept for a limited time.")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics():
+    """Admission queue wait times and queue lengths in Prometheus text format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/")
 async def root():
     return {
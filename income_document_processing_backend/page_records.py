@@ -0,0 +1,44 @@
+"""
+Merging the income records extracted page by page from one document.
+
+Statements and payslip bundles repeat rows across pages (carried-forward lines, a summary page
+restating the credits, the same payslip scanned twice), so a record already emitted for another
+page is dropped. Repeats within one page are kept: two identical transfers on the same day are
+two payments.
+"""
+import re
+from collections import Counter
+from typing import List, Tuple
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+def _normalized(text: str) -> str:
+    return _NON_ALNUM.sub("", (text or "").lower())
+
+def record_key(record: dict) -> Tuple:
+    """Date and amount, plus the reference when there is one, otherwise the payer and description."""
+    reference = _normalized(record.get("document_reference"))
+    identity = (reference,) if reference else (_normalized(record.get("source")), _normalized(record.get("description")))
+    return (record.get("date", ""), round(float(record.get("amount") or 0.0), 2)) + identity
+
+class RecordDeduplicator:
+    """Tracks, per record key, the most copies any one page has had; later pages only add copies beyond that."""
+
+    def __init__(self):
+        self._emitted = Counter()
+        self.duplicates = 0
+
+    def new_records(self, records: List[dict]) -> List[dict]:
+        """The records of one page that were not already emitted for another page, in page order."""
+        on_page = Counter()
+        fresh = []
+        for record in records:
+            key = record_key(record)
+            on_page[key] += 1
+            if on_page[key] > self._emitted[key]:
+                fresh.append(record)
+            else:
+                self.duplicates += 1
+        for key, count in on_page.items():
+            self._emitted[key] = max(self._emitted[key], count)
+        return fresh
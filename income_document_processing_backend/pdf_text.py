@@ -0,0 +1,200 @@
+"""
+Text-layer extraction for born-digital income PDFs.
+
+Most invoices and payslips are generated as PDFs with an embedded text layer, which PyPDF2 reads
+locally in milliseconds; only scanned or image-only pages need the vision model. extract_pdf_text()
+sorts the pages into those two kinds and pulls the embedded images out of the image-only pages,
+so the vision call (when one is still needed) sees just those pages instead of the whole document.
+A scanned page with a text layer over part of it (a stamped header, an OCR'd title) is mixed: its
+text is kept and its large images go to the vision model as well.
+split_pdf_pages() gives the same per-page view for processing a long document page by page.
+"""
+import io
+import logging
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import PyPDF2
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+PDF_TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER_ENABLED", "true").lower() == "true"
+# A page counts as text-bearing with at least this many letters and digits in its text layer...
+PDF_TEXT_MIN_CHARS_PER_PAGE = int(os.getenv("PDF_TEXT_MIN_CHARS_PER_PAGE", "40"))
+# ...and at most this fraction of unreadable characters (fonts without a Unicode map extract as garbage)
+PDF_TEXT_MAX_UNREADABLE_FRACTION = float(os.getenv("PDF_TEXT_MAX_UNREADABLE_FRACTION", "0.1"))
+# Embedded images of at least this many pixels on a text-bearing page are sent to the vision model
+# too (a scanned body under a text header); smaller ones are logos and signatures
+PDF_MIXED_MIN_IMAGE_PIXELS = int(os.getenv("PDF_MIXED_MIN_IMAGE_PIXELS", "250000"))
+
+# Image formats the vision model accepts as data URLs
+VISION_IMAGE_MIMETYPES = {"image/jpeg", "image/png", "image/webp", "image/bmp"}
+# Content stream operators that put marks on the page (text, images, shadings, painted paths)
+_PAINTING_OPERATORS = {b"Tj", b"TJ", b"'", b'"', b"Do", b"BI", b"sh", b"S", b"s", b"f", b"F", b"f*", b"B", b"B*", b"b", b"b*"}
+
+TEXT_SOURCE = Counter("income_text_source", "Where the text of uploaded income documents came from.", ["source"])
+
+class PageLimitExceeded(Exception):
+    """Raised by split_pdf_pages() for documents with more pages than allowed."""
+
+@dataclass
+class PdfText:
+    page_texts: List[str] # Text layer per page; "" for blank pages and image-only pages
+    image_pages: List[int] = field(default_factory=list) # Indices of scanned / image-only / mixed pages; never blank pages
+    page_images: List[Tuple[bytes, str]] = field(default_factory=list) # (data, mimetype) embedded in those pages
+    images_complete: bool = True # False when some of those pages cannot be sent to the vision model as images
+
+    @property
+    def text(self) -> str:
+        return "\n\n".join(text for text in self.page_texts if text)
+
+    @property
+    def needs_vision(self) -> bool:
+        return bool(self.image_pages)
+
+@dataclass
+class PdfPage:
+    number: int # 1-based
+    text: str = "" # Text layer, when the page has a usable one; on a mixed page, alongside `images`
+    images: List[Tuple[bytes, str]] = field(default_factory=list) # (data, mimetype) for the vision model
+    pdf: Optional[bytes] = None # The page as a one-page PDF, when its images cannot be sent on their own
+    blank: bool = False # Nothing drawn on the page: no records and no vision call
+
+    @property
+    def needs_vision(self) -> bool:
+        """When True, the page has `images` or (otherwise) `pdf` to send to the vision model."""
+        return bool(self.images) or self.pdf is not None
+
+def is_pdf(content_type: Optional[str], filename: Optional[str]) -> bool:
+    return content_type == "application/pdf" or bool(filename and filename.lower().endswith(".pdf"))
+
+def garbled(text: str) -> bool:
+    unreadable = sum(1 for char in text if char == "\ufffd" or not (char.isprintable() or char.isspace()))
+    return unreadable > PDF_TEXT_MAX_UNREADABLE_FRACTION * len(text)
+
+def text_bearing(text: str) -> bool:
+    return sum(char.isalnum() for char in text) >= PDF_TEXT_MIN_CHARS_PER_PAGE and not garbled(text)
+
+def _image_pixels(page, name: str) -> int:
+    """Width x height of the image XObject that PyPDF2 extracted as `name` (e.g. "Im0.jpg")."""
+    xobject = page["/Resources"]["/XObject"].get_object().get("/" + os.path.splitext(name)[0])
+    if xobject is None:
+        return 0
+    xobject = xobject.get_object()
+    return int(xobject.get("/Width", 0)) * int(xobject.get("/Height", 0))
+
+def _page_images(page, min_pixels: int = 0) -> Tuple[List[Tuple[bytes, str]], bool]:
+    """The page's embedded images (of at least `min_pixels`) the vision model accepts, and whether all of those images were."""
+    images, complete = [], True
+    try:
+        for image in page.images:
+            if min_pixels and _image_pixels(page, image.name) < min_pixels:
+                continue
+            mimetype, _ = mimetypes.guess_type(image.name)
+            if mimetype in VISION_IMAGE_MIMETYPES:
+                images.append((image.data, mimetype))
+            else:
+                complete = False
+    except Exception as e:
+        logger.warning(f"Could not extract the images of a PDF page: {e}")
+        complete = False
+    return images, complete
+
+def _paints_nothing(page) -> bool:
+    """True for a page whose content stream puts no marks on it."""
+    try:
+        contents = page.get_contents()
+        if contents is None:
+            return True
+        operations = PyPDF2.generic.ContentStream(contents, page.pdf).operations
+        return not any(operator in _PAINTING_OPERATORS for _, operator in operations)
+    except Exception as e:
+        logger.warning(f"Could not read the content stream of a PDF page: {e}")
+        return False
+
+def _read_page(page) -> Tuple[str, List[Tuple[bytes, str]], bool]:
+    """(text, images, complete) for one page: its text when text-bearing (or nearly blank), and the
+    images to send to the vision model, `complete` being False when those do not cover it. A
+    text-bearing page only sends its large images; a blank page is ("", [], True)."""
+    text = (page.extract_text() or "").strip()
+    if text_bearing(text):
+        # The text may be just a header over a scanned body, so large images are read as well
+        images, complete = _page_images(page, PDF_MIXED_MIN_IMAGE_PIXELS)
+        return text, images, complete
+    images, complete = _page_images(page)
+    if not images and complete and not garbled(text) and (text or _paints_nothing(page)):
+        # A (nearly) blank page, e.g. a closing page with only a signature line
+        return text, [], True
+    # Garbled text, marks drawn without a text layer or images (vector art, outlined text), or
+    # images in formats the vision model cannot take: only a rendering of the whole page will do
+    return "", images, complete and bool(images)
+
+def _blank(text: str, images: List[Tuple[bytes, str]], complete: bool) -> bool:
+    return not text and not images and complete
+
+def _open_pdf(contents) -> Optional[PyPDF2.PdfReader]:
+    reader = PyPDF2.PdfReader(io.BytesIO(contents))
+    if reader.is_encrypted and not reader.decrypt(""):
+        logger.info("PDF is password protected; leaving it to the vision model.")
+        return None
+    return reader
+
+def extract_pdf_text(contents) -> Optional[PdfText]:
+    """
+    Reads the text layer of every page of the PDF in `contents` (any buffer). Returns None when the
+    PDF cannot be read (damaged, or encrypted with a password), in which case the caller should
+    send the whole document to the vision model as before.
+    """
+    try:
+        reader = _open_pdf(contents)
+        if reader is None:
+            return None
+        result = PdfText(page_texts=[])
+        for index, page in enumerate(reader.pages):
+            text, images, complete = _read_page(page)
+            result.page_texts.append(text)
+            if complete and not images:
+                # Text only, or blank
+                continue
+            result.image_pages.append(index)
+            result.page_images.extend(images)
+            # One page that needs a full rendering sends the whole document to the vision model
+            result.images_complete = result.images_complete and complete
+        return result
+    except Exception as e:
+        logger.warning(f"Could not read the PDF text layer ({type(e).__name__}: {e}); leaving it to the vision model.")
+        return None
+
+def split_pdf_pages(contents, max_pages: int) -> Optional[List[PdfPage]]:
+    """
+    The pages of the PDF in `contents`, each with its text layer, or what to send the vision model
+    for it: its images, or (when those do not cover it) the page as a one-page PDF. Returns None when
+    the PDF cannot be read; raises PageLimitExceeded when it has more than `max_pages` pages.
+    """
+    try:
+        reader = _open_pdf(contents)
+        if reader is None:
+            return None
+        if len(reader.pages) > max_pages:
+            raise PageLimitExceeded(f"The document has {len(reader.pages)} pages; the limit is {max_pages}.")
+        pages = []
+        for index, page in enumerate(reader.pages):
+            text, images, complete = _read_page(page)
+            result = PdfPage(number=index + 1, text=text, images=images, blank=_blank(text, images, complete))
+            if not complete:
+                # The rendering covers the page's text layer too
+                writer = PyPDF2.PdfWriter()
+                writer.add_page(page)
+                buffer = io.BytesIO()
+                writer.write(buffer)
+                result.text, result.images, result.pdf = "", [], buffer.getvalue()
+            pages.append(result)
+        return pages
+    except PageLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not split the PDF into pages ({type(e).__name__}: {e}).")
+        return None
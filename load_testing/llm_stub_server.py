@@ -0,0 +1,202 @@
+"""
+Local, deterministic stand-in for the hosted models the backends call, so they can be
+benchmarked offline without Hugging Face or DashScope credentials.
+
+Speaks two protocols:
+  - Text Generation Inference, as used by huggingface_hub's (Async)InferenceClient.text_generation
+    (POST / or /generate, optionally streamed as server-sent events). Point the chatbot and
+    receipt backends at it with LLM_ENDPOINT_URL=http://127.0.0.1:8090
+  - OpenAI-compatible chat completions (POST /v1/chat/completions), as used by the income
+    backend. Point it here with DASHSCOPE_BASE_URL=http://127.0.0.1:8090/v1
+
+Replies are canned per prompt type (smart-assistant insight list, receipt category, receipt
+JSON, income OCR/JSON, free-form chat). Latency is sampled from a seeded distribution:
+a time-to-first-token delay followed by a fixed per-token delay.
+
+Usage:
+    python llm_stub_server.py --port 8090 --latency lognormal --ttft-median 0.4 --ttft-sigma 0.6 --token-delay 0.01
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SMART_INSIGHTS = json.dumps([
+    "Your Books & Publications spending may qualify for lifestyle relief of up to RM2,500.",
+    "Keep receipts for medical expenses; they can be claimed under medical relief.",
+    "Consider contributing to SSPN to claim up to RM8,000 in education savings relief.",
+])
+RECEIPT_CATEGORY = "Books & Publications"
+RECEIPT_JSON = json.dumps({
+    "category": RECEIPT_CATEGORY, "merchant": "MPH Bookstores", "amount": 89.9, "date": "2025-03-14",
+    "is_deductible": True, "deduction_type": "personal relief",
+    "deduction_details": "Lifestyle relief under Section 46(1)(p), up to RM2,500 for books and publications.",
+})
+INCOME_OCR_TEXT = (
+    "INVOICE No. INV-2025-0042\nDate: 02/05/2025\nBill To: Acme Corp Sdn Bhd\n"
+    "Web design services - May 2025\nTotal: RM 4,500.00\nPayment terms: 30 days"
+)
+INCOME_JSON = json.dumps({
+    "date": "2025-05-02", "source": "Acme Corp Sdn Bhd", "amount": 4500.0, "type": "Freelance Project",
+    "description": "Web design services - May 2025", "document_reference": "INV-2025-0042",
+})
+CHAT_REPLY = (
+    "Under Malaysian tax rules, lifestyle relief lets individuals claim up to RM2,500 a year for books, "
+    "personal computers, smartphones, tablets, internet subscriptions and sports equipment, provided the "
+    "purchases are for the taxpayer, their spouse or children and are supported by receipts."
+)
+
+def canned_text_generation_reply(prompt: str) -> str:
+    if "JSON list of strings" in prompt:
+        return SMART_INSIGHTS
+    if "primary expense category" in prompt:
+        return RECEIPT_CATEGORY
+    if '"is_deductible"' in prompt:
+        return RECEIPT_JSON
+    return CHAT_REPLY
+
+def canned_chat_completion_reply(messages: list) -> str:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return INCOME_OCR_TEXT
+    if any("JSON" in str(message.get("content", "")) for message in messages):
+        return INCOME_JSON
+    return CHAT_REPLY
+
+def tokenize(text: str) -> list:
+    """Splits into word-ish tokens (leading whitespace kept) so streamed chunks join back exactly."""
+    tokens, current = [], ""
+    for char in text:
+        if char.isspace() and current.strip():
+            tokens.append(current)
+            current = ""
+        current += char
+    if current:
+        tokens.append(current)
+    return tokens
+
+class LatencyModel:
+    def __init__(self, distribution: str, ttft_median: float, ttft_sigma: float, token_delay: float,
+                 error_rate: float, seed: int):
+        self.distribution = distribution
+        self.ttft_median = ttft_median
+        self.ttft_sigma = ttft_sigma
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+
+    def ttft(self) -> float:
+        if self.distribution == "constant":
+            return self.ttft_median
+        if self.distribution == "uniform":
+            return self._rng.uniform(0, 2 * self.ttft_median)
+        return self._rng.lognormvariate(math.log(self.ttft_median), self.ttft_sigma)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self._rng.random() < self.error_rate
+
+def create_app(latency: LatencyModel) -> FastAPI:
+    app = FastAPI(title="LLM stub server")
+    stats = {"text_generation": 0, "chat_completions": 0, "injected_errors": 0}
+
+    def overloaded():
+        stats["injected_errors"] += 1
+        return JSONResponse(status_code=503, content={"error": "Model is overloaded", "error_type": "overloaded"})
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", **stats}
+
+    @app.post("/")
+    @app.post("/generate")
+    @app.post("/generate_stream")
+    @app.post("/models/{model_id:path}")
+    async def text_generation(request: Request, model_id: str = ""):
+        stats["text_generation"] += 1
+        body = await request.json()
+        if latency.should_fail():
+            return overloaded()
+        prompt = body.get("inputs", "")
+        max_new_tokens = (body.get("parameters") or {}).get("max_new_tokens") or 500
+        tokens = tokenize(canned_text_generation_reply(prompt))[:max_new_tokens]
+        await asyncio.sleep(latency.ttft())
+
+        if not (body.get("stream") or request.url.path == "/generate_stream"):
+            await asyncio.sleep(latency.token_delay * len(tokens))
+            return [{"generated_text": "".join(tokens)}]
+
+        async def events():
+            for index, token_text in enumerate(tokens):
+                if index:
+                    await asyncio.sleep(latency.token_delay)
+                last = index == len(tokens) - 1
+                event = {
+                    "index": index,
+                    "token": {"id": index, "text": token_text, "logprob": 0.0, "special": False},
+                    "generated_text": "".join(tokens) if last else None,
+                    "details": {"finish_reason": "eos_token", "generated_tokens": len(tokens)} if last else None,
+                }
+                yield f"data:{json.dumps(event)}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        stats["chat_completions"] += 1
+        body = await request.json()
+        if latency.should_fail():
+            return overloaded()
+        tokens = tokenize(canned_chat_completion_reply(body.get("messages", [])))
+        await asyncio.sleep(latency.ttft())
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "stub")
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency.token_delay * len(tokens))
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+
+        async def events():
+            for index, token_text in enumerate(tokens):
+                if index:
+                    await asyncio.sleep(latency.token_delay)
+                chunk = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token_text},
+                                 "finish_reason": "stop" if index == len(tokens) - 1 else None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Deterministic local stand-in for the TGI and OpenAI-compatible endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", choices=["constant", "uniform", "lognormal"], default="lognormal",
+                        help="Distribution of the time-to-first-token delay.")
+    parser.add_argument("--ttft-median", type=float, default=0.4, help="Median time to first token, in seconds.")
+    parser.add_argument("--ttft-sigma", type=float, default=0.6, help="Log-space sigma for the lognormal distribution.")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Delay between streamed tokens, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503.")
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    latency_model = LatencyModel(args.latency, args.ttft_median, args.ttft_sigma, args.token_delay, args.error_rate, args.seed)
+    uvicorn.run(create_app(latency_model), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,238 @@
+"""
+End-to-end offline load test for the three FastAPI backends.
+
+Starts the LLM stub server and the chatbot, receipt and income backends as subprocesses, with
+the backends pointed at the stub. Then it drives each endpoint with a bounded number of
+concurrent requests and reports throughput and p50/p95/p99 latency per scenario. Results can
+be saved as JSON and compared against an earlier run; exceeding the tolerance fails the run.
+
+Usage:
+    python run_load_tests.py --concurrency 20 --requests 200 --output results.json
+    python run_load_tests.py --baseline results.json --tolerance 0.2
+    python run_load_tests.py --no-start --scenarios chat,smart_assistant   # against already running servers
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from tax_chat_assistant_backend.load_test import DEFAULT_MESSAGES, percentile
+
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_stub_server.py")
+
+SERVICES = {
+    "chatbot": {"app_dir": "tax_chat_assistant_backend", "app": "chatbot_server:app", "port": 8003},
+    "receipt": {"app_dir": "receipt_processing_backend", "app": "main:app", "port": 8002},
+    "income": {"app_dir": "income_document_processing_backend", "app": "main:app", "port": 8004},
+}
+
+SCENARIOS = {
+    "chat": {"service": "chatbot", "path": "/chat"},
+    "smart_assistant": {"service": "chatbot", "path": "/chat"},
+    "receipt": {"service": "receipt", "path": "/process-receipt"},
+    "income": {"service": "income", "path": "/process-income-document"},
+}
+
+EXPENSE_CATEGORIES = ["Books & Publications", "Groceries", "Healthcare & Medical", "Education & Training",
+                      "Utilities (Electricity, Water, Internet)", "Transportation (Fuel, Parking, Public Transport)"]
+
+def synthetic_document_png() -> bytes:
+    """A small receipt-like image, so OCR has real text to extract."""
+    import cv2
+    import numpy as np
+    image = np.full((480, 360, 3), 255, dtype=np.uint8)
+    lines = ["MPH BOOKSTORES", "Mid Valley, KL", "14/03/2025 13:42", "Tax Guide 2025   59.90",
+             "Notebook A5      30.00", "TOTAL         RM 89.90", "Thank you!"]
+    for i, line in enumerate(lines):
+        cv2.putText(image, line, (20, 50 + i * 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+    ok, encoded = cv2.imencode(".png", image)
+    return encoded.tobytes()
+
+def synthetic_expenses(rng: random.Random, count: int) -> list:
+    return [
+        {"category": rng.choice(EXPENSE_CATEGORIES), "amount": round(rng.uniform(5, 500), 2),
+         "date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", "merchant": f"Merchant {rng.randint(1, 40)}"}
+        for _ in range(count)
+    ]
+
+def build_request(scenario: str, index: int, document: bytes) -> dict:
+    """httpx request kwargs for one request of `scenario`. Messages are unique so coalescing does not hide the real cost."""
+    if scenario == "chat":
+        message = f"{DEFAULT_MESSAGES[index % len(DEFAULT_MESSAGES)]} (load test #{index})"
+        return {"json": {"message": message, "history": [], "expenses": [], "is_smart_assistant_query": False}}
+    if scenario == "smart_assistant":
+        expenses = synthetic_expenses(random.Random(index), 50)
+        return {"json": {"message": "", "history": [], "expenses": expenses, "is_smart_assistant_query": True}}
+    return {"files": {"file": (f"document_{index}.png", document, "image/png")}}
+
+async def run_scenario(base_url: str, scenario: str, concurrency: int, total_requests: int, timeout: float, document: bytes) -> dict:
+    url = base_url + SCENARIOS[scenario]["path"]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    status_counts = {}
+
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one_request(i: int):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, **build_request(scenario, i, document))
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                status_counts[status] = status_counts.get(status, 0) + 1
+
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(one_request(i) for i in range(total_requests)))
+        wall_elapsed = time.perf_counter() - wall_started
+
+    latencies.sort()
+    return {
+        "endpoint": url,
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "throughput_rps": total_requests / wall_elapsed,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "max_s": latencies[-1] if latencies else 0.0,
+        "status_counts": status_counts,
+    }
+
+def start_process(args: list, env: dict, cwd: str) -> subprocess.Popen:
+    return subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+def wait_until_ready(url: str, timeout: float, process: subprocess.Popen):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process serving {url} exited with code {process.returncode} during startup.")
+        try:
+            if httpx.get(url, timeout=2.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} was not ready within {timeout:.0f}s.")
+
+def start_stack(args, services: set) -> list:
+    """Starts the stub and the requested backends; returns the processes to terminate afterwards."""
+    processes = []
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    stub = start_process([sys.executable, STUB_SCRIPT, "--port", str(args.stub_port), "--latency", args.stub_latency,
+                          "--ttft-median", str(args.stub_ttft_median), "--ttft-sigma", str(args.stub_ttft_sigma),
+                          "--token-delay", str(args.stub_token_delay), "--error-rate", str(args.stub_error_rate)],
+                         os.environ.copy(), PROJECT_ROOT)
+    processes.append(stub)
+    wait_until_ready(f"{stub_url}/health", 30, stub)
+
+    env = os.environ.copy()
+    env.update({
+        "LLM_ENDPOINT_URL": stub_url,
+        "DASHSCOPE_BASE_URL": f"{stub_url}/v1",
+        "HUGGING_FACE_API_TOKEN": env.get("HUGGING_FACE_API_TOKEN", "stub-token"),
+        "DASHSCOPE_API_KEY": env.get("DASHSCOPE_API_KEY", "stub-key"),
+    })
+    for name in sorted(services):
+        service = SERVICES[name]
+        app_dir = os.path.join(PROJECT_ROOT, service["app_dir"])
+        process = start_process([sys.executable, "-m", "uvicorn", service["app"], "--app-dir", app_dir,
+                                 "--host", "127.0.0.1", "--port", str(service["port"]), "--log-level", "warning"],
+                                env, app_dir)
+        processes.append(process)
+        print(f"Starting {name} on port {service['port']}...")
+        wait_until_ready(f"http://127.0.0.1:{service['port']}/", args.startup_timeout, process)
+    return processes
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for scenario, result in results.items():
+        previous = baseline.get(scenario)
+        if not previous:
+            continue
+        if result["p95_s"] > previous["p95_s"] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {previous['p95_s']:.3f}s -> {result['p95_s']:.3f}s")
+        if result["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {previous['throughput_rps']:.2f} -> {result['throughput_rps']:.2f} req/s")
+    return regressions
+
+def print_report(results: dict):
+    print("\n--- Load Test Results ---")
+    print(f"{'scenario':<17}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  status codes")
+    for scenario, r in results.items():
+        print(f"{scenario:<17}{r['throughput_rps']:>9.2f}{r['p50_s']:>9.3f}{r['p95_s']:>9.3f}{r['p99_s']:>9.3f}{r['max_s']:>9.3f}  {r['status_counts']}")
+    print("-------------------------")
+
+async def run_all(args, scenarios: list) -> dict:
+    document = synthetic_document_png() if {"receipt", "income"} & set(scenarios) else b""
+    results = {}
+    for scenario in scenarios:
+        base_url = f"http://127.0.0.1:{SERVICES[SCENARIOS[scenario]['service']]['port']}"
+        if args.warmup:
+            await run_scenario(base_url, scenario, 1, args.warmup, args.timeout, document)
+        print(f"Running {scenario}: {args.requests} requests, concurrency {args.concurrency}...")
+        results[scenario] = await run_scenario(base_url, scenario, args.concurrency, args.requests, args.timeout, document)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test of the backends against the LLM stub.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=2, help="Sequential requests per scenario before measuring.")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--no-start", action="store_true", help="Use servers that are already running instead of starting them.")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--stub-port", type=int, default=8090)
+    parser.add_argument("--stub-latency", choices=["constant", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--stub-ttft-median", type=float, default=0.4)
+    parser.add_argument("--stub-ttft-sigma", type=float, default=0.6)
+    parser.add_argument("--stub-token-delay", type=float, default=0.01)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative p95/throughput regression.")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    processes = [] if args.no_start else start_stack(args, {SCENARIOS[name]["service"] for name in scenarios})
+    try:
+        results = asyncio.run(run_all(args, scenarios))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Performance regressions beyond tolerance:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of the baseline.")
+
+if __name__ == "__main__":
+    main()
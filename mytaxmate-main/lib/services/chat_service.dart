@@ -11,6 +11,8 @@ class ChatService {
   static const String _backendUrl = 'http://localhost:8003/chat';
 
   final List<ChatMessage> _chatHistory = [];
+  // Server-side session id; once the backend has assigned one it keeps the history for us
+  String? _sessionId;
   final _chatStreamController = StreamController<List<ChatMessage>>.broadcast();
 
   Stream<List<ChatMessage>> get chatStream => _chatStreamController.stream;
@@ -38,19 +40,16 @@ class ChatService {
         .toList();
 
     try {
-      final response = await http.post(
-        Uri.parse(_backendUrl),
-        headers: {'Content-Type': 'application/json; charset=UTF-8'},
-        body: jsonEncode({
-          'message': userMessage, // Changed 'query' to 'message'
-          'history': historyPayload, // Added history
-          'expenses': [], // Added expenses (empty for now)
-          'is_smart_assistant_query': false, // Added flag (false for now)
-        }),
-      );
+      var response = await _postMessage(userMessage, historyPayload);
+      if (response.statusCode == 409) {
+        // The server no longer has our session (expired or restarted); start a new one from our copy
+        _sessionId = null;
+        response = await _postMessage(userMessage, historyPayload);
+      }
 
       if (response.statusCode == 200) {
         final responseData = jsonDecode(utf8.decode(response.bodyBytes)); // handle UTF-8
+        _sessionId = responseData['session_id'] as String? ?? _sessionId;
         final assistantReply = responseData['assistant_reply'] as String?;
         if (assistantReply != null) {
           final assistantMessage = ChatMessage.fromAssistant(assistantReply);
@@ -70,6 +69,21 @@ class ChatService {
     _chatStreamController.add(List.from(_chatHistory)); 
   }
 
+  Future<http.Response> _postMessage(String userMessage, List<Map<String, String>> historyPayload) {
+    return http.post(
+      Uri.parse(_backendUrl),
+      headers: {'Content-Type': 'application/json; charset=UTF-8'},
+      body: jsonEncode({
+        'message': userMessage, // Changed 'query' to 'message'
+        'session_id': _sessionId,
+        // Only needed to seed a new session; the server keeps the history afterwards
+        'history': _sessionId == null ? historyPayload : [],
+        'expenses': [], // Added expenses (empty for now)
+        'is_smart_assistant_query': false, // Added flag (false for now)
+      }),
+    );
+  }
+
   void _addErrorMessage(String errorMessageText) {
     final errorMessage = ChatMessage.fromAssistant(errorMessageText);
     _chatHistory.add(errorMessage);
@@ -77,6 +91,7 @@ class ChatService {
 
   void clearChat() {
     _chatHistory.clear();
+    _sessionId = null;
     _chatStreamController.add(List.from(_chatHistory));
   }
 
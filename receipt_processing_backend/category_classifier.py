@@ -0,0 +1,167 @@
+"""
+Local expense-category classifier over receipt OCR text.
+
+A multinomial naive Bayes model over word unigrams and bigrams, trained at startup from
+labelled receipts in JSONL ({"text": "<OCR text>", "category": "<one of EXPENSE_CATEGORIES>"}).
+Training a few thousand receipts takes well under a second, so there is no separate model
+artifact to keep in sync with the data. Predictions come with a posterior probability;
+callers only trust predictions above a threshold and ask the LLM otherwise.
+
+The local path is off by default (CATEGORY_CLASSIFIER_ENABLED=false): the bundled training file
+is a seed set, not labelled production receipts. Turn it on once production receipts have been
+added and --evaluate shows acceptable accuracy at the chosen threshold.
+
+Append labelled production receipts to the training file (or point CATEGORY_TRAINING_DATA
+at a larger one) to raise coverage. To check accuracy and coverage per threshold:
+    python category_classifier.py --evaluate
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+from collections import Counter as TermCounter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_TRAINING_DATA = os.getenv(
+    "CATEGORY_TRAINING_DATA", os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_training_data.jsonl"))
+# Local predictions are only used when enabled; off until the training file holds labelled production receipts
+CATEGORY_CLASSIFIER_ENABLED = os.getenv("CATEGORY_CLASSIFIER_ENABLED", "false").lower() == "true"
+# Posterior probability above which the local prediction is used instead of asking the LLM
+CATEGORY_CONFIDENCE_THRESHOLD = float(os.getenv("CATEGORY_CONFIDENCE_THRESHOLD", "0.9"))
+# Receipts with fewer known terms than this always go to the LLM; too little evidence to trust the prior
+CATEGORY_MIN_KNOWN_TERMS = int(os.getenv("CATEGORY_MIN_KNOWN_TERMS", "3"))
+
+CATEGORY_SOURCE = Counter("receipt_category_source", "Which component chose the receipt expense category.", ["source"])
+
+EXPENSE_CATEGORIES = [
+    "Books & Publications", "Computer & IT Equipment", "Software & Subscriptions", "Groceries", "Meals & Entertainment",
+    "Utilities (Electricity, Water, Internet)", "Transportation (Fuel, Parking, Public Transport)",
+    "Office Supplies & Stationery", "Travel (Flights, Accommodation)", "Healthcare & Medical",
+    "Professional Fees (Legal, Accounting)", "Education & Training", "Charitable Contributions", "Repairs & Maintenance",
+    "Rentals", "Financial Costs (Bank Charges)", "Insurance", "Gifts & Donations (Non-charitable)", "Personal Care",
+    "Clothing & Apparel", "Home & Furnishing", "Other",
+]
+
+# Tokens on every receipt regardless of category; they only add noise
+STOP_WORDS = {
+    "total", "subtotal", "sub", "rm", "myr", "date", "time", "qty", "amount", "price", "tax", "sst", "gst", "cash",
+    "change", "card", "paid", "thank", "you", "terima", "kasih", "receipt", "invoice", "no", "tel", "sdn", "bhd",
+    "the", "and", "for", "of", "to", "please", "come", "again", "by", "in", "at",
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased alphabetic words (numbers and prices carry no category signal) plus adjacent-word bigrams."""
+    words = [w for w in re.findall(r"[a-z][a-z'&]+", text.lower()) if w not in STOP_WORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def load_training_data(path: str) -> List[Tuple[str, str]]:
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("category") not in EXPENSE_CATEGORIES:
+                logger.warning(f"{path}:{line_number}: unknown category {record.get('category')!r}; skipped.")
+                continue
+            examples.append((record["text"], record["category"]))
+    return examples
+
+class CategoryClassifier:
+    """Multinomial naive Bayes with Laplace smoothing; term counts are clipped to 1 per receipt."""
+
+    def __init__(self, smoothing: float = 0.5):
+        self.smoothing = smoothing
+        self.categories: List[str] = []
+        self._log_priors: Dict[str, float] = {}
+        self._log_likelihoods: Dict[str, Dict[str, float]] = {}
+        self._log_unseen: Dict[str, float] = {}
+        self._vocabulary: set = set()
+
+    @property
+    def trained(self) -> bool:
+        return bool(self.categories)
+
+    def fit(self, examples: Iterable[Tuple[str, str]]) -> "CategoryClassifier":
+        documents_per_category: TermCounter = TermCounter()
+        term_counts: Dict[str, TermCounter] = {}
+        for text, category in examples:
+            documents_per_category[category] += 1
+            term_counts.setdefault(category, TermCounter()).update(set(tokenize(text)))
+        total_documents = sum(documents_per_category.values())
+        self._vocabulary = set().union(*term_counts.values()) if term_counts else set()
+        self.categories = sorted(documents_per_category)
+        vocabulary_size = len(self._vocabulary)
+        for category in self.categories:
+            counts = term_counts[category]
+            denominator = sum(counts.values()) + self.smoothing * vocabulary_size
+            self._log_priors[category] = math.log(documents_per_category[category] / total_documents)
+            self._log_likelihoods[category] = {term: math.log((count + self.smoothing) / denominator) for term, count in counts.items()}
+            self._log_unseen[category] = math.log(self.smoothing / denominator)
+        return self
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """(category, posterior probability); (None, 0.0) when untrained or the text has too few known terms."""
+        if not self.trained:
+            return None, 0.0
+        terms = [term for term in set(tokenize(text)) if term in self._vocabulary]
+        if len(terms) < CATEGORY_MIN_KNOWN_TERMS:
+            return None, 0.0
+        scores = {}
+        for category in self.categories:
+            likelihoods, unseen = self._log_likelihoods[category], self._log_unseen[category]
+            scores[category] = self._log_priors[category] + sum(likelihoods.get(term, unseen) for term in terms)
+        best = max(scores, key=scores.get)
+        # Normalize in log space; exp of raw log-likelihoods underflows for long receipts
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / normalizer
+
+def build_default_classifier(path: str = CATEGORY_TRAINING_DATA) -> CategoryClassifier:
+    classifier = CategoryClassifier()
+    if not os.path.exists(path):
+        logger.warning(f"Category training data not found at {path}. All receipts will be categorized by the LLM.")
+        return classifier
+    examples = load_training_data(path)
+    classifier.fit(examples)
+    logger.info(f"Category classifier trained on {len(examples)} receipts across {len(classifier.categories)} categories.")
+    return classifier
+
+def evaluate(examples: List[Tuple[str, str]], folds: int, thresholds: List[float], seed: int):
+    """k-fold cross-validation: share of receipts answered locally and accuracy on those, per threshold."""
+    examples = examples[:]
+    random.Random(seed).shuffle(examples)
+    predictions = []
+    for fold in range(folds):
+        test = examples[fold::folds]
+        train = [example for i, example in enumerate(examples) if i % folds != fold]
+        classifier = CategoryClassifier().fit(train)
+        predictions.extend((classifier.predict(text), category) for text, category in test)
+
+    print(f"{len(examples)} labelled receipts, {folds}-fold cross-validation")
+    print(f"{'threshold':>10}{'coverage':>10}{'accuracy':>10}")
+    for threshold in thresholds:
+        answered = [(predicted, actual) for (predicted, confidence), actual in predictions if predicted and confidence >= threshold]
+        coverage = len(answered) / len(predictions)
+        accuracy = sum(predicted == actual for predicted, actual in answered) / len(answered) if answered else 0.0
+        print(f"{threshold:>10.2f}{coverage:>10.1%}{accuracy:>10.1%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train and evaluate the local receipt category classifier.")
+    parser.add_argument("--data", default=CATEGORY_TRAINING_DATA)
+    parser.add_argument("--evaluate", action="store_true", help="Report cross-validated coverage and accuracy per threshold.")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--text", help="Classify this OCR text with a model trained on --data.")
+    args = parser.parse_args()
+
+    if args.evaluate:
+        evaluate(load_training_data(args.data), args.folds, [0.5, 0.7, 0.8, 0.9, 0.95, 0.99], args.seed)
+    if args.text:
+        print(build_default_classifier(args.data).predict(args.text))
@@ -0,0 +1,116 @@
+import logging
+import os
+from typing import Any, Dict, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Normalization applied to receipt photos before OCR; off by default, so images go through untouched
+# until it has been checked against the deployment's own receipts
+RECEIPT_PREPROCESSING_ENABLED = os.getenv("RECEIPT_PREPROCESSING_ENABLED", "false").lower() == "true"
+# Long side cap in pixels. PaddleOCR's detector resizes to a few hundred/thousand pixels anyway,
+# so 12MP phone photos only cost decode, transfer and resize time above this
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1600"))
+RECEIPT_CROP_ENABLED = os.getenv("RECEIPT_CROP_ENABLED", "true").lower() == "true"
+RECEIPT_DESKEW_ENABLED = os.getenv("RECEIPT_DESKEW_ENABLED", "true").lower() == "true"
+# Skew corrections outside this range (degrees) are ignored: tiny ones are noise, large ones are usually misdetections
+MIN_DESKEW_ANGLE = 0.5
+MAX_DESKEW_ANGLE = 20.0
+
+def downscale(image: np.ndarray, max_side: int) -> np.ndarray:
+    height, width = image.shape[:2]
+    long_side = max(height, width)
+    if max_side <= 0 or long_side <= max_side:
+        return image
+    scale = max_side / long_side
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+def to_grayscale(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def crop_to_receipt(gray: np.ndarray) -> Tuple[np.ndarray, bool]:
+    """
+    Crops to the bounding box of the largest bright region (the paper against a darker
+    background). Left uncropped when no region covers a plausible share of the frame,
+    e.g. scans or photos where the receipt already fills the image.
+    """
+    height, width = gray.shape
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Close the gaps that printed text leaves in the paper region
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, width // 40), max(3, height // 40)))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return gray, False
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    coverage = (w * h) / float(width * height)
+    if coverage < 0.15 or coverage > 0.92:
+        return gray, False
+    pad = max(4, min(w, h) // 50)
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(width, x + w + pad), min(height, y + h + pad)
+    return gray[y0:y1, x0:x1], True
+
+def estimate_skew(gray: np.ndarray) -> float:
+    """
+    Angle in degrees (counter-clockwise positive) of the printed lines: characters are smeared
+    into line blobs and the median orientation of the long, thin blobs is taken, which ignores
+    background corners and logos.
+    """
+    # Local threshold, so background left around a cropped receipt does not read as ink
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    ink = cv2.dilate(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, gray.shape[1] // 40), 1)))
+    contours, _ = cv2.findContours(ink, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    angles = []
+    for contour in contours:
+        (_, _), (rect_w, rect_h), angle = cv2.minAreaRect(contour)
+        long_side, short_side = max(rect_w, rect_h), min(rect_w, rect_h)
+        if short_side == 0 or long_side < gray.shape[1] / 8 or long_side / short_side < 4:
+            continue
+        # OpenCV's angle convention differs between versions; normalize to the long side's slope
+        if rect_w < rect_h:
+            angle -= 90.0
+        while angle > 45.0:
+            angle -= 90.0
+        while angle < -45.0:
+            angle += 90.0
+        angles.append(angle)
+    if len(angles) < 3:
+        return 0.0
+    return -float(np.median(angles))
+
+def rotate(gray: np.ndarray, angle: float) -> np.ndarray:
+    height, width = gray.shape
+    matrix = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(height * sin + width * cos), int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2.0 - width / 2.0
+    matrix[1, 2] += new_height / 2.0 - height / 2.0
+    return cv2.warpAffine(gray, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def preprocess_receipt_image(image: np.ndarray, max_side: int = OCR_MAX_SIDE, crop: bool = RECEIPT_CROP_ENABLED,
+                             deskew: bool = RECEIPT_DESKEW_ENABLED) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    Normalizes a receipt photo for OCR: caps the long side at `max_side`, converts to grayscale,
+    crops to the receipt and corrects small rotations. Returns a 3-channel BGR image (the layout
+    PaddleOCR expects) and a dict describing what was done.
+    """
+    info: Dict[str, Any] = {"original_size": list(image.shape[:2])}
+    # Grayscale first: resizing one channel instead of three is most of the saving on large photos
+    gray = downscale(to_grayscale(image), max_side)
+    info["cropped"] = False
+    if crop:
+        gray, info["cropped"] = crop_to_receipt(gray)
+    info["deskew_angle"] = 0.0
+    if deskew:
+        angle = estimate_skew(gray)
+        if MIN_DESKEW_ANGLE <= abs(angle) <= MAX_DESKEW_ANGLE:
+            gray = rotate(gray, -angle)
+            info["deskew_angle"] = round(angle, 2)
+    info["final_size"] = list(gray.shape[:2])
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), info
@@ -0,0 +1,225 @@
+"""
+Deterministic merchant / total / date extraction from PaddleOCR output.
+
+Uses the text boxes to rebuild the visual rows of the receipt (PaddleOCR often returns a
+label and its amount as separate boxes on the same row), then applies compiled patterns and
+layout heuristics:
+  - total: the largest amount on a row labelled with a total keyword, e.g. "Grand Total"
+    or "Gross Amount". Subtotal, tax, rounding, cash and change rows are ignored.
+  - merchant: the most prominent text line near the top of the receipt; confident only when it
+    is the sole candidate or clearly taller than the others, which needs box geometry.
+  - date: date patterns, read day-first as Malaysian receipts are printed.
+Each field gets its own confidence. The LLM extraction call is only skipped when all
+three are confident.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from statistics import median
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_LAYOUT_FAST_PATH_ENABLED = os.getenv("RECEIPT_LAYOUT_FAST_PATH_ENABLED", "true").lower() == "true"
+# OCR recognition score below which a line is not trusted for the merchant name
+MIN_MERCHANT_SCORE = 0.8
+# With several name-like header rows, the merchant must be at least this much taller than the rest
+MERCHANT_HEIGHT_MARGIN = 1.25
+
+EXTRACTION_PATH = Counter("receipt_extraction_path", "How receipt merchant/amount/date were extracted.", ["path"])
+
+# "1,234.50", "RM 12.90", "12,90"; not the pieces of dates like 14.03.2025 or of percentages
+AMOUNT_PATTERN = re.compile(r"(?<![\d.,])(?:RM|MYR)?\s*(\d{1,3}(?:,\d{3})+|\d+)[.,](\d{2})(?![\d%]|[.,]\d)", re.IGNORECASE)
+# Strongest label first; a row's priority is the first pattern it matches
+TOTAL_KEYWORDS = [
+    re.compile(r"\b(grand\s*total|total\s*amount\s*(?:due|payable)?|amount\s*(?:due|payable)|gross\s*amount|net\s*total|jumlah\s*besar)\b", re.IGNORECASE),
+    re.compile(r"\b(total|jumlah)\b", re.IGNORECASE),
+]
+NOT_TOTAL_PATTERN = re.compile(
+    r"\b(sub\s*-?\s*total|total\s*(?:qty|quantity|items?|disc\w*|savings?|tax|sst|gst)|rounding|round\s*adj\w*|"
+    r"cash|change|tender\w*|paid|balance|bal|points?|discount|service\s*(?:tax|charge)|sst|gst|tax)\b",
+    re.IGNORECASE)
+INCLUSIVE_TAX_PATTERN = re.compile(r"\b(?:incl\w*|inc)\.?\s*(?:of\s*)?(?:sst|gst|tax)\b", re.IGNORECASE)
+# Rows that can legitimately hold amounts larger than the total (e.g. cash handed over)
+PAYMENT_ROW_PATTERN = re.compile(r"\b(cash|change|tender\w*|paid|payment|card|visa|master\w*|debit|credit|e-?wallet|balance)\b", re.IGNORECASE)
+
+MONTHS = "jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec|january|february|march|april|june|july|august|september|october|november|december"
+DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b"), "ymd"),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b"), "dmy"),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{2})\b(?![-/.:]\d)"), "dmy"),
+    (re.compile(rf"\b(\d{{1,2}})[\s-]*({MONTHS})[a-z]*[\s,-]*(\d{{2,4}})\b", re.IGNORECASE), "d_mon_y"),
+    (re.compile(rf"\b({MONTHS})[a-z]*\s+(\d{{1,2}}),?\s+(\d{{4}})\b", re.IGNORECASE), "mon_d_y"),
+]
+MONTH_NUMBERS = {name: index for index, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+
+# Header lines that are not the merchant name
+NOT_MERCHANT_PATTERN = re.compile(
+    r"\b(tax\s*invoice|invoice|receipt|resit|welcome|selamat|official|cash\s*bill|bill|tel|fax|phone|"
+    r"gst|sst|reg(?:istration)?\s*no|co\.?\s*no|no\.?\s*\d|jalan|jln|lot|taman|www\.|@|\.com|"
+    r"cashier|served\s*by|staff|counter|terminal|pos|(?:customer|merchant|store|duplicate)\s*copy|reprint\w*|"
+    r"member\w*|(?:table|order|queue)\s*(?:no|num\w*|id)|items?|qty|description)\b",
+    re.IGNORECASE)
+
+@dataclass
+class OCRRow:
+    """One visual row of the receipt: the OCR fragments sharing a baseline, left to right."""
+    text: str
+    top: float
+    height: float
+    score: float
+    boxed: bool = True  # False when the OCR result had no boxes, so `top` and `height` are placeholders
+
+@dataclass
+class LayoutExtraction:
+    merchant: str = ""
+    amount: float = 0.0
+    date: str = ""
+    confidence: Dict[str, bool] = field(default_factory=lambda: {"merchant": False, "amount": False, "date": False})
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def confident(self) -> bool:
+        return all(self.confidence.values())
+
+    def as_fields(self) -> Dict[str, Any]:
+        return {"merchant": self.merchant, "amount": self.amount, "date": self.date}
+
+def build_rows(ocr_result: Dict[str, Any]) -> List[OCRRow]:
+    """Groups OCR fragments into rows by vertical overlap; without boxes every line is its own row."""
+    lines = ocr_result.get("lines") or []
+    boxes = ocr_result.get("boxes") or []
+    scores = ocr_result.get("scores") or [1.0] * len(lines)
+    if not boxes:
+        return [OCRRow(text=line, top=float(i), height=1.0, score=score, boxed=False)
+                for i, (line, score) in enumerate(zip(lines, scores))]
+
+    fragments = []
+    for text, box, score in zip(lines, boxes, scores):
+        xs, ys = [point[0] for point in box], [point[1] for point in box]
+        fragments.append((min(ys), max(ys), min(xs), text, score))
+    fragments.sort(key=lambda f: (f[0] + f[1]) / 2)
+    row_tolerance = 0.5 * median([bottom - top for top, bottom, _, _, _ in fragments] or [1.0])
+
+    rows: List[List[tuple]] = []
+    for fragment in fragments:
+        center = (fragment[0] + fragment[1]) / 2
+        if rows:
+            last = rows[-1]
+            last_center = sum((f[0] + f[1]) / 2 for f in last) / len(last)
+            if abs(center - last_center) <= row_tolerance:
+                last.append(fragment)
+                continue
+        rows.append([fragment])
+
+    result = []
+    for row in rows:
+        row.sort(key=lambda f: f[2])
+        result.append(OCRRow(
+            text="  ".join(f[3] for f in row),
+            top=min(f[0] for f in row),
+            height=median([f[1] - f[0] for f in row]),
+            score=min(f[4] for f in row),
+        ))
+    return result
+
+def parse_amounts(text: str) -> List[float]:
+    return [float(f"{whole.replace(',', '')}.{cents}") for whole, cents in AMOUNT_PATTERN.findall(text)]
+
+def extract_total(rows: List[OCRRow]) -> Tuple[float, bool, str]:
+    """(amount, confident, note). Considers the row with the keyword and, for labels printed above their value, the next row."""
+    candidates = []
+    for index, row in enumerate(rows):
+        # "Total incl. SST" is the total; "SST 6%" or "Service Tax" on their own are not
+        if NOT_TOTAL_PATTERN.search(INCLUSIVE_TAX_PATTERN.sub("", row.text)):
+            continue
+        for priority, pattern in enumerate(TOTAL_KEYWORDS):
+            if pattern.search(row.text):
+                amounts = parse_amounts(row.text)
+                if not amounts and index + 1 < len(rows) and not TOTAL_KEYWORDS[1].search(rows[index + 1].text):
+                    amounts = parse_amounts(rows[index + 1].text)
+                candidates.extend((priority, amount) for amount in amounts)
+                break
+    if not candidates:
+        return 0.0, False, "no amount on a total row"
+
+    best_priority = min(priority for priority, _ in candidates)
+    total = max(amount for priority, amount in candidates if priority == best_priority)
+    other_amounts = [amount for row in rows if not PAYMENT_ROW_PATTERN.search(row.text) for amount in parse_amounts(row.text)]
+    if total <= 0:
+        return total, False, "total is zero"
+    if other_amounts and max(other_amounts) > total + 0.005:
+        return total, False, f"a larger amount ({max(other_amounts):.2f}) appears outside the total row"
+    distinct_totals = {amount for priority, amount in candidates if priority == best_priority}
+    if len(distinct_totals) > 1 and best_priority > 0:
+        return total, False, "several different amounts on total rows"
+    return total, True, ""
+
+def _to_date(day: int, month: int, year: int) -> Optional[date]:
+    if year < 100:
+        year += 2000
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+def extract_date(rows: List[OCRRow]) -> Tuple[str, bool, str]:
+    found = []
+    for row in rows:
+        for pattern, order in DATE_PATTERNS:
+            for groups in pattern.findall(row.text):
+                if order == "ymd":
+                    parsed = _to_date(int(groups[2]), int(groups[1]), int(groups[0]))
+                elif order == "dmy":
+                    parsed = _to_date(int(groups[0]), int(groups[1]), int(groups[2]))
+                elif order == "d_mon_y":
+                    parsed = _to_date(int(groups[0]), MONTH_NUMBERS[groups[1][:3].lower()], int(groups[2]))
+                else:
+                    parsed = _to_date(int(groups[1]), MONTH_NUMBERS[groups[0][:3].lower()], int(groups[2]))
+                if parsed:
+                    found.append(parsed)
+    if not found:
+        return "", False, "no date found"
+    plausible = {d for d in found if 2000 <= d.year <= datetime.now().year + 1}
+    if len(plausible) != 1:
+        return found[0].isoformat(), False, f"{len(plausible)} distinct plausible dates"
+    return plausible.pop().isoformat(), True, ""
+
+def extract_merchant(rows: List[OCRRow]) -> Tuple[str, bool, str]:
+    """The tallest plausible name among the first rows; merchants are printed at the top, often larger."""
+    header = []
+    for row in rows[:6]:
+        text = row.text.strip()
+        letters = sum(c.isalpha() for c in text)
+        if letters < 3 or letters / max(1, len(text.replace(" ", ""))) < 0.6:
+            continue
+        if NOT_MERCHANT_PATTERN.search(text) or AMOUNT_PATTERN.search(text) or any(p.search(text) for p, _ in DATE_PATTERNS):
+            continue
+        header.append(row)
+    if not header:
+        return "", False, "no name-like line at the top"
+    candidates = header[:3]
+    merchant_row = max(candidates, key=lambda row: row.height)
+    merchant = re.sub(r"\s{2,}", " ", merchant_row.text).strip()
+    if not merchant_row.boxed:
+        return merchant, False, "no box geometry to tell the merchant line apart"
+    if merchant_row.score < MIN_MERCHANT_SCORE:
+        return merchant, False, f"low OCR score {merchant_row.score:.2f}"
+    runner_up = max((row.height for row in candidates if row is not merchant_row), default=0.0)
+    if runner_up and merchant_row.height < MERCHANT_HEIGHT_MARGIN * runner_up:
+        return merchant, False, "several header lines of similar size"
+    return merchant, True, ""
+
+def extract_receipt_fields(ocr_result: Dict[str, Any]) -> LayoutExtraction:
+    rows = build_rows(ocr_result)
+    extraction = LayoutExtraction()
+    extraction.merchant, extraction.confidence["merchant"], merchant_note = extract_merchant(rows)
+    extraction.amount, extraction.confidence["amount"], amount_note = extract_total(rows)
+    extraction.date, extraction.confidence["date"], date_note = extract_date(rows)
+    extraction.notes = [note for note in (merchant_note, amount_note, date_note) if note]
+    return extraction
@@ -1,17 +1,20 @@
 import os
 import sys
 import base64
+import asyncio
+import logging
+from contextlib import ExitStack, asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, Header, UploadFile, HTTPException, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import re
+import hashlib
 import mimetypes
 import json
 from datetime import datetime
-from paddleocr import PaddleOCR
-from huggingface_hub import InferenceClient
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import cv2
 import numpy as np
 
@@ -19,26 +22,86 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if PROJECT_ROOT not in sys.path:
     sys.path.append(PROJECT_ROOT)
 
+from backend_shared.logging_setup import setup_logging, log_payload
+from backend_shared.admission import AdmissionController, AdmissionRejected, admission_rejected_handler, EXTRACTION
+from backend_shared.llm_client import ResilientLLMClient
+from backend_shared.job_queue import (JobQueue, JobQueueFull, InvalidCallbackURL, IdempotencyKeyConflict, job_queue_full_handler,
+                                      invalid_callback_url_handler, idempotency_key_conflict_handler)
+from backend_shared.uploads import UploadSizeLimitMiddleware, configure_upload_spooling, upload_buffer
+from backend_shared.parsing import clean_text, extract_json_object, normalize_date, parse_amount, parse_bool
+from backend_shared.deadline import (Deadline, DeadlineExceeded, DeadlinePolicy, DEADLINE_MIN_LLM_CALL_SECONDS, cut_stage,
+                                     cut_stages, deadline_scope, stage_slot, time_allows, within_deadline, without_deadline)
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from tax_knowledge_engine.simple_retriever import TaxGuidelineRetriever
+from ocr_pool import OCRWorkerPool, OCR_POOL_SIZE
+from image_preprocessing import preprocess_receipt_image, RECEIPT_PREPROCESSING_ENABLED
+from category_classifier import build_default_classifier, CATEGORY_CLASSIFIER_ENABLED, CATEGORY_CONFIDENCE_THRESHOLD, CATEGORY_TRAINING_DATA, CATEGORY_SOURCE
+from layout_extractor import extract_receipt_fields, RECEIPT_LAYOUT_FAST_PATH_ENABLED, EXTRACTION_PATH
+from receipt_cache import ReceiptResultCache, RECEIPT_CACHE_ENABLED, content_hash, perceptual_hash
+
+# Queue-based logging: request handlers only enqueue records, a listener thread writes them out
+setup_logging('receipt_processing', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'))
+logger = logging.getLogger(__name__)
 
 ENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 
 if os.path.exists(ENV_PATH):
     load_dotenv(dotenv_path=ENV_PATH)
-    print(f"Loaded .env file from: {ENV_PATH}")
+    logger.info(f"Loaded .env file from: {ENV_PATH}")
 else:
-    print(f".env file not found at: {ENV_PATH}. Please ensure it exists.")
+    logger.warning(f".env file not found at: {ENV_PATH}. Please ensure it exists.")
 
 # --- Configuration ---
 HUGGING_FACE_API_TOKEN = os.getenv("HUGGING_FACE_API_TOKEN")
 MISTRAL_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.3"
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+# Per-stage concurrency for the receipt pipeline. OCR defaults to one job per OCR worker process.
+OCR_STAGE_CONCURRENCY = int(os.getenv("OCR_STAGE_CONCURRENCY", str(OCR_POOL_SIZE)))
+LLM_STAGE_CONCURRENCY = int(os.getenv("LLM_STAGE_CONCURRENCY", "8"))
+RAG_STAGE_CONCURRENCY = int(os.getenv("RAG_STAGE_CONCURRENCY", "4"))
+MAX_RECEIPTS_PER_BATCH = int(os.getenv("MAX_RECEIPTS_PER_BATCH", "100"))
+# Deductibility assessments per (category, guidelines) kept for receipts on the layout fast path
+DEDUCTIBILITY_CACHE_MAX_ENTRIES = int(os.getenv("DEDUCTIBILITY_CACHE_MAX_ENTRIES", "256"))
+# Guideline retrieval is skipped unless this much time is left besides the LLM call that follows it
+DEADLINE_MIN_RAG_SECONDS = float(os.getenv("DEADLINE_MIN_RAG_SECONDS", "1"))
+# Jobs have no client waiting on them, so they get a longer budget than interactive requests
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "300"))
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info(f"Starting {ocr_pool.size} PaddleOCR worker processes...")
+    await ocr_pool.start()
+    if RECEIPT_CACHE_ENABLED:
+        await asyncio.to_thread(receipt_cache.open)
+    await receipt_jobs.start()
+    yield
+    await receipt_jobs.close()
+    await ocr_pool.close()
+    receipt_cache.close()
+    if hf_client:
+        await hf_client.close()
+        logger.info("Hugging Face client closed.")
 
 app = FastAPI(
     title="Receipt Processing API with PaddleOCR, Mistral & RAG",
     description="Processes receipts using PaddleOCR for text extraction, a Mistral LLM for structuring, and a RAG system for tax deductibility assessment based on the Malaysian Income Tax Act 1967.",
     version="0.8.0", 
+    lifespan=lifespan,
 )
 
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+app.add_exception_handler(JobQueueFull, job_queue_full_handler)
+app.add_exception_handler(InvalidCallbackURL, invalid_callback_url_handler)
+app.add_exception_handler(IdempotencyKeyConflict, idempotency_key_conflict_handler)
+# Bounds concurrent extraction work; excess uploads queue briefly, then get 429/503 with Retry-After
+admission_controller = AdmissionController("receipt_processing")
+# Per-request time budget (X-Request-Timeout header or the default) that OCR, RAG and the LLM calls share
+request_deadlines = DeadlinePolicy("receipt_processing")
+# Oversized bodies get 413 before they are parsed; larger file parts are spooled to disk, not held in memory
+app.add_middleware(UploadSizeLimitMiddleware, service_name="receipt_processing")
+configure_upload_spooling()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -49,138 +112,99 @@ app.add_middleware(
 
 SUPPORTED_IMAGE_MIMETYPES = ["image/jpeg", "image/png", "image/webp", "image/bmp"]
 
-print("Initializing PaddleOCR...")
-try:
-    ocr_engine = PaddleOCR(use_angle_cls=True, lang='en')
-    print("PaddleOCR initialized successfully.")
-except Exception as e:
-    print(f"Error initializing PaddleOCR: {e}")
-    ocr_engine = None
+# Each worker process owns a PaddleOCR engine; the workers are started in the lifespan handler
+ocr_pool = OCRWorkerPool(size=OCR_POOL_SIZE, engine_kwargs={"use_angle_cls": True, "lang": "en"})
 
 hf_client = None
 if HUGGING_FACE_API_TOKEN:
     try:
-        hf_client = InferenceClient(model=MISTRAL_MODEL_ID, token=HUGGING_FACE_API_TOKEN)
-        print(f"Hugging Face InferenceClient initialized for model: {MISTRAL_MODEL_ID}.")
+        # Async, hedged and retried calls with a circuit breaker, so a slow upstream does not block the event loop
+        hf_client = ResilientLLMClient("receipt_processing", MISTRAL_MODEL_ID, token=HUGGING_FACE_API_TOKEN, timeout=LLM_REQUEST_TIMEOUT)
+        logger.info(f"Hugging Face InferenceClient initialized for model: {hf_client.model}.")
     except Exception as e:
-        print(f"Error initializing Hugging Face InferenceClient: {e}")
+        logger.error(f"Error initializing Hugging Face InferenceClient: {e}")
         hf_client = None
 else:
-    print("HUGGING_FACE_API_TOKEN not found. Hugging Face client not initialized.")
+    logger.warning("HUGGING_FACE_API_TOKEN not found. Hugging Face client not initialized.")
 
 EXPECTED_FAISS_INDEX_DIR = os.path.join(PROJECT_ROOT, "tax_knowledge_engine", "vector_store", "faiss_index")
 retriever = None
 if os.path.isdir(EXPECTED_FAISS_INDEX_DIR) and os.path.exists(os.path.join(EXPECTED_FAISS_INDEX_DIR, "index.faiss")):
     try:
         retriever = TaxGuidelineRetriever()
-        print(f"TaxGuidelineRetriever initialized successfully. Loading from: {EXPECTED_FAISS_INDEX_DIR}")
+        logger.info(f"TaxGuidelineRetriever initialized successfully. Loading from: {EXPECTED_FAISS_INDEX_DIR}")
     except Exception as e:
-        print(f"Error initializing TaxGuidelineRetriever: {e}")
+        logger.error(f"Error initializing TaxGuidelineRetriever: {e}")
         retriever = None
 else:
-    print(f"Vector store not found at {EXPECTED_FAISS_INDEX_DIR}. TaxGuidelineRetriever not initialized. Ensure 'document_processor.py' has run.")
+    logger.warning(f"Vector store not found at {EXPECTED_FAISS_INDEX_DIR}. TaxGuidelineRetriever not initialized. Ensure 'document_processor.py' has run.")
+
+def results_version() -> str:
+    """
+    Fingerprint of what a processed receipt depends on besides the image: the model, the
+    guideline index and, when the local classifier is on, the category training data on disk. Cached results from another
+    version are discarded.
+    """
+    digest = hashlib.sha1(MISTRAL_MODEL_ID.encode("utf-8"))
+    paths = [os.path.join(EXPECTED_FAISS_INDEX_DIR, name) for name in sorted(os.listdir(EXPECTED_FAISS_INDEX_DIR))] \
+        if os.path.isdir(EXPECTED_FAISS_INDEX_DIR) else []
+    for path in paths + ([CATEGORY_TRAINING_DATA] if CATEGORY_CLASSIFIER_ENABLED else []):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()
+
+# Picks the expense category locally for most receipts when enabled; only low-confidence ones cost an LLM call
+category_classifier = build_default_classifier() if CATEGORY_CLASSIFIER_ENABLED else None
+
+# Re-uploads of the same file are answered from here; similar-looking receipts of the same user
+# (X-User-Id header, set by the app or gateway that authenticated them) are flagged as possible duplicates
+receipt_cache = ReceiptResultCache(version=results_version())
 
 def parse_llm_json_output(llm_json_text, pre_determined_category=None):
-    raw_data = {}
     default_response = {
         "date": "", "merchant": "", "amount": 0.0,
         "category": pre_determined_category if pre_determined_category else "Other",
         "is_deductible": False, "deduction_type": "N/A", "deduction_details": "N/A"
     }
-
-    try:
-        match = re.search(r"```(?:json)?\s*(.*?)\s*```", llm_json_text, re.DOTALL | re.IGNORECASE)
-        if match:
-            cleaned_json_text = match.group(1).strip()
-        else:
-            cleaned_json_text = llm_json_text.strip()
-        
-        if not cleaned_json_text:
-             print("Warning: LLM returned empty JSON content for parsing.")
-             return default_response
-
-        raw_data = json.loads(cleaned_json_text)
-        
-        final_category = pre_determined_category if pre_determined_category else str(raw_data.get("category", "Other"))
-
-        date_str = str(raw_data.get("date", "")).strip()
-        formatted_date = default_response["date"]
-        if date_str and date_str.lower() not in ["not provided", "not specified", "n/a", ""]:
-            parsed_successfully = False
-            date_formats_to_try = [
-                "%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%m-%d-%Y", "%d-%m-%Y",
-                "%Y/%m/%d", "%m/%d/%y", "%d/%m/%y", "%d %b %Y", "%d %B %Y",
-                "%b %d, %Y", "%B %d, %Y", "%Y%m%d", "%d.%m.%Y",
-                "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S",
-            ]
-            for fmt in date_formats_to_try:
-                try:
-                    dt_obj = datetime.strptime(date_str, fmt)
-                    formatted_date = dt_obj.strftime("%Y-%m-%d")
-                    parsed_successfully = True
-                    break
-                except ValueError:
-                    continue
-            if not parsed_successfully:
-                print(f"Warning: Date '{date_str}' from LLM is not in a recognized format. Leaving as original string.")
-                formatted_date = date_str
-
-        amount_val = raw_data.get("amount")
-        parsed_amount = default_response["amount"]
-        if isinstance(amount_val, (int, float)):
-            parsed_amount = float(amount_val)
-        elif isinstance(amount_val, str):
-            amount_str_cleaned = amount_val.lower().strip()
-            if amount_str_cleaned not in ["not provided", "not specified", "n/a", ""]:
-                try:
-                    cleaned_amount_str_for_float = re.sub(r"[^\d.]", "", amount_str_cleaned)
-                    if cleaned_amount_str_for_float and cleaned_amount_str_for_float != ".":
-                        parsed_amount = float(cleaned_amount_str_for_float)
-                    else:
-                        print(f"Warning: Amount string '{amount_val}' became empty or invalid for float conversion after cleaning.")
-                except ValueError:
-                    print(f"Warning: Could not convert amount string '{amount_val}' to float.")
-        elif amount_val is not None:
-             print(f"Warning: Amount '{amount_val}' is of unexpected type {type(amount_val)}. Using default.")
-
-        is_deductible_val = raw_data.get("is_deductible", default_response["is_deductible"])
-        parsed_is_deductible = default_response["is_deductible"]
-        if isinstance(is_deductible_val, bool):
-            parsed_is_deductible = is_deductible_val
-        elif isinstance(is_deductible_val, str):
-            if is_deductible_val.lower() == "true":
-                parsed_is_deductible = True
-            elif is_deductible_val.lower() == "false":
-                parsed_is_deductible = False
-            else:
-                print(f"Warning: 'is_deductible' string value '{is_deductible_val}' is not 'true' or 'false'. Defaulting to False.")
-        
-        return {
-            "date": formatted_date,
-            "merchant": str(raw_data.get("merchant", default_response["merchant"])).strip(),
-            "amount": parsed_amount,
-            "category": final_category,
-            "is_deductible": parsed_is_deductible,
-            "deduction_type": str(raw_data.get("deduction_type", default_response["deduction_type"])).strip(),
-            "deduction_details": str(raw_data.get("deduction_details", default_response["deduction_details"])).strip()
-        }
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from LLM: {e}")
-        print(f"Problematic JSON string: >>>{llm_json_text}<<<")
+    if not (llm_json_text or "").strip():
+        logger.warning("LLM returned empty JSON content for parsing.")
         return default_response
-    except Exception as e:
-        print(f"Unexpected error parsing LLM JSON output: {e}. Raw data: {raw_data if raw_data else 'not loaded'}")
+    raw_data = extract_json_object(llm_json_text)
+    if raw_data is None:
+        logger.error("No JSON object found in the LLM output.")
+        log_payload(logger, "Problematic JSON string", llm_json_text, level=logging.ERROR)
         return default_response
 
-@app.post("/process-receipt")
-async def process_receipt(file: UploadFile = File(...)):
-    if not ocr_engine:
-        raise HTTPException(status_code=500, detail="PaddleOCR engine not initialized. Check server logs.")
+    amount = parse_amount(raw_data.get("amount"))
+    if amount is None and raw_data.get("amount") is not None:
+        logger.warning(f"Could not parse amount {raw_data.get('amount')!r}. Using 0.0.")
+    return {
+        "date": normalize_date(raw_data.get("date")),
+        "merchant": clean_text(raw_data.get("merchant")),
+        "amount": amount if amount is not None else default_response["amount"],
+        "category": pre_determined_category if pre_determined_category else clean_text(raw_data.get("category"), "Other"),
+        "is_deductible": parse_bool(raw_data.get("is_deductible"), default_response["is_deductible"]),
+        "deduction_type": clean_text(raw_data.get("deduction_type"), default_response["deduction_type"]),
+        "deduction_details": clean_text(raw_data.get("deduction_details"), default_response["deduction_details"]),
+    }
+
+# --- Receipt pipeline stages ---
+# Shared by /process-receipt and the pipelined /process-receipts batch endpoint. Each stage has its
+# own concurrency bound, so while one receipt is in OCR others can be waiting on the LLM or RAG.
+ocr_stage = asyncio.Semaphore(OCR_STAGE_CONCURRENCY)
+llm_stage = asyncio.Semaphore(LLM_STAGE_CONCURRENCY)
+rag_stage = asyncio.Semaphore(RAG_STAGE_CONCURRENCY)
+
+def ensure_pipeline_ready():
+    if not ocr_pool.available:
+        raise HTTPException(status_code=500, detail="No PaddleOCR workers are running. Check server logs.")
     if not hf_client:
         raise HTTPException(status_code=500, detail="Hugging Face client not initialized. Check HUGGING_FACE_API_TOKEN.")
     if not retriever:
         raise HTTPException(status_code=500, detail="TaxGuidelineRetriever not initialized. Check vector store path and server logs.")
 
+def resolve_content_type(file: UploadFile) -> str:
     file_content_type = file.content_type
     if file_content_type not in SUPPORTED_IMAGE_MIMETYPES:
         guessed_type, _ = mimetypes.guess_type(file.filename) if file.filename else (None, None)
@@ -191,197 +215,368 @@ async def process_receipt(file: UploadFile = File(...)):
                 status_code=400,
                 detail=f"Unsupported file type: {file_content_type or guessed_type or 'unknown'}. Please upload a JPG, PNG, WEBP, or BMP image."
             )
+    return file_content_type
+
+def decode_image(contents):
+    """Decodes from any buffer (bytes, memoryview, mmap) without copying the encoded image."""
+    nparr = np.frombuffer(contents, np.uint8)
+    img_np = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img_np is None:
+        raise HTTPException(status_code=400, detail="Could not decode image. File might be corrupted or an unsupported format.")
+    return img_np
+
+def normalize_image(img_np) -> Tuple[np.ndarray, int]:
+    """Preprocesses the image for OCR and computes its perceptual hash (on the normalized image, so crop and skew matter less)."""
+    if RECEIPT_PREPROCESSING_ENABLED:
+        # Downscale, grayscale, crop and deskew: OCR time grows with pixel count, phone photos are 12MP+
+        img_np, preprocessing_info = preprocess_receipt_image(img_np)
+        logger.info(f"Preprocessed receipt image: {preprocessing_info}")
+    return img_np, perceptual_hash(img_np)
+
+def duplicate_info(entry: dict, match: str) -> dict:
+    """What the response says about an earlier receipt of the same owner; entries of other owners never get here."""
+    return {
+        "filename": entry["filename"], "match": match, "distance": entry.get("distance", 0),
+        "processed_at": datetime.fromtimestamp(entry["processed_at"]).isoformat(timespec="seconds"),
+        "date": entry["result"].get("date", ""), "merchant": entry["result"].get("merchant", ""),
+        "amount": entry["result"].get("amount", 0.0),
+    }
 
-    extracted_text = "" 
-    extracted_category_from_llm = "Other" 
-    llm_response_data = {} 
+def duplicate_fields(similar: Optional[dict]) -> dict:
+    return {"possible_duplicate": similar is not None, "duplicate_of": duplicate_info(similar, "perceptual") if similar else None}
 
-    try:
-        contents = await file.read()
-        
-        # --- Step 1: Extracting text with PaddleOCR ---
-        print("Step 1: Extracting text with PaddleOCR...")
-        nparr = np.frombuffer(contents, np.uint8)
-        img_np = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img_np is None:
-            raise HTTPException(status_code=400, detail="Could not decode image. File might be corrupted or an unsupported format.")
-
-        ocr_result_raw = ocr_engine.predict(img_np)
-        
-        lines = []
-        if ocr_result_raw and isinstance(ocr_result_raw, list) and len(ocr_result_raw) > 0:
-            image_data_level = ocr_result_raw[0] 
-            
-            if isinstance(image_data_level, list) and \
-               all(isinstance(line_item, list) and len(line_item) == 2 and isinstance(line_item[1], tuple) and len(line_item[1]) == 2 for line_item in image_data_level if line_item):
-                for line_item in image_data_level:
-                    if line_item: lines.append(line_item[1][0])
-            elif isinstance(image_data_level, dict) and 'rec_texts' in image_data_level: 
-                if isinstance(image_data_level['rec_texts'], list):
-                    lines.extend(image_data_level['rec_texts'])
-            elif isinstance(image_data_level, dict) and 'rec_res' in image_data_level: 
-                for text_info_outer in image_data_level['rec_res']:
-                    if isinstance(text_info_outer, tuple) and len(text_info_outer) > 0 and isinstance(text_info_outer[0], str):
-                        lines.append(text_info_outer[0])
-            else: 
-                try:
-                    for item in image_data_level: 
-                        if isinstance(item, str):
-                            lines.append(item)
-                        elif isinstance(item, (list, tuple)) and len(item) > 0 and isinstance(item[0], str):
-                             lines.append(item[0]) 
-                        elif isinstance(item, (list, tuple)) and len(item) > 1 and isinstance(item[1], str):
-                             lines.append(item[1]) 
-                except TypeError: 
-                    print(f"Warning: Unexpected OCR result structure from predict(): {type(image_data_level)}")
-
-        extracted_text = "\n".join(lines)
-        print(f"\n--- PaddleOCR Extracted Text --- \n'{extracted_text}'\n---------------------------------")
+async def run_ocr(img_np) -> Tuple[str, dict]:
+    """Returns the extracted text and the full OCR result ({"lines", "boxes", "scores"}) for layout analysis."""
+    logger.info("Step 1: Extracting text with PaddleOCR...")
 
-        if not extracted_text.strip():
-            print("Warning: PaddleOCR did not extract any meaningful text.")
-            return JSONResponse(content={
-                "filename": file.filename, "ocr_text": extracted_text,
-                "date": "", "merchant": "", "amount": 0.0, "category": "Other",
-                "is_deductible": False, "deduction_type": "N/A",
-                "deduction_details": "OCR failed to extract text or text was empty."
-            })
-
-        # --- Step 2a: First LLM call to determine category ---
-        print(f"Step 2a: Sending request to Mistral LLM ('{MISTRAL_MODEL_ID}') for category extraction...")
-        category_prompt_text = f"""
-        Based on the following text extracted from a receipt, determine the most appropriate primary expense category.
-        Focus on the main items or services purchased.
-        Consider categories like: 'Books & Publications', 'Computer & IT Equipment', 'Software & Subscriptions', 'Groceries', 'Meals & Entertainment', 'Utilities (Electricity, Water, Internet)', 'Transportation (Fuel, Parking, Public Transport)', 'Office Supplies & Stationery', 'Travel (Flights, Accommodation)', 'Healthcare & Medical', 'Professional Fees (Legal, Accounting)', 'Education & Training', 'Charitable Contributions', 'Repairs & Maintenance', 'Rentals', 'Financial Costs (Bank Charges)', 'Insurance', 'Gifts & Donations (Non-charitable)', 'Personal Care', 'Clothing & Apparel', 'Home & Furnishing', 'Other'.
-        If the text is unclear, very short, or nonsensical, output 'Other'.
-        Provide only the category name as a single string.
-
-        Extracted text:
-        ---
-        {extracted_text}
-        ---
-        
-        Category:
-        """
-        
-        extracted_category_from_llm = "Other" 
-        try:
-            category_prompt_full = f"[INST] {category_prompt_text.strip()} [/INST]"
-            category_response_raw = hf_client.text_generation(
+    # Without OCR there is nothing to return, so running out of time here fails the request
+    async with stage_slot(ocr_stage, "OCR"):
+        ocr_result = await within_deadline(ocr_pool.run(img_np), "OCR")
+    extracted_text = "\n".join(ocr_result["lines"])
+    log_payload(logger, "PaddleOCR Extracted Text", extracted_text)
+    return extracted_text, ocr_result
+
+def empty_ocr_response(filename: str, extracted_text: str) -> dict:
+    return {
+        "filename": filename, "ocr_text": extracted_text,
+        "date": "", "merchant": "", "amount": 0.0, "category": "Other",
+        "is_deductible": False, "deduction_type": "N/A",
+        "deduction_details": "OCR failed to extract text or text was empty."
+    }
+
+def not_assessed_fields(layout_fields, extracted_category_from_llm: str) -> dict:
+    """OCR-only result for a receipt whose LLM stages were cut by the request deadline."""
+    return {
+        **layout_fields.as_fields(), "category": extracted_category_from_llm,
+        "is_deductible": False, "deduction_type": "N/A",
+        "deduction_details": "Not assessed: the request deadline was reached before the tax assessment.",
+    }
+
+async def extract_category(extracted_text: str) -> str:
+    """Step 2a: determine the expense category, locally when the classifier is enabled and confident, otherwise with a first LLM call."""
+    local_category, confidence = category_classifier.predict(extracted_text) if category_classifier else (None, 0.0)
+    if local_category and confidence >= CATEGORY_CONFIDENCE_THRESHOLD:
+        CATEGORY_SOURCE.labels(source="classifier").inc()
+        logger.info(f"--- Local classifier category: {local_category} (confidence {confidence:.3f}); skipping the LLM call ---")
+        return local_category
+    if category_classifier:
+        logger.info(f"Local classifier not confident ({local_category}, {confidence:.3f}).")
+    # Leave time for the extraction or deductibility call that follows
+    if not time_allows(2 * DEADLINE_MIN_LLM_CALL_SECONDS):
+        cut_stage("category_llm", "not enough time left for two LLM calls")
+        return "Other"
+    CATEGORY_SOURCE.labels(source="llm").inc()
+    logger.info(f"Step 2a: Sending request to Mistral LLM ('{MISTRAL_MODEL_ID}') for category extraction...")
+    category_prompt_text = f"""
+    Based on the following text extracted from a receipt, determine the most appropriate primary expense category.
+    Focus on the main items or services purchased.
+    Consider categories like: 'Books & Publications', 'Computer & IT Equipment', 'Software & Subscriptions', 'Groceries', 'Meals & Entertainment', 'Utilities (Electricity, Water, Internet)', 'Transportation (Fuel, Parking, Public Transport)', 'Office Supplies & Stationery', 'Travel (Flights, Accommodation)', 'Healthcare & Medical', 'Professional Fees (Legal, Accounting)', 'Education & Training', 'Charitable Contributions', 'Repairs & Maintenance', 'Rentals', 'Financial Costs (Bank Charges)', 'Insurance', 'Gifts & Donations (Non-charitable)', 'Personal Care', 'Clothing & Apparel', 'Home & Furnishing', 'Other'.
+    If the text is unclear, very short, or nonsensical, output 'Other'.
+    Provide only the category name as a single string.
+
+    Extracted text:
+    ---
+    {extracted_text}
+    ---
+
+    Category:
+    """
+
+    extracted_category_from_llm = "Other" 
+    try:
+        category_prompt_full = f"[INST] {category_prompt_text.strip()} [/INST]"
+        async with stage_slot(llm_stage, "the LLM"):
+            category_response_raw = await hf_client.text_generation(
                 prompt=category_prompt_full, max_new_tokens=30, 
                 temperature=0.1, do_sample=False, return_full_text=False
             )
-            category_response = category_response_raw.strip().replace('"', '') if category_response_raw else ""
-            
-            if category_response:
-                extracted_category_from_llm = category_response
-            else:
-                 print("Warning: LLM returned an empty category. Defaulting to 'Other'.")
-            print(f"--- LLM Extracted Category: {extracted_category_from_llm} ---")
-
-        except Exception as cat_llm_e:
-            print(f"Error calling Hugging Face Inference API for category extraction: {cat_llm_e}")
-            print("Warning: Defaulting to category 'Other' due to LLM error for category extraction.")
-        
-        # --- Step 2b: Formulate RAG query using the extracted category ---
-        print(f"Step 2b: Formulating RAG query with category: {extracted_category_from_llm}...")
+        category_response = category_response_raw.strip().replace('"', '') if category_response_raw else ""
         
-        if extracted_category_from_llm.lower() == "other" or not extracted_category_from_llm:
-            rag_query = f"General tax deductibility guidelines for personal or business expenses in Malaysia under Income Tax Act 1967, for items such as: {extracted_text[:100]}"
+        if category_response:
+            extracted_category_from_llm = category_response
         else:
-            rag_query = f"Tax deductibility guidelines for '{extracted_category_from_llm}' expenses for individuals or businesses in Malaysia under the Income Tax Act 1967."
-
-        # --- Step 2c: Retrieve relevant tax guidelines ---
-        print(f"Step 2c: Retrieving tax guidelines with RAG query: '{rag_query}'...")
-        dynamic_malaysian_tax_guidelines = "No specific guidelines retrieved from the Income Tax Act 1967. The LLM should indicate if deductibility cannot be determined based on provided guidelines."
-        try:
-            if retriever:
+             logger.warning("LLM returned an empty category. Defaulting to 'Other'.")
+        logger.info(f"--- LLM Extracted Category: {extracted_category_from_llm} ---")
+
+    except DeadlineExceeded as e:
+        cut_stage("category_llm", str(e))
+    except Exception as cat_llm_e:
+        logger.error(f"Error calling Hugging Face Inference API for category extraction: {cat_llm_e}")
+        logger.warning("Defaulting to category 'Other' due to LLM error for category extraction.")
+    return extracted_category_from_llm
+
+def build_rag_query(extracted_category_from_llm: str, extracted_text: str) -> str:
+    """Step 2b: formulate the RAG query from the extracted category."""
+    logger.info(f"Step 2b: Formulating RAG query with category: {extracted_category_from_llm}...")
+    if extracted_category_from_llm.lower() == "other" or not extracted_category_from_llm:
+        return f"General tax deductibility guidelines for personal or business expenses in Malaysia under Income Tax Act 1967, for items such as: {extracted_text[:100]}"
+    return f"Tax deductibility guidelines for '{extracted_category_from_llm}' expenses for individuals or businesses in Malaysia under the Income Tax Act 1967."
+
+NO_GUIDELINES_MESSAGE = "No specific guidelines retrieved from the Income Tax Act 1967. The LLM should indicate if deductibility cannot be determined based on provided guidelines."
+
+async def retrieve_guidelines(rag_query: str, extracted_category_from_llm: str) -> str:
+    """Step 2c: retrieve relevant tax guidelines."""
+    logger.info(f"Step 2c: Retrieving tax guidelines with RAG query: '{rag_query}'...")
+    dynamic_malaysian_tax_guidelines = NO_GUIDELINES_MESSAGE
+    try:
+        if retriever:
+            async with stage_slot(rag_stage, "guideline retrieval"):
                 relevant_guidelines = await retriever.search_guidelines(rag_query, top_k=3) 
-                if relevant_guidelines and not any("Error: Vector store not available" in guideline for guideline in relevant_guidelines):
-                    dynamic_malaysian_tax_guidelines = "\n\n".join(relevant_guidelines) 
-                else:
-                    dynamic_malaysian_tax_guidelines = f"No specific guidelines found for the category '{extracted_category_from_llm}' in the Income Tax Act 1967. The LLM should indicate if deductibility cannot be determined from these guidelines."
-                print(f"\n--- Retrieved Tax Guidelines for RAG ---\n{dynamic_malaysian_tax_guidelines}\n-----------------------------------------")
+            if relevant_guidelines and not any("Error: Vector store not available" in guideline for guideline in relevant_guidelines):
+                dynamic_malaysian_tax_guidelines = "\n\n".join(relevant_guidelines) 
             else:
-                print("Warning: TaxGuidelineRetriever was not initialized. Using fallback guidelines message.")
-        except Exception as e:
-            print(f"Error retrieving guidelines: {e}")
-        
-        # --- Step 3: Second LLM call for full structured data extraction and deductibility ---
-        print(f"Step 3: Sending request to Mistral LLM ('{MISTRAL_MODEL_ID}') for full structured data extraction and deductibility assessment...")
-        
-        text_prompt_final = f"""
-        You are an AI assistant processing a receipt.
-        The expense category for this receipt has been pre-determined as: '{extracted_category_from_llm}'.
-
-        From the "Extracted text" of the receipt provided below, please:
-        1. Extract the merchant name (string, or "N/A" if not found).
-        2. Extract the final total amount payable, often labeled as 'Gross Amount', 'Total', or 'Grand Total' (float, or 0.0 if not found/parsable).
-        3. Extract the date (string, format as<y_bin_46>-MM-DD if possible; otherwise, use original format or "N/A" if not found).
-
-        Then, using EXCLUSIVELY the "Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967)" provided below:
-        a. Determine if an expense of category '{extracted_category_from_llm}' is potentially tax-deductible under these specific guidelines (is_deductible: true or false).
-        b. If deductible, specify if it's generally considered a 'personal relief', 'business expense', or 'capital allowance for business' based on the provided guidelines (deduction_type: "personal relief", "business expense", "capital allowance for business", "N/A" if not deductible, or "unclear from guidelines" if guidelines are ambiguous on type).
-        c. Briefly state the main conditions, limits, or relevant section (e.g., "Section 46(1)(p) for lifestyle relief up to RM2500 for personal computers" or "Schedule 3 for plant and machinery used in business") for the deduction if explicitly mentioned in the provided guidelines (deduction_details: "string" or "N/A"). If not deductible or no specific details are found in the provided guidelines, use "Not deductible based on provided guidelines" or "No specific conditions/details found in provided guidelines."
-
-        IMPORTANT: Base your tax deductibility assessment (is_deductible, deduction_type, deduction_details) *solely and strictly* on the "Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967)" provided below. Do NOT use any external knowledge or general assumptions about tax laws. If the provided guidelines are insufficient, unclear, or do not cover this category for deductibility, then 'is_deductible' should be false, and 'deduction_details' should reflect this lack of information from the provided guidelines.
-
-        Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967):
-        --- Start Guidelines ---
-        {dynamic_malaysian_tax_guidelines}
-        --- End Guidelines ---
-
-        Extracted text:
-        ---
-        {extracted_text}
-        ---
-
-        Provide the output STRICTLY in JSON format with ONLY the following keys: "category", "merchant", "amount", "date", "is_deductible", "deduction_type", "deduction_details".
-        The "category" in the JSON output MUST be "{extracted_category_from_llm}".
-        The "amount" MUST be a float (e.g., 123.45 or 0.0 if not found/parsable), representing the final total/gross amount.
-        The "is_deductible" MUST be a boolean (true or false).
-        Do NOT include any explanatory text, apologies, or markdown code fences (```json ... ```) before or after the JSON object itself. Ensure the JSON is valid.
-
-        JSON Output:
-        """
-        
-        structured_data_json_text = ""
-        try:
-            full_prompt_for_text_generation = f"[INST] {text_prompt_final.strip()} [/INST]"
-            response_raw = hf_client.text_generation(
+                dynamic_malaysian_tax_guidelines = f"No specific guidelines found for the category '{extracted_category_from_llm}' in the Income Tax Act 1967. The LLM should indicate if deductibility cannot be determined from these guidelines."
+            log_payload(logger, "Retrieved Tax Guidelines for RAG", dynamic_malaysian_tax_guidelines)
+        else:
+            logger.warning("TaxGuidelineRetriever was not initialized. Using fallback guidelines message.")
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Error retrieving guidelines: {e}")
+    return dynamic_malaysian_tax_guidelines
+
+async def extract_structured_data(extracted_text: str, extracted_category_from_llm: str, dynamic_malaysian_tax_guidelines: str) -> dict:
+    """Step 3: second LLM call, for full structured data extraction and deductibility assessment."""
+    logger.info(f"Step 3: Sending request to Mistral LLM ('{MISTRAL_MODEL_ID}') for full structured data extraction and deductibility assessment...")
+    
+    text_prompt_final = f"""
+    You are an AI assistant processing a receipt.
+    The expense category for this receipt has been pre-determined as: '{extracted_category_from_llm}'.
+
+    From the "Extracted text" of the receipt provided below, please:
+    1. Extract the merchant name (string, or "N/A" if not found).
+    2. Extract the final total amount payable, often labeled as 'Gross Amount', 'Total', or 'Grand Total' (float, or 0.0 if not found/parsable).
+    3. Extract the date (string, format as<y_bin_46>-MM-DD if possible; otherwise, use original format or "N/A" if not found).
+
+    Then, using EXCLUSIVELY the "Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967)" provided below:
+    a. Determine if an expense of category '{extracted_category_from_llm}' is potentially tax-deductible under these specific guidelines (is_deductible: true or false).
+    b. If deductible, specify if it's generally considered a 'personal relief', 'business expense', or 'capital allowance for business' based on the provided guidelines (deduction_type: "personal relief", "business expense", "capital allowance for business", "N/A" if not deductible, or "unclear from guidelines" if guidelines are ambiguous on type).
+    c. Briefly state the main conditions, limits, or relevant section (e.g., "Section 46(1)(p) for lifestyle relief up to RM2500 for personal computers" or "Schedule 3 for plant and machinery used in business") for the deduction if explicitly mentioned in the provided guidelines (deduction_details: "string" or "N/A"). If not deductible or no specific details are found in the provided guidelines, use "Not deductible based on provided guidelines" or "No specific conditions/details found in provided guidelines."
+
+    IMPORTANT: Base your tax deductibility assessment (is_deductible, deduction_type, deduction_details) *solely and strictly* on the "Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967)" provided below. Do NOT use any external knowledge or general assumptions about tax laws. If the provided guidelines are insufficient, unclear, or do not cover this category for deductibility, then 'is_deductible' should be false, and 'deduction_details' should reflect this lack of information from the provided guidelines.
+
+    Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967):
+    --- Start Guidelines ---
+    {dynamic_malaysian_tax_guidelines}
+    --- End Guidelines ---
+
+    Extracted text:
+    ---
+    {extracted_text}
+    ---
+
+    Provide the output STRICTLY in JSON format with ONLY the following keys: "category", "merchant", "amount", "date", "is_deductible", "deduction_type", "deduction_details".
+    The "category" in the JSON output MUST be "{extracted_category_from_llm}".
+    The "amount" MUST be a float (e.g., 123.45 or 0.0 if not found/parsable), representing the final total/gross amount.
+    The "is_deductible" MUST be a boolean (true or false).
+    Do NOT include any explanatory text, apologies, or markdown code fences (```json ... ```) before or after the JSON object itself. Ensure the JSON is valid.
+
+    JSON Output:
+    """
+    
+    structured_data_json_text = ""
+    try:
+        full_prompt_for_text_generation = f"[INST] {text_prompt_final.strip()} [/INST]"
+        async with stage_slot(llm_stage, "the LLM"):
+            response_raw = await hf_client.text_generation(
                 prompt=full_prompt_for_text_generation, max_new_tokens=600, 
                 temperature=0.05, do_sample=False, return_full_text=False
             )
-            structured_data_json_text = response_raw.strip() if response_raw else ""
-            
-            if not structured_data_json_text:
-                print("Warning: Mistral LLM returned an empty response for full extraction.")
-                llm_response_data = parse_llm_json_output("{}", pre_determined_category=extracted_category_from_llm)
-            else:
-                llm_response_data = parse_llm_json_output(structured_data_json_text, pre_determined_category=extracted_category_from_llm)
-
-        except Exception as llm_e:
-            print(f"Error calling Hugging Face Inference API for full extraction: {llm_e}")
+        structured_data_json_text = response_raw.strip() if response_raw else ""
+        
+        if not structured_data_json_text:
+            logger.warning("Mistral LLM returned an empty response for full extraction.")
             llm_response_data = parse_llm_json_output("{}", pre_determined_category=extracted_category_from_llm)
-
-        print(f"\n--- Mistral LLM Structured JSON Output (Raw) --- \n{structured_data_json_text}\n--------------------------------------- ")
-        print(f"--- Parsed LLM Data (After RAG) --- \n{llm_response_data}\n-----------------------------------------")
-                
-        response_data = {
-            "filename": file.filename,
+        else:
+            llm_response_data = parse_llm_json_output(structured_data_json_text, pre_determined_category=extracted_category_from_llm)
+
+    except DeadlineExceeded:
+        raise
+    except Exception as llm_e:
+        logger.error(f"Error calling Hugging Face Inference API for full extraction: {llm_e}")
+        llm_response_data = parse_llm_json_output("{}", pre_determined_category=extracted_category_from_llm)
+
+    log_payload(logger, "Mistral LLM Structured JSON Output (Raw)", structured_data_json_text)
+    log_payload(logger, "Parsed LLM Data (After RAG)", llm_response_data)
+    return llm_response_data
+
+# Tasks rather than results, so concurrent receipts of the same category share one in-flight call
+deductibility_assessments: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+
+async def request_deductibility_assessment(extracted_category_from_llm: str, dynamic_malaysian_tax_guidelines: str) -> dict:
+    """Step 3 (fast path): LLM call on the category and guidelines only; the receipt text does not affect deductibility."""
+    logger.info(f"Step 3: Requesting deductibility assessment for category '{extracted_category_from_llm}'...")
+    assessment_prompt_text = f"""
+    You are an AI assistant assessing the tax deductibility of an expense category in Malaysia.
+    The expense category is: '{extracted_category_from_llm}'.
+
+    Using EXCLUSIVELY the "Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967)" provided below:
+    a. Determine if an expense of category '{extracted_category_from_llm}' is potentially tax-deductible under these specific guidelines (is_deductible: true or false).
+    b. If deductible, specify if it's generally considered a 'personal relief', 'business expense', or 'capital allowance for business' based on the provided guidelines (deduction_type: "personal relief", "business expense", "capital allowance for business", "N/A" if not deductible, or "unclear from guidelines" if guidelines are ambiguous on type).
+    c. Briefly state the main conditions, limits, or relevant section for the deduction if explicitly mentioned in the provided guidelines (deduction_details: "string" or "N/A"). If not deductible or no specific details are found in the provided guidelines, use "Not deductible based on provided guidelines" or "No specific conditions/details found in provided guidelines."
+
+    IMPORTANT: Base your assessment *solely and strictly* on the guidelines below. Do NOT use any external knowledge or general assumptions about tax laws. If the provided guidelines are insufficient, unclear, or do not cover this category, then 'is_deductible' should be false, and 'deduction_details' should reflect this lack of information from the provided guidelines.
+
+    Malaysian Tax Deduction Guidelines (from the Income Tax Act 1967):
+    --- Start Guidelines ---
+    {dynamic_malaysian_tax_guidelines}
+    --- End Guidelines ---
+
+    Provide the output STRICTLY in JSON format with ONLY the following keys: "is_deductible", "deduction_type", "deduction_details".
+    The "is_deductible" MUST be a boolean (true or false).
+    Do NOT include any explanatory text or markdown code fences before or after the JSON object itself.
+
+    JSON Output:
+    """
+    async with stage_slot(llm_stage, "the LLM"):
+        response_raw = await hf_client.text_generation(
+            prompt=f"[INST] {assessment_prompt_text.strip()} [/INST]", max_new_tokens=300,
+            temperature=0.05, do_sample=False, return_full_text=False
+        )
+    log_payload(logger, "Mistral LLM Deductibility Assessment (Raw)", response_raw)
+    parsed = parse_llm_json_output(response_raw or "{}", pre_determined_category=extracted_category_from_llm)
+    if parsed["deduction_details"] == "N/A" and parsed["deduction_type"] == "N/A" and not parsed["is_deductible"]:
+        # Indistinguishable from the parse failure default; do not let it be reused
+        raise ValueError("Deductibility assessment could not be parsed.")
+    return {key: parsed[key] for key in ("is_deductible", "deduction_type", "deduction_details")}
+
+async def assess_deductibility(extracted_category_from_llm: str, dynamic_malaysian_tax_guidelines: str) -> dict:
+    key = hashlib.sha256(f"{extracted_category_from_llm}\n{dynamic_malaysian_tax_guidelines}".encode("utf-8")).hexdigest()
+    task = deductibility_assessments.get(key)
+    if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+        # Shared with later receipts, so it runs outside this request's deadline; each caller bounds its own wait
+        task = asyncio.create_task(without_deadline(request_deductibility_assessment(extracted_category_from_llm, dynamic_malaysian_tax_guidelines)))
+        deductibility_assessments[key] = task
+        while len(deductibility_assessments) > DEDUCTIBILITY_CACHE_MAX_ENTRIES:
+            deductibility_assessments.popitem(last=False)
+    else:
+        deductibility_assessments.move_to_end(key)
+    try:
+        return await within_deadline(asyncio.shield(task), "the deductibility assessment")
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        if deductibility_assessments.get(key) is task:
+            del deductibility_assessments[key]
+        raise
+
+async def process_receipt_image(filename: str, contents: bytes, guideline_lookup=retrieve_guidelines, owner: str = "") -> Tuple[int, dict]:
+    """
+    Runs one receipt through OCR -> category LLM -> RAG -> extraction LLM.
+    Returns (status_code, payload); undecodable images raise HTTPException(400).
+    `owner` (the X-User-Id header, "" when absent) scopes duplicate detection to that user's receipts.
+    Within a request deadline, stages that would not fit are cut: the category falls back to
+    'Other', RAG is skipped, and with no time for an LLM call the layout (OCR-only) fields are
+    returned. Running out of time before OCR finishes raises DeadlineExceeded.
+    """
+    extracted_text = "" 
+    extracted_category_from_llm = "Other" 
+    try:
+        receipt_key = content_hash(contents)
+        cached = await receipt_cache.get(receipt_key, owner)
+        if cached and cached["own"]:
+            logger.info(f"Receipt '{filename}' is a re-upload of '{cached['filename']}'; returning the cached result.")
+            return 200, {**cached["result"], "filename": filename,
+                         "possible_duplicate": True, "duplicate_of": duplicate_info(cached, "exact")}
+        if cached:
+            # The same file processed for someone else: reuse the result, compare only with this owner's receipts
+            logger.info(f"Receipt '{filename}' was processed before; returning the cached result.")
+            result = {**cached["result"], "filename": filename}
+            similar = await receipt_cache.find_duplicate(cached["image_hash"], owner)
+            if owner:
+                await receipt_cache.put(receipt_key, cached["image_hash"], filename, result, owner)
+            return 200, {**result, **duplicate_fields(similar)}
+
+        img_np = decode_image(contents)
+        img_np, image_hash = await asyncio.to_thread(normalize_image, img_np)
+        similar = await receipt_cache.find_duplicate(image_hash, owner)
+        if similar:
+            logger.info(f"Receipt '{filename}' looks like '{similar['filename']}' (hash distance {similar['distance']}).")
+
+        extracted_text, ocr_result = await run_ocr(img_np)
+        if not extracted_text.strip():
+            logger.warning("PaddleOCR did not extract any meaningful text.")
+            return 200, {**empty_ocr_response(filename, extracted_text), **duplicate_fields(similar)}
+
+        layout_fields = extract_receipt_fields(ocr_result)
+        extracted_category_from_llm = await extract_category(extracted_text)
+        rag_query = build_rag_query(extracted_category_from_llm, extracted_text)
+        dynamic_malaysian_tax_guidelines = None
+        if time_allows(DEADLINE_MIN_RAG_SECONDS + DEADLINE_MIN_LLM_CALL_SECONDS):
+            try:
+                dynamic_malaysian_tax_guidelines = await within_deadline(guideline_lookup(rag_query, extracted_category_from_llm), "guideline retrieval")
+            except DeadlineExceeded as e:
+                cut_stage("rag", str(e))
+        else:
+            cut_stage("rag", "not enough time left for retrieval and an LLM call")
+        llm_response_data = None
+        if not time_allows(DEADLINE_MIN_LLM_CALL_SECONDS):
+            cut_stage("extraction", "not enough time left for an LLM call")
+            llm_response_data = not_assessed_fields(layout_fields, extracted_category_from_llm)
+        elif RECEIPT_LAYOUT_FAST_PATH_ENABLED and layout_fields.confident:
+            logger.info(f"Layout extractor is confident ({layout_fields.as_fields()}); skipping the LLM extraction call.")
+            if dynamic_malaysian_tax_guidelines is None:
+                # Without guidelines the assessment could only say "cannot be determined"
+                llm_response_data = not_assessed_fields(layout_fields, extracted_category_from_llm)
+                EXTRACTION_PATH.labels(path="layout").inc()
+            else:
+                try:
+                    deductibility = await assess_deductibility(extracted_category_from_llm, dynamic_malaysian_tax_guidelines)
+                    llm_response_data = {**layout_fields.as_fields(), "category": extracted_category_from_llm, **deductibility}
+                    EXTRACTION_PATH.labels(path="layout").inc()
+                except DeadlineExceeded as e:
+                    cut_stage("deductibility", str(e))
+                    llm_response_data = not_assessed_fields(layout_fields, extracted_category_from_llm)
+                except Exception as e:
+                    logger.error(f"Deductibility assessment failed ({e}); falling back to full LLM extraction.")
+        elif RECEIPT_LAYOUT_FAST_PATH_ENABLED:
+            logger.info(f"Layout extractor not confident: {'; '.join(layout_fields.notes)}")
+        if llm_response_data is None:
+            EXTRACTION_PATH.labels(path="llm").inc()
+            try:
+                llm_response_data = await extract_structured_data(
+                    extracted_text, extracted_category_from_llm,
+                    dynamic_malaysian_tax_guidelines or NO_GUIDELINES_MESSAGE)
+            except DeadlineExceeded as e:
+                cut_stage("extraction", str(e))
+                llm_response_data = not_assessed_fields(layout_fields, extracted_category_from_llm)
+        result = {
+            "filename": filename,
             "ocr_text": extracted_text,
             **llm_response_data
         }
-        return JSONResponse(content=response_data)
-            
-    except HTTPException as http_exc:
-        raise http_exc 
+        # An empty merchant with a zero amount is what a failed LLM call degrades to; retry those next time.
+        # Results degraded to meet a deadline are not cached either
+        if (result["merchant"] or result["amount"]) and not cut_stages():
+            await receipt_cache.put(receipt_key, image_hash, filename, result, owner)
+        return 200, {**result, **duplicate_fields(similar)}
+
+    except (HTTPException, DeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"Critical error processing receipt: {e}")
-        import traceback
-        traceback.print_exc()
-        default_error_response = {
-            "filename": file.filename if file and hasattr(file, 'filename') else "N/A",
+        logger.exception(f"Critical error processing receipt: {e}")
+        return 500, {
+            "filename": filename or "N/A",
             "ocr_text": extracted_text,
             "date": "", "merchant": "", "amount": 0.0,
             "category": extracted_category_from_llm,
@@ -389,13 +584,136 @@ async def process_receipt(file: UploadFile = File(...)):
             "deduction_type": "N/A",
             "deduction_details": f"Internal server error: {str(e)}"
         }
-        return JSONResponse(status_code=500, content=default_error_response)
+
+async def process_receipt_within(deadline: Deadline, filename: str, contents, guideline_lookup=retrieve_guidelines,
+                                 owner: str = "") -> Tuple[int, dict]:
+    """process_receipt_image under `deadline`; the payload gets a "deadline" entry listing the stages cut to meet it."""
+    with deadline_scope(deadline):
+        try:
+            status_code, payload = await process_receipt_image(filename, contents, guideline_lookup=guideline_lookup, owner=owner)
+        except DeadlineExceeded as e:
+            status_code, payload = 504, request_deadlines.exceeded(deadline, filename, e)
+    return status_code, {**payload, "deadline": deadline.summary()}
+
+# The deadline dependency is listed before admission so time spent queued counts against the budget
+@app.post("/process-receipt", dependencies=[Depends(request_deadlines.dependency), Depends(admission_controller.dependency(EXTRACTION))])
+async def process_receipt(file: UploadFile = File(...), deadline: Deadline = Depends(request_deadlines.dependency),
+                          x_user_id: Optional[str] = Header(None)):
+    ensure_pipeline_ready()
+    resolve_content_type(file)
+    with upload_buffer(file) as contents:
+        status_code, payload = await process_receipt_within(deadline, file.filename, contents, owner=x_user_id or "")
+    return JSONResponse(status_code=status_code, content=payload)
+
+@app.post("/process-receipts", dependencies=[Depends(request_deadlines.dependency), Depends(admission_controller.dependency(EXTRACTION))])
+async def process_receipts(files: List[UploadFile] = File(...), deadline: Deadline = Depends(request_deadlines.dependency),
+                           x_user_id: Optional[str] = Header(None)):
+    """
+    Batch variant of /process-receipt. Receipts are pipelined through the stages concurrently
+    (bounded per stage), guideline lookups are shared between receipts with the same RAG query,
+    and one NDJSON line per receipt is streamed back as soon as that receipt finishes:
+    {"index": <position in the upload>, "status_code": ..., "filename": ..., ...}
+    Each receipt gets the request's budget (X-Request-Timeout or the default) to itself, counted
+    only while it is being worked on: time spent queued behind the rest of the batch for an OCR,
+    LLM or RAG slot does not count, so the whole stream may take longer than the budget. Each line
+    lists the stages cut for that receipt, and its "deadline" entry the time it spent queued.
+    """
+    ensure_pipeline_ready()
+    if len(files) > MAX_RECEIPTS_PER_BATCH:
+        raise HTTPException(status_code=413, detail=f"Too many receipts in one batch ({len(files)}); the limit is {MAX_RECEIPTS_PER_BATCH}.")
+    for file in files:
+        resolve_content_type(file)
+    logger.info(f"Processing a batch of {len(files)} receipts.")
+
+    guideline_tasks: Dict[str, asyncio.Task] = {}
+
+    async def shared_guideline_lookup(rag_query: str, extracted_category_from_llm: str) -> str:
+        task = guideline_tasks.get(rag_query)
+        if task is None:
+            # Shared by the receipts of the batch, so it runs outside any one receipt's deadline; each bounds its own wait
+            task = guideline_tasks[rag_query] = asyncio.create_task(without_deadline(retrieve_guidelines(rag_query, extracted_category_from_llm)))
+        return await asyncio.shield(task)
+
+    async def process_one(index: int, filename: str, contents) -> dict:
+        try:
+            status_code, payload = await process_receipt_within(deadline.branch(), filename, contents,
+                                                                guideline_lookup=shared_guideline_lookup, owner=x_user_id or "")
+        except HTTPException as http_exc:
+            status_code, payload = http_exc.status_code, {"filename": filename, "detail": http_exc.detail}
+        return {"index": index, "status_code": status_code, **payload}
+
+    async def ndjson_results():
+        # FastAPI closes the uploads only once the response has been sent, so each one is read in place while streaming
+        with ExitStack() as upload_buffers:
+            tasks = [asyncio.create_task(process_one(index, file.filename, upload_buffers.enter_context(upload_buffer(file))))
+                     for index, file in enumerate(files)]
+            try:
+                for next_finished in asyncio.as_completed(tasks):
+                    yield json.dumps(await next_finished) + "\n"
+            finally:
+                for task in tasks + list(guideline_tasks.values()):
+                    task.cancel()
+                # The buffers are released on leaving the `with`, so no task may still be reading them
+                await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Batch of {len(files)} receipts done; {len(guideline_tasks)} distinct guideline lookups.")
+
+    return StreamingResponse(ndjson_results(), media_type="application/x-ndjson")
+
+
+async def run_receipt_job(contents: bytes, metadata: dict) -> Tuple[int, dict]:
+    try:
+        return await process_receipt_within(request_deadlines.new(JOB_DEADLINE_SECONDS), metadata["filename"], contents,
+                                            owner=metadata.get("owner", ""))
+    except HTTPException as http_exc:
+        return http_exc.status_code, {"filename": metadata["filename"], "detail": http_exc.detail}
+
+# Submit/poll mode: uploads are stored durably and processed by background workers, so the
+# result survives a dropped client connection
+receipt_jobs = JobQueue("receipt_processing", JOB_DB_PATH, run_receipt_job)
+
+@app.post("/jobs/process-receipt", status_code=202)
+async def submit_receipt_job(response: Response, file: UploadFile = File(...), callback_url: Optional[str] = Form(None),
+                             idempotency_key: Optional[str] = Header(None), x_user_id: Optional[str] = Header(None)):
+    """
+    Queues a receipt for processing and returns immediately with a job id. Poll GET /jobs/{job_id}
+    for the result, or pass callback_url to have the finished job POSTed there. Resubmitting with
+    the same Idempotency-Key header returns the original job (200) instead of queueing a new one;
+    reusing the key for a different file is refused (409). The job belongs to the X-User-Id it was
+    submitted with: keys are per user, and only that user can read the job.
+    """
+    ensure_pipeline_ready()
+    resolve_content_type(file)
+    with upload_buffer(file) as contents:
+        # Results carry the owner's duplicate matches, so one user's key never returns another user's job
+        job, created = await receipt_jobs.submit(contents, {"filename": file.filename}, idempotency_key, callback_url,
+                                                 owner=x_user_id or "")
+    if not created:
+        response.status_code = 200
+    return {**job.to_dict(), "status_url": f"/jobs/{job.job_id}"}
+
+@app.get("/jobs/{job_id}")
+async def get_receipt_job(job_id: str, x_user_id: Optional[str] = Header(None)):
+    """
+    Job status; once finished, status_code and result hold what /process-receipt would have returned.
+    Jobs of another X-User-Id are reported as not found.
+    """
+    job = await receipt_jobs.get(job_id, owner=x_user_id or "")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found. Finished jobs are kept for a limited time.")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics():
+    """Admission queue wait times and queue lengths in Prometheus text format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/")
 async def root():
     return {
         "message": "Receipt Processing API (PaddleOCR + Mistral + RAG) is running.",
-        "ocr_engine_status": "Initialized" if ocr_engine else "Failed to initialize",
+        "ocr_engine_status": "Initialized" if ocr_pool.available else "Failed to initialize",
+        "ocr_workers": ocr_pool.health(),
+        "result_cache": receipt_cache.stats(),
         "hf_client_status": "Initialized" if hf_client else "Failed to initialize (Check HUGGING_FACE_API_TOKEN)",
         "retriever_status": "Initialized" if retriever else "Failed to initialize (Check vector store)"
     }
@@ -404,7 +722,7 @@ if __name__ == "__main__":
     print("\n--- Environment Configuration ---")
     print(f"HUGGING_FACE_API_TOKEN: {'Configured' if HUGGING_FACE_API_TOKEN else 'NOT CONFIGURED'}")
     print(f"MISTRAL_MODEL_ID: {MISTRAL_MODEL_ID}")
-    print(f"PaddleOCR Engine: {'Initialized' if ocr_engine else 'Failed to initialize'}")
+    print(f"PaddleOCR worker processes: {OCR_POOL_SIZE}")
     print(f"TaxGuidelineRetriever: {'Initialized' if retriever else 'Failed to initialize'}")
     print("--------------------------------\n")
 
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# One PaddleOCR engine per worker process; by default one worker per OCR_THREADS_PER_WORKER cores
+OCR_THREADS_PER_WORKER = int(os.getenv("OCR_THREADS_PER_WORKER", "2"))
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // OCR_THREADS_PER_WORKER))))
+# A job running longer than this is treated as a hung worker: the worker is killed and restarted
+OCR_JOB_TIMEOUT_SECONDS = float(os.getenv("OCR_JOB_TIMEOUT_SECONDS", "120"))
+OCR_WORKER_START_TIMEOUT_SECONDS = float(os.getenv("OCR_WORKER_START_TIMEOUT_SECONDS", "300"))
+OCR_HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("OCR_HEALTH_CHECK_INTERVAL_SECONDS", "30"))
+
+WORKERS_ALIVE = Gauge("ocr_pool_workers_alive", "OCR worker processes that are up and ready.")
+WORKER_RESTARTS = Counter("ocr_pool_worker_restarts", "OCR worker processes restarted.", ["reason"])
+QUEUE_WAIT = Histogram("ocr_pool_queue_wait_seconds", "Time OCR jobs wait for a free worker.",
+                       buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+JOB_DURATION = Histogram("ocr_pool_job_duration_seconds", "OCR time per image inside a worker.",
+                         buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 60.0))
+
+class OCRWorkerError(Exception):
+    """An OCR job failed because its worker crashed, hung or could not be started."""
+
+def flatten_ocr_result(ocr_result_raw) -> Dict[str, list]:
+    """
+    Normalizes the various PaddleOCR result layouts (2.x nested lists, 3.x result dicts) into
+    parallel lists: text `lines`, their `boxes` (4 [x, y] points, when available) and `scores`.
+    Only plain lists are returned so results can be sent back from the worker processes.
+    """
+    lines, boxes, scores = [], [], []
+    if ocr_result_raw and isinstance(ocr_result_raw, list) and len(ocr_result_raw) > 0:
+        image_data_level = ocr_result_raw[0]
+
+        if isinstance(image_data_level, list) and \
+           all(isinstance(line_item, list) and len(line_item) == 2 and isinstance(line_item[1], tuple) and len(line_item[1]) == 2 for line_item in image_data_level if line_item):
+            for line_item in image_data_level:
+                if line_item:
+                    lines.append(line_item[1][0])
+                    scores.append(float(line_item[1][1]))
+                    boxes.append(np.asarray(line_item[0], dtype=float).tolist())
+        elif hasattr(image_data_level, "get") and image_data_level.get('rec_texts') is not None:
+            if isinstance(image_data_level['rec_texts'], list):
+                lines.extend(image_data_level['rec_texts'])
+                scores.extend(float(score) for score in (image_data_level.get('rec_scores') or []))
+                polys = image_data_level.get('rec_polys')
+                if polys is None:
+                    polys = image_data_level.get('dt_polys')
+                if polys is not None:
+                    boxes.extend(np.asarray(poly, dtype=float).tolist() for poly in polys)
+        elif hasattr(image_data_level, "get") and image_data_level.get('rec_res') is not None:
+            for text_info_outer in image_data_level['rec_res']:
+                if isinstance(text_info_outer, tuple) and len(text_info_outer) > 0 and isinstance(text_info_outer[0], str):
+                    lines.append(text_info_outer[0])
+        else:
+            try:
+                for item in image_data_level:
+                    if isinstance(item, str):
+                        lines.append(item)
+                    elif isinstance(item, (list, tuple)) and len(item) > 0 and isinstance(item[0], str):
+                         lines.append(item[0])
+                    elif isinstance(item, (list, tuple)) and len(item) > 1 and isinstance(item[1], str):
+                         lines.append(item[1])
+            except TypeError:
+                logger.warning(f"Unexpected OCR result structure from predict(): {type(image_data_level)}")
+    # Boxes and scores are only meaningful when they line up with every text line
+    if len(boxes) != len(lines):
+        boxes = []
+    if len(scores) != len(lines):
+        scores = []
+    return {"lines": lines, "boxes": boxes, "scores": scores}
+
+def _worker_main(conn, engine_kwargs: Dict[str, Any], threads: int):
+    """Entry point of a worker process: owns one PaddleOCR engine and serves jobs from its pipe."""
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    try:
+        from paddleocr import PaddleOCR
+        engine = PaddleOCR(**engine_kwargs)
+    except Exception as e:
+        conn.send(("error", f"Could not initialize PaddleOCR: {type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message is None:
+            return
+        kind, payload = message
+        if kind == "ping":
+            conn.send(("pong", None))
+            continue
+        started = time.perf_counter()
+        try:
+            result = flatten_ocr_result(engine.predict(payload))
+            conn.send(("ok", (result, time.perf_counter() - started)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class _Worker:
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.process = None
+        self.conn = None
+        self.ready = False
+
+    def _receive(self, timeout: float):
+        """Waits for the worker's reply, noticing a crashed process instead of blocking forever."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.conn.poll(0.5):
+                try:
+                    return self.conn.recv()
+                except EOFError:
+                    raise OCRWorkerError(f"OCR worker {self.worker_id} closed its pipe (exit code {self.process.exitcode}).")
+            if not self.process.is_alive():
+                raise OCRWorkerError(f"OCR worker {self.worker_id} exited with code {self.process.exitcode}.")
+        raise OCRWorkerError(f"OCR worker {self.worker_id} did not respond within {timeout:.0f}s.")
+
+    def start(self, context, engine_kwargs: Dict[str, Any], threads: int):
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, engine_kwargs, threads),
+                                       name=f"ocr-worker-{self.worker_id}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        kind, payload = self._receive(OCR_WORKER_START_TIMEOUT_SECONDS)
+        if kind != "ready":
+            self.stop()
+            raise OCRWorkerError(f"OCR worker {self.worker_id} failed to start: {payload}")
+        self.ready = True
+        logger.info(f"OCR worker {self.worker_id} ready (pid {payload}).")
+
+    def stop(self):
+        self.ready = False
+        if self.conn is not None:
+            try:
+                self.conn.send(None)
+            except (OSError, EOFError):
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join(timeout=5)
+            self.process = None
+
+    def call(self, kind: str, payload: Any, timeout: float):
+        try:
+            self.conn.send((kind, payload))
+        except (OSError, EOFError) as e:
+            raise OCRWorkerError(f"OCR worker {self.worker_id} is unreachable: {e}")
+        return self._receive(timeout)
+
+class OCRWorkerPool:
+    """
+    N worker processes, each owning its own PaddleOCR engine, so OCR runs in parallel across
+    cores and never on the event loop. Jobs wait for an idle worker (the job queue); workers
+    that crash, hang or fail a periodic ping are restarted in the background.
+    """
+
+    def __init__(self, size: int = OCR_POOL_SIZE, engine_kwargs: Optional[Dict[str, Any]] = None,
+                 threads_per_worker: int = OCR_THREADS_PER_WORKER):
+        self.size = size
+        self.engine_kwargs = engine_kwargs or {}
+        self.threads_per_worker = threads_per_worker
+        self._context = multiprocessing.get_context("spawn") # Paddle is not fork-safe
+        self._workers = [_Worker(i) for i in range(size)]
+        self._idle: Optional[asyncio.Queue] = None
+        self._restarting = set()
+        self._health_task = None
+        self._closed = False
+
+    @property
+    def available(self) -> bool:
+        return any(worker.ready for worker in self._workers)
+
+    def health(self) -> List[Dict[str, Any]]:
+        return [{"worker": w.worker_id, "ready": w.ready, "pid": w.process.pid if w.process else None}
+                for w in self._workers]
+
+    def _update_alive_gauge(self):
+        WORKERS_ALIVE.set(sum(1 for worker in self._workers if worker.ready))
+
+    async def start(self):
+        """Starts all workers concurrently; the pool is usable if at least one comes up."""
+        self._idle = asyncio.Queue()
+        results = await asyncio.gather(
+            *(asyncio.to_thread(worker.start, self._context, self.engine_kwargs, self.threads_per_worker) for worker in self._workers),
+            return_exceptions=True,
+        )
+        for worker, result in zip(self._workers, results):
+            if isinstance(result, Exception):
+                logger.error(f"OCR worker {worker.worker_id} failed to start: {result}")
+            else:
+                self._idle.put_nowait(worker)
+        self._update_alive_gauge()
+        logger.info(f"OCR worker pool started with {self._idle.qsize()}/{self.size} workers.")
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        self._closed = True
+        if self._health_task:
+            self._health_task.cancel()
+        await asyncio.gather(*(asyncio.to_thread(worker.stop) for worker in self._workers))
+        self._update_alive_gauge()
+
+    async def _restart(self, worker: _Worker, reason: str):
+        """Replaces a failed worker's process and returns it to the idle queue once it is ready."""
+        if worker.worker_id in self._restarting or self._closed:
+            return
+        self._restarting.add(worker.worker_id)
+        WORKER_RESTARTS.labels(reason).inc()
+        logger.warning(f"Restarting OCR worker {worker.worker_id} ({reason}).")
+        try:
+            await asyncio.to_thread(worker.stop)
+            self._update_alive_gauge()
+            await asyncio.to_thread(worker.start, self._context, self.engine_kwargs, self.threads_per_worker)
+            self._idle.put_nowait(worker)
+        except Exception as e:
+            logger.error(f"Could not restart OCR worker {worker.worker_id}; will retry at the next health check: {e}")
+        finally:
+            self._restarting.discard(worker.worker_id)
+            self._update_alive_gauge()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(OCR_HEALTH_CHECK_INTERVAL_SECONDS)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error(f"OCR pool health check failed: {e}", exc_info=True)
+
+    async def check_health(self):
+        """Pings idle workers and restarts any that are dead, unresponsive or never came up."""
+        for worker in self._workers:
+            if not worker.ready and worker.worker_id not in self._restarting:
+                asyncio.create_task(self._restart(worker, "not_running"))
+        idle_workers = []
+        while not self._idle.empty():
+            idle_workers.append(self._idle.get_nowait())
+        for worker in idle_workers:
+            try:
+                kind, _ = await asyncio.to_thread(worker.call, "ping", None, 10.0)
+                if kind != "pong":
+                    raise OCRWorkerError(f"unexpected ping reply {kind!r}")
+                self._idle.put_nowait(worker)
+            except OCRWorkerError as e:
+                logger.warning(f"OCR worker {worker.worker_id} failed its health check: {e}")
+                asyncio.create_task(self._restart(worker, "health_check"))
+
+    def _release_after_cancel(self, worker: _Worker, finished: asyncio.Future):
+        if finished.cancelled() or finished.exception() is not None:
+            asyncio.create_task(self._restart(worker, "job_failure"))
+        else:
+            self._idle.put_nowait(worker)
+
+    async def run(self, image: np.ndarray, attempts: int = 2) -> Dict[str, list]:
+        """
+        OCRs one image on the next free worker and returns flatten_ocr_result()'s dict.
+        A job whose worker crashes or hangs is retried once on another worker.
+        """
+        if not self.available and not self._restarting:
+            raise OCRWorkerError("No OCR workers are running.")
+        for attempt in range(attempts):
+            queued_at = time.perf_counter()
+            try:
+                worker = await asyncio.wait_for(self._idle.get(), timeout=OCR_JOB_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                raise OCRWorkerError(f"No OCR worker became free within {OCR_JOB_TIMEOUT_SECONDS:.0f}s.")
+            QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+            call = asyncio.ensure_future(asyncio.to_thread(worker.call, "ocr", image, OCR_JOB_TIMEOUT_SECONDS))
+            try:
+                kind, payload = await asyncio.shield(call)
+            except OCRWorkerError as e:
+                logger.error(f"OCR job failed: {e}")
+                asyncio.create_task(self._restart(worker, "job_failure"))
+                if attempt == attempts - 1:
+                    raise
+                continue
+            except asyncio.CancelledError:
+                # The caller went away mid-job; the worker is handed back once its reply has been drained
+                call.add_done_callback(lambda finished, worker=worker: self._release_after_cancel(worker, finished))
+                raise
+            self._idle.put_nowait(worker)
+            if kind != "ok":
+                raise RuntimeError(f"PaddleOCR failed: {payload}")
+            result, duration = payload
+            JOB_DURATION.observe(duration)
+            return result
@@ -0,0 +1,305 @@
+"""
+Offline benchmark of the /process-receipt hot path, stage by stage.
+
+Runs every image of a labelled corpus (receipt_corpus.py) through the same functions
+process_receipt_image uses, in order:
+
+    hash -> decode -> preprocess -> ocr -> flatten -> layout -> category -> rag -> extraction
+
+with the LLM replaced by an in-process stub (canned replies, optional fixed latency), so only
+our own code, OpenCV, PaddleOCR and the retriever are measured. The result cache and the OCR
+worker pool are bypassed; PaddleOCR runs in this process so its cost is not mixed with IPC.
+`--ocr replay` skips PaddleOCR and feeds the corpus' ground-truth OCR lines and boxes to the
+later stages, for machines without PaddleOCR or to focus on the parsing stages.
+
+Per stage it reports wall time (mean/p50/p95/max over images and repeats) and peak memory:
+the tracemalloc peak (Python objects and numpy arrays) and growth of the process' max RSS
+(also native allocations, e.g. inside PaddleOCR). Memory is measured in a separate pass, since
+tracing slows everything down. Layout extraction and category accuracy against the labels
+are reported as well.
+
+The report is written as JSON; pass an earlier report with --compare to see per-stage deltas.
+The exit status is 1 when a stage got slower than --max-slowdown or accuracy dropped.
+
+Usage:
+    python pipeline_benchmark.py --corpus /tmp/receipt_corpus --generate 40 --output bench/HEAD.json
+    python pipeline_benchmark.py --corpus /tmp/receipt_corpus --ocr replay --repeat 5 \\
+        --output bench/new.json --compare bench/HEAD.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import main
+from ocr_pool import flatten_ocr_result
+from layout_extractor import extract_receipt_fields, RECEIPT_LAYOUT_FAST_PATH_ENABLED
+from receipt_corpus import IMAGE_EXTENSIONS, generate_corpus
+from receipt_cache import content_hash
+
+STAGES = ["hash", "decode", "preprocess", "ocr", "flatten", "layout", "category", "rag", "extraction"]
+# Slowdowns smaller than this (ms) are within timer noise and never count as regressions
+NOISE_FLOOR_MS = 1.0
+
+class StubLLMClient:
+    """Stands in for ResilientLLMClient: canned, well-formed replies for each prompt the pipeline sends."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def text_generation(self, prompt: str, **kwargs) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if "Category:" in prompt:
+            return "Other"
+        return json.dumps({
+            "category": "Other", "merchant": "N/A", "amount": 0.0, "date": "N/A", "is_deductible": False,
+            "deduction_type": "N/A", "deduction_details": "No specific conditions/details found in provided guidelines.",
+        })
+
+    async def close(self):
+        pass
+
+def max_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageRecorder:
+    """Collects per-stage wall times, or per-stage memory peaks when `trace_memory` is set."""
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.seconds: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        self.peak_kib: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.rss_growth_kib: Dict[str, int] = {stage: 0 for stage in STAGES}
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            rss_before = max_rss_kib()
+            yield
+            self.peak_kib[name] = max(self.peak_kib[name], (tracemalloc.get_traced_memory()[1] - baseline) // 1024)
+            self.rss_growth_kib[name] += max_rss_kib() - rss_before
+        else:
+            started = time.perf_counter()
+            yield
+            self.seconds[name].append(time.perf_counter() - started)
+
+def replayed_ocr(label: dict):
+    """The label's ground-truth lines in PaddleOCR 3.x result format, so flatten_ocr_result still runs."""
+    ocr = label["ocr"]
+    return [{"rec_texts": ocr["lines"], "rec_scores": ocr["scores"], "rec_polys": [np.asarray(box) for box in ocr["boxes"]]}]
+
+async def run_pipeline(contents: bytes, label: dict, engine, recorder: StageRecorder) -> Dict[str, Any]:
+    """One receipt through the stages of main.process_receipt_image; returns the extracted fields."""
+    with recorder.stage("hash"):
+        content_hash(contents)
+    with recorder.stage("decode"):
+        img_np = main.decode_image(contents)
+    with recorder.stage("preprocess"):
+        img_np, _ = main.normalize_image(img_np)
+    with recorder.stage("ocr"):
+        raw = engine.predict(img_np) if engine is not None else replayed_ocr(label)
+    with recorder.stage("flatten"):
+        ocr_result = flatten_ocr_result(raw)
+        extracted_text = "\n".join(ocr_result["lines"])
+    with recorder.stage("layout"):
+        layout = extract_receipt_fields(ocr_result)
+    with recorder.stage("category"):
+        category = await main.extract_category(extracted_text)
+    with recorder.stage("rag"):
+        rag_query = main.build_rag_query(category, extracted_text)
+        guidelines = await main.retrieve_guidelines(rag_query, category)
+    with recorder.stage("extraction"):
+        if RECEIPT_LAYOUT_FAST_PATH_ENABLED and layout.confident:
+            # Measure the call itself rather than a hit on the per-category assessment cache
+            main.deductibility_assessments.clear()
+            fields = {**layout.as_fields(), **await main.assess_deductibility(category, guidelines)}
+        else:
+            fields = await main.extract_structured_data(extracted_text, category, guidelines)
+    return {**fields, "category": category, "layout": layout.as_fields(), "layout_confident": layout.confident}
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    values = sorted(seconds)
+    if not values:
+        return {}
+    return {
+        "mean_ms": 1000 * statistics.fmean(values),
+        "p50_ms": 1000 * values[len(values) // 2],
+        "p95_ms": 1000 * values[min(len(values) - 1, round(0.95 * (len(values) - 1)))],
+        "max_ms": 1000 * values[-1],
+    }
+
+def score(outcomes: List[tuple]) -> Dict[str, float]:
+    """Accuracy of the local (non-LLM) stages against the labels."""
+    if not outcomes:
+        return {}
+    count = len(outcomes)
+    return {
+        "layout_merchant": sum(o["layout"]["merchant"].upper() == l["merchant"].upper() for o, l in outcomes) / count,
+        "layout_amount": sum(abs(o["layout"]["amount"] - l["amount"]) < 0.005 for o, l in outcomes) / count,
+        "layout_date": sum(o["layout"]["date"] == l["date"] for o, l in outcomes) / count,
+        "layout_fast_path_coverage": sum(o["layout_confident"] for o, _ in outcomes) / count,
+        "category": sum(o["category"] == l["category"] for o, l in outcomes) / count,
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def run_benchmark(corpus: str, engine, repeat: int, trace_memory: bool, llm_latency: float) -> Dict[str, Any]:
+    with open(os.path.join(corpus, "labels.json")) as f:
+        labels = json.load(f)
+    names = sorted(name for name in labels if name.lower().endswith(IMAGE_EXTENSIONS))
+    if not names:
+        raise SystemExit(f"No labelled images found in {corpus}")
+    uploads = {}
+    for name in names:
+        with open(os.path.join(corpus, name), "rb") as f:
+            uploads[name] = f.read()
+
+    stub = StubLLMClient(latency=llm_latency)
+    main.hf_client = stub
+    # Warm up model loading, first-call imports and allocator pools outside the measurements
+    await run_pipeline(uploads[names[0]], labels[names[0]], engine, StageRecorder(trace_memory=False))
+
+    stub.calls = 0
+    timings = StageRecorder(trace_memory=False)
+    outcomes = []
+    started = time.perf_counter()
+    for iteration in range(repeat):
+        for name in names:
+            outcome = await run_pipeline(uploads[name], labels[name], engine, timings)
+            if iteration == 0:
+                outcomes.append((outcome, labels[name]))
+    wall_seconds = time.perf_counter() - started
+    llm_calls = stub.calls
+
+    memory = None
+    if trace_memory:
+        memory = StageRecorder(trace_memory=True)
+        tracemalloc.start()
+        try:
+            for name in names:
+                await run_pipeline(uploads[name], labels[name], engine, memory)
+        finally:
+            tracemalloc.stop()
+
+    totals = [sum(timings.seconds[stage][i] for stage in STAGES) for i in range(len(timings.seconds["hash"]))]
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = summarize(timings.seconds[stage])
+        if memory:
+            stages[stage]["peak_traced_kib"] = memory.peak_kib[stage]
+            stages[stage]["rss_growth_kib"] = memory.rss_growth_kib[stage]
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "corpus": os.path.abspath(corpus), "images": len(names), "repeat": repeat,
+            "ocr": "paddle" if engine is not None else "replay", "llm_latency_s": llm_latency,
+            "preprocessing": main.RECEIPT_PREPROCESSING_ENABLED, "layout_fast_path": RECEIPT_LAYOUT_FAST_PATH_ENABLED,
+            "category_classifier": main.CATEGORY_CLASSIFIER_ENABLED,
+            "retriever": main.retriever is not None, "python": platform.python_version(), "cpus": os.cpu_count(),
+        },
+        "stages": stages,
+        "total": summarize(totals),
+        "receipts_per_second": len(totals) / wall_seconds,
+        "llm_calls_per_receipt": llm_calls / (len(names) * repeat),
+        "max_rss_kib": max_rss_kib(),
+        "accuracy": score(outcomes),
+    }
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]], max_slowdown: float) -> bool:
+    """Prints the per-stage table (with deltas against `baseline`); returns False on a regression."""
+    config = report["config"]
+    print(f"\n--- Receipt pipeline benchmark @ {report['commit']} ({config['images']} images x {config['repeat']}, "
+          f"ocr={config['ocr']}, retriever={'on' if config['retriever'] else 'off'}) ---")
+    print(f"{'stage':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak KiB':>10}{'rss KiB':>10}"
+          + (f"{'p50 vs base':>13}" if baseline else ""))
+    ok = True
+    for stage in STAGES + ["total"]:
+        row = report["total"] if stage == "total" else report["stages"][stage]
+        line = (f"{stage:<12}{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+                f"{row.get('peak_traced_kib', '-'):>10}{row.get('rss_growth_kib', '-'):>10}")
+        if baseline:
+            base = baseline["total"] if stage == "total" else baseline["stages"].get(stage, {})
+            if base.get("p50_ms"):
+                change = row["p50_ms"] / base["p50_ms"] - 1
+                flag = ""
+                if change > max_slowdown and row["p50_ms"] - base["p50_ms"] > NOISE_FLOOR_MS:
+                    ok, flag = False, " !"
+                line += f"{change:>+12.1%}{flag}"
+        print(line)
+    print(f"Throughput: {report['receipts_per_second']:.2f} receipts/s single-threaded; "
+          f"{report['llm_calls_per_receipt']:.2f} LLM calls per receipt; max RSS {report['max_rss_kib'] // 1024} MiB")
+    print("Accuracy: " + ", ".join(f"{metric} {value:.3f}" for metric, value in report["accuracy"].items()))
+    if baseline:
+        for metric, value in report["accuracy"].items():
+            previous = baseline.get("accuracy", {}).get(metric)
+            if previous is not None and value < previous - 0.005:
+                ok = False
+                print(f"Accuracy dropped: {metric} {previous:.3f} -> {value:.3f}")
+        if baseline.get("config", {}).get("ocr") != config["ocr"]:
+            print(f"Note: the baseline used ocr={baseline.get('config', {}).get('ocr')}; OCR-dependent stages are not comparable.")
+        print(f"Compared with {baseline.get('commit', 'unknown')}: {'no regressions' if ok else 'REGRESSIONS (!)'}"
+              f" (threshold +{max_slowdown:.0%} on p50, noise floor {NOISE_FLOOR_MS} ms)")
+    return ok
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Per-stage latency and memory of the receipt pipeline with the LLM stubbed.")
+    parser.add_argument("--corpus", required=True, help="Corpus directory with labels.json (see receipt_corpus.py).")
+    parser.add_argument("--generate", type=int, default=0, help="Generate this many synthetic receipts into --corpus first.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--ocr", choices=["paddle", "replay"], default="paddle",
+                        help="Run PaddleOCR, or replay the corpus' ground-truth OCR output.")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed passes over the corpus.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc/RSS pass.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the stub LLM waits before replying.")
+    parser.add_argument("--output", help="Write the JSON report here.")
+    parser.add_argument("--compare", help="An earlier JSON report to compare against.")
+    parser.add_argument("--max-slowdown", type=float, default=0.2, help="Allowed relative p50 increase per stage.")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_corpus(args.corpus, args.generate, args.seed)
+        print(f"Wrote {args.generate} synthetic receipts to {args.corpus}")
+    engine = None
+    if args.ocr == "paddle":
+        from paddleocr import PaddleOCR
+        engine = PaddleOCR(use_angle_cls=True, lang="en")
+
+    report = asyncio.run(run_benchmark(args.corpus, engine, args.repeat, not args.no_memory, args.llm_latency))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    ok = print_report(report, baseline, args.max_slowdown)
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main_cli()
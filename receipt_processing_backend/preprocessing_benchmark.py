@@ -0,0 +1,198 @@
+"""
+Benchmark of the pre-OCR image normalization stage (image_preprocessing.py).
+
+Runs PaddleOCR on every sample image twice, once untouched and once preprocessed, and reports
+OCR latency and extraction accuracy for both. Accuracy is measured against ground truth when a
+`labels.json` is present in the sample directory:
+
+    {"receipt1.jpg": {"text": "full expected text (optional)", "fields": ["MPH BOOKSTORES", "89.90", "14/03/2025"]}}
+
+Without labels, the untouched image's OCR output is used as the reference, so the report shows
+how much of it survives preprocessing. `--synthesize N` writes N rotated, photo-sized synthetic
+receipts with labels into the sample directory first, so the benchmark can run without real data.
+
+Usage:
+    python preprocessing_benchmark.py --samples test_images
+    python preprocessing_benchmark.py --samples /tmp/receipt_samples --synthesize 20
+"""
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+from image_preprocessing import preprocess_receipt_image
+from ocr_pool import flatten_ocr_result
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+MERCHANTS = ["MPH BOOKSTORES", "POPULAR BOOK CO", "GUARDIAN PHARMACY", "AEON BIG", "SHELL MALAYSIA", "UNIFI"]
+ITEMS = ["Tax Guide 2025", "Notebook A5", "Pen set", "Vitamin C", "Rice 5kg", "Fuel RON95", "Parking", "Internet 100Mbps"]
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().upper()
+
+def synthesize_receipt(rng: random.Random) -> tuple:
+    """A receipt printed on white paper, photographed slightly rotated against a darker surface at phone resolution."""
+    merchant = rng.choice(MERCHANTS)
+    date = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025"
+    items = [(name, round(rng.uniform(2, 150), 2)) for name in rng.sample(ITEMS, rng.randint(2, 5))]
+    total = f"{sum(price for _, price in items):.2f}"
+    lines = [merchant, date] + [f"{name}  {price:.2f}" for name, price in items] + [f"TOTAL RM {total}", "THANK YOU"]
+
+    paper = np.full((120 + 90 * len(lines), 560), 255, dtype=np.uint8)
+    for i, line in enumerate(lines):
+        cv2.putText(paper, line, (24, 80 + i * 90), cv2.FONT_HERSHEY_SIMPLEX, 0.9, 0, 2)
+    background = rng.randint(30, 110)
+    canvas = np.full((paper.shape[0] + 500, paper.shape[1] + 600), background, dtype=np.uint8)
+    top, left = rng.randint(150, 350), rng.randint(200, 400)
+    canvas[top:top + paper.shape[0], left:left + paper.shape[1]] = paper
+    height, width = canvas.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-10, 10), 1.0)
+    canvas = cv2.warpAffine(canvas, matrix, (width, height), borderValue=background)
+    photo = cv2.resize(cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR), (3024, round(3024 * height / width)))
+    return photo, {"text": "\n".join(lines), "fields": [merchant, date, total]}
+
+def synthesize_samples(directory: str, count: int, seed: int):
+    os.makedirs(directory, exist_ok=True)
+    labels_path = os.path.join(directory, "labels.json")
+    labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            labels = json.load(f)
+    rng = random.Random(seed)
+    for i in range(count):
+        image, label = synthesize_receipt(rng)
+        name = f"synthetic_{i:03d}.jpg"
+        cv2.imwrite(os.path.join(directory, name), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        labels[name] = label
+    with open(labels_path, "w") as f:
+        json.dump(labels, f, indent=2)
+    print(f"Wrote {count} synthetic receipts to {directory}")
+
+def run_ocr(engine, image: np.ndarray) -> tuple:
+    started = time.perf_counter()
+    lines = flatten_ocr_result(engine.predict(image))["lines"]
+    return "\n".join(lines), time.perf_counter() - started
+
+def score(extracted: str, label: dict) -> dict:
+    extracted_norm = normalize_text(extracted)
+    scores = {}
+    if label.get("text"):
+        scores["text_similarity"] = difflib.SequenceMatcher(None, normalize_text(label["text"]), extracted_norm).ratio()
+    fields = label.get("fields") or []
+    if fields:
+        scores["field_recall"] = sum(normalize_text(field) in extracted_norm for field in fields) / len(fields)
+    return scores
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, round(0.95 * (len(values) - 1)))],
+    }
+
+def run_benchmark(samples_dir: str, engine) -> dict:
+    labels_path = os.path.join(samples_dir, "labels.json")
+    labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            labels = json.load(f)
+    names = sorted(name for name in os.listdir(samples_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    if not names:
+        raise SystemExit(f"No images found in {samples_dir}")
+
+    # Warm up so model loading is not counted against the first image
+    run_ocr(engine, np.full((64, 64, 3), 255, dtype=np.uint8))
+
+    results = {"raw": {"ocr_s": [], "scores": []}, "preprocessed": {"ocr_s": [], "preprocess_s": [], "scores": []}}
+    for name in names:
+        image = cv2.imread(os.path.join(samples_dir, name))
+        if image is None:
+            print(f"Skipping unreadable image {name}")
+            continue
+        raw_text, raw_seconds = run_ocr(engine, image)
+
+        started = time.perf_counter()
+        prepared, info = preprocess_receipt_image(image)
+        preprocess_seconds = time.perf_counter() - started
+        prepared_text, prepared_seconds = run_ocr(engine, prepared)
+
+        label = labels.get(name) or {"text": raw_text}
+        results["raw"]["ocr_s"].append(raw_seconds)
+        results["raw"]["scores"].append(score(raw_text, label))
+        results["preprocessed"]["ocr_s"].append(prepared_seconds)
+        results["preprocessed"]["preprocess_s"].append(preprocess_seconds)
+        results["preprocessed"]["scores"].append(score(prepared_text, label))
+        print(f"{name}: raw {raw_seconds:.2f}s, preprocessed {preprocess_seconds:.2f}s + {prepared_seconds:.2f}s {info}")
+
+    report = {"images": len(results["raw"]["ocr_s"]), "labelled": bool(labels)}
+    for variant, data in results.items():
+        report[variant] = {"ocr_s": summarize(data["ocr_s"])}
+        if data.get("preprocess_s"):
+            report[variant]["preprocess_s"] = summarize(data["preprocess_s"])
+        for metric in ("text_similarity", "field_recall"):
+            values = [s[metric] for s in data["scores"] if metric in s]
+            if values:
+                report[variant][metric] = statistics.fmean(values)
+    return report
+
+def print_report(report: dict, tolerance: float) -> bool:
+    print(f"\n--- OCR preprocessing benchmark ({report['images']} images, "
+          f"{'ground truth labels' if report['labelled'] else 'raw OCR as reference'}) ---")
+    print(f"{'variant':<14}{'ocr mean':>10}{'ocr p50':>10}{'ocr p95':>10}{'prep mean':>11}{'text sim':>10}{'fields':>9}")
+    for variant in ("raw", "preprocessed"):
+        r = report[variant]
+        prep = r.get("preprocess_s", {}).get("mean")
+        print(f"{variant:<14}{r['ocr_s']['mean']:>10.3f}{r['ocr_s']['p50']:>10.3f}{r['ocr_s']['p95']:>10.3f}"
+              f"{(f'{prep:.3f}' if prep is not None else '-'):>11}"
+              f"{(format(r['text_similarity'], '.3f') if 'text_similarity' in r else '-'):>10}"
+              f"{(format(r['field_recall'], '.3f') if 'field_recall' in r else '-'):>9}")
+    print("-----------------------------------------------------------------------------")
+
+    held = True
+    if report["labelled"]:
+        for metric in ("text_similarity", "field_recall"):
+            if metric in report["raw"] and report["preprocessed"].get(metric, 0.0) < report["raw"][metric] - tolerance:
+                held = False
+                print(f"Accuracy dropped: {metric} {report['raw'][metric]:.3f} -> {report['preprocessed'].get(metric, 0.0):.3f}")
+        if held:
+            print(f"Accuracy held within {tolerance:.3f} of the untouched images.")
+    speedup = report["raw"]["ocr_s"]["mean"] / max(1e-9, report["preprocessed"]["ocr_s"]["mean"]
+                                                    + report["preprocessed"]["preprocess_s"]["mean"])
+    print(f"End-to-end OCR speedup including preprocessing: {speedup:.2f}x")
+    return held
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR latency and accuracy with and without receipt image preprocessing.")
+    parser.add_argument("--samples", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images"),
+                        help="Directory of receipt images, optionally with a labels.json.")
+    parser.add_argument("--synthesize", type=int, default=0, help="Write this many synthetic labelled receipts into --samples first.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed absolute drop in accuracy metrics.")
+    parser.add_argument("--output", help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize_samples(args.samples, args.synthesize, args.seed)
+
+    from paddleocr import PaddleOCR
+    engine = PaddleOCR(use_angle_cls=True, lang="en")
+    report = run_benchmark(args.samples, engine)
+    held = print_report(report, args.tolerance)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    raise SystemExit(0 if held else 1)
+
+if __name__ == "__main__":
+    main()
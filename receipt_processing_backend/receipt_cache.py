@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_CACHE_ENABLED = os.getenv("RECEIPT_CACHE_ENABLED", "true").lower() == "true"
+RECEIPT_CACHE_PATH = os.getenv(
+    "RECEIPT_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "receipt_results.sqlite3"))
+RECEIPT_CACHE_MAX_ENTRIES = int(os.getenv("RECEIPT_CACHE_MAX_ENTRIES", "5000"))
+# Perceptual hashes within this many differing bits (out of 256) are treated as the same receipt.
+# On synthetic receipts sharing one layout, re-photographs of one receipt stayed within ~30 bits
+# and different receipts were 46+ bits apart.
+RECEIPT_DUPLICATE_MAX_DISTANCE = int(os.getenv("RECEIPT_DUPLICATE_MAX_DISTANCE", "36"))
+
+CACHE_LOOKUPS = Counter("receipt_cache_lookups", "Receipt result cache lookups by outcome.", ["outcome"])
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+def _crop_to_ink(gray: np.ndarray) -> np.ndarray:
+    """Bounding box of the printed text, so the margin and background left around the receipt do not count."""
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    ys, xs = np.nonzero(ink)
+    if len(xs) == 0:
+        return gray
+    # Percentiles rather than min/max, so a few specks at the edges do not widen the box
+    x0, x1 = np.percentile(xs, [0.5, 99.5]).astype(int)
+    y0, y1 = np.percentile(ys, [0.5, 99.5]).astype(int)
+    return gray[y0:y1 + 1, x0:x1 + 1]
+
+def perceptual_hash(image: np.ndarray) -> int:
+    """
+    256-bit DCT perceptual hash of the text area: the low-frequency 16x16 block of a 64x64
+    thumbnail, thresholded at its median. Re-encoding, rescaling, a different background or a
+    slightly different crop flip few bits, so another photo of the same receipt lands within a
+    small Hamming distance. Receipts all look alike at low resolution, hence more bits than the
+    usual 64.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(_crop_to_ink(gray), (64, 64), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(thumbnail)[:16, :16].flatten()
+    # The DC term only encodes overall brightness
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+class ReceiptResultCache:
+    """
+    Processed receipt results persisted to SQLite, keyed by the SHA-256 of the uploaded bytes and
+    the uploader (`owner`, "" when unknown).
+
+    An exact re-upload is answered from here without OCR or LLM calls. The result only describes
+    bytes the uploader already has, so it is reused across owners; the filename and time of
+    another owner's upload are never returned. Every entry also stores the perceptual hash of the
+    normalized image, so a different photo or scan of a receipt the same owner already processed
+    can be flagged as a possible duplicate expense; receipts of anonymous uploads are never
+    compared. The least recently used entries are evicted beyond `max_entries`. Entries written
+    under another `version` (a different model or guideline index) are dropped when the cache is
+    opened.
+    """
+
+    def __init__(self, path: str = RECEIPT_CACHE_PATH, max_entries: int = RECEIPT_CACHE_MAX_ENTRIES,
+                 max_distance: int = RECEIPT_DUPLICATE_MAX_DISTANCE, version: str = ""):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.version = version
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # owner -> content_hash -> perceptual hash, mirrored in memory so near-duplicate search needs no table scan
+        self._image_hashes: Dict[str, Dict[str, int]] = {}
+
+    def open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(receipt_results)")}
+        if columns and "owner" not in columns:
+            # Entries from before results were scoped by owner cannot be attributed to anyone
+            self._conn.execute("DROP TABLE receipt_results")
+            logger.info("Dropped cached receipt results written before they were scoped by owner.")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS receipt_results ("
+            " content_hash TEXT NOT NULL, owner TEXT NOT NULL, image_hash TEXT NOT NULL, filename TEXT,"
+            " result TEXT NOT NULL, version TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL,"
+            " PRIMARY KEY (content_hash, owner))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS receipt_results_last_used ON receipt_results (last_used_at)")
+        stale = self._conn.execute("DELETE FROM receipt_results WHERE version != ?", (self.version,)).rowcount
+        self._conn.commit()
+        if stale:
+            logger.info(f"Dropped {stale} cached receipt results from an earlier model/guideline version.")
+        self._image_hashes = {}
+        for key, owner, image_hash in self._conn.execute("SELECT content_hash, owner, image_hash FROM receipt_results"):
+            self._image_hashes.setdefault(owner, {})[key] = int(image_hash, 16)
+        logger.info(f"Receipt result cache opened at {self.path} with {self._entry_count()} entries.")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _entry_count(self) -> int:
+        return sum(len(hashes) for hashes in self._image_hashes.values())
+
+    def _get(self, key: str, owner: str, any_owner: bool = False) -> Optional[Dict[str, Any]]:
+        """The owner's entry for `key`; with `any_owner`, another owner's result when the owner has none."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT owner, image_hash, filename, result, created_at FROM receipt_results"
+                " WHERE content_hash = ? AND (owner = ? OR ?) ORDER BY owner = ? DESC LIMIT 1",
+                (key, owner, any_owner, owner)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE receipt_results SET last_used_at = ? WHERE content_hash = ? AND owner = ?",
+                               (time.time(), key, row[0]))
+            self._conn.commit()
+        if not owner or row[0] != owner:
+            result = json.loads(row[3])
+            result.pop("filename", None)
+            return {"own": False, "image_hash": int(row[1], 16), "result": result}
+        return {"own": True, "image_hash": int(row[1], 16), "filename": row[2], "result": json.loads(row[3]), "processed_at": row[4]}
+
+    def _find_similar(self, owner: str, image_hash: int) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            candidates = list(self._image_hashes.get(owner, {}).items())
+        best = None
+        for key, other in candidates:
+            distance = (image_hash ^ other).bit_count()
+            if distance <= self.max_distance and (best is None or distance < best[1]):
+                best = (key, distance)
+        return best
+
+    def _put(self, key: str, owner: str, image_hash: int, filename: str, result: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO receipt_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, owner, format(image_hash, "064x"), filename, json.dumps(result), self.version, now, now))
+            self._image_hashes.setdefault(owner, {})[key] = image_hash
+            overflow = self._entry_count() - self.max_entries
+            if overflow > 0:
+                evicted = self._conn.execute(
+                    "SELECT content_hash, owner FROM receipt_results ORDER BY last_used_at LIMIT ?", (overflow,)).fetchall()
+                self._conn.executemany("DELETE FROM receipt_results WHERE content_hash = ? AND owner = ?", evicted)
+                for evicted_key, evicted_owner in evicted:
+                    hashes = self._image_hashes.get(evicted_owner, {})
+                    hashes.pop(evicted_key, None)
+                    if not hashes:
+                        self._image_hashes.pop(evicted_owner, None)
+            self._conn.commit()
+
+    async def get(self, key: str, owner: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Cached entry for exactly these bytes, or None. The owner's own upload gives {"own": True,
+        "image_hash", "filename", "result", "processed_at"}; an upload by someone else only
+        {"own": False, "image_hash", "result"}.
+        """
+        if self._conn is None:
+            return None
+        try:
+            entry = await asyncio.to_thread(self._get, key, owner, True)
+        except sqlite3.Error as e:
+            logger.error(f"Receipt cache lookup failed: {e}")
+            return None
+        CACHE_LOOKUPS.labels(outcome="miss" if entry is None else "hit" if entry["own"] else "shared_hit").inc()
+        return entry
+
+    async def find_duplicate(self, image_hash: int, owner: str = "") -> Optional[Dict[str, Any]]:
+        """The owner's closest earlier receipt whose perceptual hash is within `max_distance` bits, with its distance."""
+        if self._conn is None or not owner:
+            return None
+        try:
+            match = await asyncio.to_thread(self._find_similar, owner, image_hash)
+            if match is None:
+                return None
+            key, distance = match
+            entry = await asyncio.to_thread(self._get, key, owner)
+        except sqlite3.Error as e:
+            logger.error(f"Receipt cache duplicate search failed: {e}")
+            return None
+        if entry is None:
+            return None
+        CACHE_LOOKUPS.labels(outcome="near_duplicate").inc()
+        return {**entry, "distance": distance}
+
+    async def put(self, key: str, image_hash: int, filename: str, result: Dict[str, Any], owner: str = ""):
+        if self._conn is None:
+            return
+        try:
+            await asyncio.to_thread(self._put, key, owner, image_hash, filename, result)
+        except sqlite3.Error as e:
+            logger.error(f"Receipt cache write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self._conn is not None, "entries": self._entry_count(), "max_entries": self.max_entries}
@@ -0,0 +1,179 @@
+"""
+Synthetic receipt corpus for offline benchmarks of the receipt pipeline.
+
+Receipts are drawn with OpenCV in several layouts (narrow thermal rolls, totals printed under
+their label, wide tax invoices, long compact till rolls) and then "captured" at different
+resolutions and rotations, as scans or as photos against a darker surface, with optional blur
+and noise. Every image gets a ground-truth entry in `labels.json`:
+
+    {"thermal_000.jpg": {"layout": "thermal", "merchant": "MPH BOOKSTORES", "amount": 89.9,
+                         "date": "2025-03-14", "category": "Books & Publications",
+                         "text": "...", "fields": ["MPH BOOKSTORES", "14/03/2025", "89.90"],
+                         "ocr": {"lines": [...], "boxes": [...], "scores": [...]}}}
+
+`text`/`fields` use the same format as preprocessing_benchmark.py. `ocr` holds the printed lines
+with their boxes on the upright receipt (what OCR sees after preprocessing has deskewed it), so
+the stages after OCR can be benchmarked without PaddleOCR (pipeline_benchmark.py --ocr replay).
+
+Usage:
+    python receipt_corpus.py --output /tmp/receipt_corpus --count 60
+"""
+import argparse
+import json
+import os
+import random
+from datetime import date, timedelta
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+LAYOUTS = ["thermal", "label_above", "invoice", "compact"]
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# category -> (merchants, items); merchants and items are what the category classifier keys on
+CATALOGUE: Dict[str, Tuple[List[str], List[str]]] = {
+    "Books & Publications": (["MPH BOOKSTORES", "POPULAR BOOK CO", "KINOKUNIYA"],
+                             ["Tax Guide 2025", "Novel Paperback", "Business Magazine", "Dictionary", "Comic Book"]),
+    "Groceries": (["AEON BIG", "JAYA GROCER", "LOTUS'S", "VILLAGE GROCER"],
+                  ["Rice 5kg", "Eggs 30pcs", "Fresh Milk 1L", "Wholemeal Bread", "Chicken Breast", "Cooking Oil 2kg"]),
+    "Transportation (Fuel, Parking, Public Transport)": (["SHELL MALAYSIA", "PETRONAS", "PETRON"],
+                                                         ["RON95 Fuel", "RON97 Fuel", "Diesel", "Car Wash"]),
+    "Healthcare & Medical": (["GUARDIAN PHARMACY", "KLINIK KESIHATAN", "CARING PHARMACY"],
+                             ["Paracetamol 500mg", "Vitamin C 1000mg", "Consultation Fee", "Cough Syrup"]),
+    "Meals & Entertainment": (["OLDTOWN WHITE COFFEE", "MCDONALD'S", "SECRET RECIPE"],
+                              ["Nasi Lemak", "Teh Tarik", "Chicken Burger Set", "Chocolate Cake", "Iced Latte"]),
+    "Computer & IT Equipment": (["SENHENG", "ALL IT HYPERMARKET", "MACHINES"],
+                                ["Laptop 14in", "Wireless Mouse", "USB-C Cable", "External SSD 1TB", "Monitor 24in"]),
+    "Office Supplies & Stationery": (["MR DIY", "OFFICE DEPOT", "STATIONERY WORLD"],
+                                     ["A4 Paper Ream", "Stapler", "Ink Cartridge", "Ball Pen Box", "File Folder"]),
+}
+
+def format_printed_date(d: date, style: int) -> str:
+    return [f"{d.day:02d}/{d.month:02d}/{d.year}", d.isoformat(), f"{d.day:02d}-{MONTH_NAMES[d.month - 1]}-{d.year}",
+            f"{d.day:02d}.{d.month:02d}.{d.year % 100:02d}"][style]
+
+def compose_lines(rng: random.Random, layout: str) -> Tuple[List[Tuple[str, str, float]], Dict[str, object]]:
+    """
+    The receipt content as rows of (left text, right text, font scale) plus its ground truth.
+    Amounts are right-aligned; a row with an empty right text is a single left-aligned line.
+    """
+    category = rng.choice(sorted(CATALOGUE))
+    merchants, catalogue_items = CATALOGUE[category]
+    merchant = rng.choice(merchants)
+    purchased = date(2025, 1, 1) + timedelta(days=rng.randrange(300))
+    printed_date = format_printed_date(purchased, rng.randrange(4))
+    item_count = rng.randint(8, 18) if layout == "compact" else rng.randint(2, 5)
+    items = [(rng.choice(catalogue_items), rng.randint(1, 3), round(rng.uniform(1.5, 120), 2)) for _ in range(item_count)]
+    subtotal = round(sum(quantity * price for _, quantity, price in items), 2)
+    tax = round(subtotal * 0.06, 2) if rng.random() < 0.5 else 0.0
+    total = round(subtotal + tax, 2)
+    cash = float(int(total) + rng.choice([1, 5, 10, 50]))
+
+    small = 0.5 if layout == "compact" else 0.7
+    rows = [(merchant, "", 1.1 if layout != "compact" else 0.9),
+            (f"Lot {rng.randint(1, 99)}, Jalan {rng.choice(['Ampang', 'Bukit Bintang', 'Tun Razak'])}", "", small * 0.8),
+            ("TAX INVOICE" if layout == "invoice" else f"Tel: 03-{rng.randint(1000, 9999)} {rng.randint(1000, 9999)}", "", small * 0.8),
+            (f"Date: {printed_date}" if layout != "thermal" else f"{printed_date}  {rng.randint(8, 21):02d}:{rng.randint(0, 59):02d}", "", small)]
+    if layout == "invoice":
+        rows.append(("Description          Qty   Unit", "Amount", small))
+    for name, quantity, price in items:
+        if layout == "invoice":
+            rows.append((f"{name:<20} {quantity:>3} {price:>7.2f}", f"{quantity * price:.2f}", small))
+        else:
+            rows.append((f"{quantity} x {name}", f"{quantity * price:.2f}", small))
+    rows.append(("Subtotal", f"{subtotal:.2f}", small))
+    if tax:
+        rows.append(("SST 6%", f"{tax:.2f}", small))
+    if layout == "label_above":
+        rows.append(("GRAND TOTAL", "", small * 1.1))
+        rows.append(("", f"RM {total:.2f}", small * 1.1))
+    else:
+        rows.append(("TOTAL" if layout != "invoice" else "Total Amount Payable", f"RM {total:.2f}", small * 1.1))
+    rows.append(("Cash", f"{cash:.2f}", small))
+    rows.append(("Change", f"{cash - total:.2f}", small))
+    rows.append(("THANK YOU, PLEASE COME AGAIN", "", small * 0.8))
+    truth = {"layout": layout, "merchant": merchant, "amount": total, "date": purchased.isoformat(), "category": category,
+             "fields": [merchant, printed_date, f"{total:.2f}"]}
+    return rows, truth
+
+def render_paper(rows: List[Tuple[str, str, float]], width: int) -> Tuple[np.ndarray, List[str], List[List[List[float]]]]:
+    """Draws the rows on white paper; returns it with each drawn text fragment and its box."""
+    font, thickness, margin = cv2.FONT_HERSHEY_SIMPLEX, 2, 24
+    line_gap = [int(cv2.getTextSize("Ag", font, scale, thickness)[0][1] * 2.2) for _, _, scale in rows]
+    paper = np.full((sum(line_gap) + 2 * margin + 20, width), 255, dtype=np.uint8)
+    lines, boxes = [], []
+    y = margin
+    for (left, right, scale), gap in zip(rows, line_gap):
+        y += gap
+        for text, align_right in ((left, False), (right, True)):
+            if not text:
+                continue
+            (text_width, text_height), baseline = cv2.getTextSize(text, font, scale, thickness)
+            x = width - margin - text_width if align_right else margin
+            cv2.putText(paper, text, (x, y), font, scale, 0, thickness, cv2.LINE_AA)
+            lines.append(text)
+            boxes.append([[x, y - text_height], [x + text_width, y - text_height], [x + text_width, y + baseline], [x, y + baseline]])
+    return paper, lines, boxes
+
+def capture(rng: random.Random, paper: np.ndarray) -> Tuple[np.ndarray, dict]:
+    """Places the paper in a frame as a scan or a photo, rotates and rescales it."""
+    photo = rng.random() < 0.6
+    if photo:
+        background = rng.randint(30, 120)
+        pad_y, pad_x = rng.randint(80, 300), rng.randint(80, 300)
+    else:
+        background, pad_y, pad_x = 255, rng.randint(10, 40), rng.randint(10, 40)
+    canvas = np.full((paper.shape[0] + 2 * pad_y, paper.shape[1] + 2 * pad_x), background, dtype=np.uint8)
+    canvas[pad_y:pad_y + paper.shape[0], pad_x:pad_x + paper.shape[1]] = paper
+    angle = rng.uniform(-12, 12) if photo else rng.uniform(-2, 2)
+    height, width = canvas.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    canvas = cv2.warpAffine(canvas, matrix, (width, height), borderValue=background)
+    long_side = rng.choice([900, 1600, 2400, 3264, 4032]) if photo else rng.choice([1100, 1700, 2200])
+    scale = long_side / max(height, width)
+    image = cv2.resize(canvas, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    if photo and rng.random() < 0.5:
+        image = cv2.GaussianBlur(image, (3, 3), 0)
+    if photo and rng.random() < 0.5:
+        image = np.clip(image.astype(np.int16) + np.random.default_rng(rng.randrange(1 << 30)).normal(0, 6, image.shape), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), {"photo": photo, "angle": round(angle, 2), "long_side": long_side}
+
+def synthesize(rng: random.Random, layout: str) -> Tuple[np.ndarray, dict]:
+    rows, truth = compose_lines(rng, layout)
+    paper_width = 1100 if layout == "invoice" else rng.choice([520, 600, 680])
+    paper, lines, boxes = render_paper(rows, paper_width)
+    image, capture_info = capture(rng, paper)
+    truth.update(capture_info)
+    truth["text"] = "\n".join(lines)
+    truth["ocr"] = {"lines": lines, "boxes": boxes, "scores": [0.98] * len(lines)}
+    return image, truth
+
+def generate_corpus(directory: str, count: int, seed: int = 1234) -> Dict[str, dict]:
+    """Writes `count` receipts, cycling through the layouts, and their labels.json; returns the labels."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    labels = {}
+    for i in range(count):
+        layout = LAYOUTS[i % len(LAYOUTS)]
+        image, truth = synthesize(rng, layout)
+        if rng.random() < 0.75:
+            name = f"{layout}_{i:03d}.jpg"
+            cv2.imwrite(os.path.join(directory, name), image, [cv2.IMWRITE_JPEG_QUALITY, rng.choice([70, 85, 95])])
+        else:
+            name = f"{layout}_{i:03d}.png"
+            cv2.imwrite(os.path.join(directory, name), image)
+        labels[name] = truth
+    with open(os.path.join(directory, "labels.json"), "w") as f:
+        json.dump(labels, f, indent=1)
+    return labels
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a labelled synthetic receipt corpus.")
+    parser.add_argument("--output", required=True, help="Directory to write the images and labels.json to.")
+    parser.add_argument("--count", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+    generate_corpus(args.output, args.count, args.seed)
+    print(f"Wrote {args.count} synthetic receipts to {args.output}")
@@ -0,0 +1,164 @@
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e: # tiktoken missing or its BPE file could not be fetched
+    logger.warning(f"tiktoken encoding unavailable, falling back to ~4 characters per token estimates: {e}")
+    _encoding = None
+
+def count_tokens(text: str) -> int:
+    """
+    Token count used for prompt budgeting.
+    cl100k_base is not Mistral's tokenizer, but it tracks it closely enough to keep prompts within a budget.
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+@dataclass
+class SessionTurn:
+    role: str
+    content: str
+    line: str # Formatted prompt line, e.g. "User: ...\n"
+    tokens: int # Token count of `line`, computed once when the turn is appended
+
+    @classmethod
+    def create(cls, role: str, content: str) -> "SessionTurn":
+        speaker = "User" if role == "user" else "Assistant"
+        line = f"{speaker}: {content}\n"
+        return cls(role=role, content=content, line=line, tokens=count_tokens(line))
+
+@dataclass
+class ChatSession:
+    session_id: str
+    turns: List[SessionTurn] = field(default_factory=list)
+    last_active: float = field(default_factory=time.monotonic)
+
+class ChatSessionStore:
+    """
+    In-memory, append-only conversation history keyed by session id.
+    Idle sessions expire after `ttl_seconds`; beyond `max_sessions` the least recently active one is dropped.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600.0, max_sessions: int = 10000, max_turns: int = 200):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def _purge_expired(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_active >= cutoff:
+                break
+            del self._sessions[oldest_id]
+
+    def get(self, session_id: Optional[str]) -> Optional[ChatSession]:
+        """The live session for `session_id`, or None when it is unknown or expired."""
+        self._purge_expired()
+        return self._sessions.get(session_id) if session_id else None
+
+    def get_or_create(self, session_id: Optional[str], seed_history: Optional[List[Any]] = None) -> Tuple[ChatSession, bool]:
+        """
+        Returns (session, reset): the live session for `session_id`, or a new one under a server-generated id.
+        `reset` is True when a `session_id` was presented but is unknown or expired. A new session is seeded
+        from `seed_history`, the client's own copy of the conversation.
+        """
+        session = self.get(session_id)
+        reset = session is None and bool(session_id)
+        if session is None:
+            session = ChatSession(session_id=uuid.uuid4().hex)
+            for msg in seed_history or []:
+                if msg.role in ("user", "assistant"):
+                    session.turns.append(SessionTurn.create(msg.role, msg.content))
+            self._sessions[session.session_id] = session
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            replaced = f" in place of unknown or expired session {session_id}" if reset else ""
+            logger.info(f"Created chat session {session.session_id}{replaced} with {len(session.turns)} seeded turns.")
+        session.last_active = time.monotonic()
+        self._sessions.move_to_end(session.session_id)
+        return session, reset
+
+    def append(self, session: ChatSession, role: str, content: str):
+        session.turns.append(SessionTurn.create(role, content))
+        if len(session.turns) > self.max_turns:
+            del session.turns[:len(session.turns) - self.max_turns]
+        session.last_active = time.monotonic()
+
+    def __len__(self):
+        return len(self._sessions)
+
+def _summarize_dropped_turns(dropped_turns: List[SessionTurn], token_budget: int) -> str:
+    """
+    Cheap extractive summary of turns that no longer fit: the most recent earlier user questions,
+    each shortened, kept only while they fit in `token_budget`.
+    """
+    header = "Summary of earlier conversation (older turns omitted): the user previously asked about "
+    budget_left = token_budget - count_tokens(header)
+    topics = []
+    for turn in reversed(dropped_turns):
+        if turn.role != "user":
+            continue
+        words = turn.content.split()
+        topic = " ".join(words[:15]) + ("..." if len(words) > 15 else "")
+        topic_tokens = count_tokens(topic) + 1
+        if topic_tokens > budget_left:
+            break
+        topics.append(topic)
+        budget_left -= topic_tokens
+    if not topics:
+        return ""
+    return header + "; ".join(reversed(topics)) + ".\n"
+
+def assemble_conversation(turns: List[Any], user_message: str, token_budget: int,
+                          summary_token_budget: int = 200) -> Tuple[str, int, int]:
+    """
+    Builds the "Conversation History and Current Question" block within `token_budget` tokens.
+    The newest turns are kept verbatim; older turns that do not fit are folded into a short summary or dropped.
+    `turns` may be SessionTurns (token counts already cached) or any objects with `role` and `content`.
+    Returns (conversation_text, token_count, number_of_turns_omitted).
+    """
+    current_line = f"User: {user_message}"
+    used_tokens = count_tokens(current_line)
+    history_budget = max(0, token_budget - used_tokens)
+
+    session_turns = [turn if isinstance(turn, SessionTurn) else SessionTurn.create(turn.role, turn.content)
+                     for turn in turns if turn.role in ("user", "assistant")]
+
+    # Reserve room for the summary only when the full history does not fit anyway
+    if sum(turn.tokens for turn in session_turns) <= history_budget:
+        window_budget = history_budget
+    else:
+        window_budget = max(0, history_budget - summary_token_budget)
+
+    kept_lines = []
+    kept_tokens = 0
+    first_kept = len(session_turns)
+    for index in range(len(session_turns) - 1, -1, -1):
+        turn = session_turns[index]
+        if kept_tokens + turn.tokens > window_budget:
+            break
+        kept_lines.append(turn.line)
+        kept_tokens += turn.tokens
+        first_kept = index
+
+    summary = ""
+    dropped_turns = session_turns[:first_kept]
+    if dropped_turns:
+        summary = _summarize_dropped_turns(dropped_turns, min(summary_token_budget, history_budget - kept_tokens))
+    summary_tokens = count_tokens(summary)
+
+    conversation_text = summary + "".join(reversed(kept_lines)) + current_line
+    return conversation_text, used_tokens + kept_tokens + summary_tokens, len(dropped_turns)
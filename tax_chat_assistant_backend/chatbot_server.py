@@ -1,59 +1,84 @@
 import os
+import asyncio
 import logging
-import logging.handlers
-from huggingface_hub import InferenceClient
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uvicorn
 from dotenv import load_dotenv
 import json
+import time
 import traceback
 import sys
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+if project_root not in sys.path:
+    sys.path.append(project_root)
 
 # --- Setup Logging --- 
-LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
-os.makedirs(LOG_DIR, exist_ok=True)
-log_file_path = os.path.join(LOG_DIR, 'chatbot_kag.log')
-log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=10*1024*1024, backupCount=5)
-file_handler.setFormatter(log_formatter)
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(file_handler)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-console_handler.setLevel(logging.INFO)
-root_logger.addHandler(console_handler)
+# Records are handed to a background listener thread, so disk I/O stays off the request path
+from backend_shared.logging_setup import setup_logging, log_payload
+from backend_shared.admission import AdmissionController, AdmissionRejected, admission_rejected_handler, INTERACTIVE, BACKGROUND
+from backend_shared.llm_client import ResilientLLMClient, CircuitOpenError
+LOG_DIR = os.path.join(current_dir, 'logs')
+setup_logging('chatbot_kag', LOG_DIR)
 logger = logging.getLogger(__name__) 
 # --- End Logging Setup ---
 
 # --- Tax Knowledge Engine Imports ---
-current_dir = os.path.dirname(os.path.abspath(__file__))
-project_root = os.path.dirname(current_dir)
 sys.path.append(os.path.join(project_root, 'tax_knowledge_engine'))
 from kg_retriever import KnowledgeGraphAgenticRetriever # <-- ADD THIS
+from semantic_cache import SemanticResponseCache
+from chat_sessions import ChatSessionStore, assemble_conversation, count_tokens
+from expense_aggregation import summarize_expenses, format_expense_summary
+from request_coalescing import SingleFlight, payload_fingerprint
+from metrics import STAGE_LATENCY, REQUEST_LATENCY, PROMPT_TOKENS, COMPLETION_TOKENS, EARLY_STOPS, observe_stage, query_type_label
+from insight_parser import InsightListParser, parse_insight_list
 
 load_dotenv()
 
 # --- Configuration --- 
 HUGGING_FACE_API_TOKEN = os.getenv("HUGGING_FACE_API_TOKEN") 
 MISTRAL_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.3" 
+# Upper bound on generations in flight at once; further chats wait for a free slot.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# Seconds a single chat may spend waiting for a slot plus generating before it is abandoned.
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+# Opt-in semantic answer cache for regular (non smart-assistant) chat questions.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+# Server-side chat sessions and the prompt token budget they are assembled into.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+HISTORY_SUMMARY_TOKEN_BUDGET = int(os.getenv("HISTORY_SUMMARY_TOKEN_BUDGET", "200"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "10000"))
+# Identical in-flight /chat computations are shared; successful results are reused for this long (0 disables).
+COALESCE_RESULT_TTL_SECONDS = float(os.getenv("COALESCE_RESULT_TTL_SECONDS", "30"))
 
 # --- Global Initializations ---
+# One async client for the whole process so every chat reuses the same HTTP connection pool
+# instead of blocking the event loop on a synchronous call. Slow calls are hedged, transient
+# errors retried, and a circuit breaker fails fast while the endpoint is unhealthy.
 hf_client = None
 if HUGGING_FACE_API_TOKEN:
     try:
-        hf_client = InferenceClient(model=MISTRAL_MODEL_ID, token=HUGGING_FACE_API_TOKEN)
-        logger.info(f"Hugging Face InferenceClient initialized globally for model: {MISTRAL_MODEL_ID}.")
+        hf_client = ResilientLLMClient("chatbot", MISTRAL_MODEL_ID, token=HUGGING_FACE_API_TOKEN, timeout=LLM_REQUEST_TIMEOUT)
+        logger.info(f"Hugging Face AsyncInferenceClient initialized globally for model: {hf_client.model} (max in-flight generations: {LLM_MAX_CONCURRENCY}).")
     except Exception as e:
         logger.error(f"Error initializing Hugging Face InferenceClient globally: {e}", exc_info=True)
         # Depending on the application's needs, you might want to raise an error here or exit
 else:
     logger.warning("HUGGING_FACE_API_TOKEN not found. Hugging Face client not initialized.")
 
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
 # Initialize the KnowledgeGraphAgenticRetriever globally
 tax_retriever = None
 try:
@@ -63,7 +88,36 @@ except Exception as e:
     logger.error(f"Error initializing KnowledgeGraphAgenticRetriever globally: {e}", exc_info=True)
     # Decide how to handle this - server might not be able to run if KAG is critical
 
-app = FastAPI()
+session_store = ChatSessionStore(ttl_seconds=SESSION_TTL_SECONDS, max_sessions=SESSION_MAX_COUNT)
+chat_single_flight = SingleFlight(result_ttl_seconds=COALESCE_RESULT_TTL_SECONDS)
+# Interactive chat is admitted ahead of background smart-assistant insights when the server is saturated
+admission_controller = AdmissionController("chatbot")
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    try:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        from simple_retriever import EMBEDDING_MODEL_NAME
+        cache_embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        semantic_cache = SemanticResponseCache(
+            embed_fn=cache_embeddings.embed_query,
+            similarity_threshold=SEMANTIC_CACHE_THRESHOLD,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+        )
+        logger.info(f"Semantic response cache enabled (threshold {SEMANTIC_CACHE_THRESHOLD}, max {SEMANTIC_CACHE_MAX_ENTRIES} entries, TTL {SEMANTIC_CACHE_TTL_SECONDS}s).")
+    except Exception as e:
+        logger.error(f"Error initializing semantic response cache. Continuing without it: {e}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if hf_client:
+        await hf_client.close()
+        logger.info("Hugging Face AsyncInferenceClient closed.")
+
+app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
 
 app.add_middleware(
     CORSMiddleware,
@@ -83,8 +137,52 @@ class ChatRequest(BaseModel):
     history: List[Message] = Field(default_factory=list)
     expenses: Optional[List[Dict[str, Any]]] = Field(default_factory=list)
     is_smart_assistant_query: Optional[bool] = False
+    # The session_id of an earlier response; the server keeps the conversation, so `history` is only
+    # needed to seed a new session. Unknown or expired ids get a new session ("session_reset": true).
+    session_id: Optional[str] = None
+
+async def _generate(final_prompt: str, is_smart_assistant_query: bool) -> str:
+    """
+    Runs one generation on the shared client, holding a concurrency slot for its duration.
+    The response is streamed so time-to-first-token and completion tokens can be measured.
+    Smart-assistant generations stop as soon as a complete JSON insight list has arrived.
+    """
+    queued_at = time.perf_counter()
+    async with llm_semaphore:
+        started = time.perf_counter()
+        STAGE_LATENCY.labels("queue_wait").observe(started - queued_at)
+        token_stream = hf_client.stream_text_generation(
+            prompt=final_prompt,
+            max_new_tokens=500 if not is_smart_assistant_query else 150, 
+            temperature=0.7 if not is_smart_assistant_query else 0.2, 
+            do_sample=True, 
+            return_full_text=False
+        )
+        chunks = []
+        insight_parser = InsightListParser() if is_smart_assistant_query else None
+        try:
+            async for token_text in token_stream:
+                if not chunks:
+                    STAGE_LATENCY.labels("llm_ttft").observe(time.perf_counter() - started)
+                chunks.append(token_text)
+                if insight_parser and insight_parser.feed(token_text):
+                    EARLY_STOPS.inc()
+                    break
+        finally:
+            # Closing the stream drops the connection, which ends generation on the inference server
+            await token_stream.aclose()
+        STAGE_LATENCY.labels("llm_generation").observe(time.perf_counter() - started)
+        COMPLETION_TOKENS.labels(query_type_label(is_smart_assistant_query)).inc(len(chunks))
+    if insight_parser and insight_parser.complete:
+        return insight_parser.text
+    return "".join(chunks)
 
-async def chat_with_assistant(user_message: str, chat_history: List[Message], is_smart_assistant_query: bool, expenses: Optional[List[Dict[str, Any]]]):
+async def admitted_chat_with_assistant(user_message: str, chat_history: List[Any], is_smart_assistant_query: bool, expenses: Optional[List[Dict[str, Any]]]):
+    """Runs chat_with_assistant once admitted; smart-assistant insights queue behind interactive chat."""
+    async with admission_controller.admit(BACKGROUND if is_smart_assistant_query else INTERACTIVE):
+        return await chat_with_assistant(user_message, chat_history, is_smart_assistant_query, expenses)
+
+async def chat_with_assistant(user_message: str, chat_history: List[Any], is_smart_assistant_query: bool, expenses: Optional[List[Dict[str, Any]]]):
     """Handles the chat logic with the assistant, incorporating KAG and using Mistral model."""
     if not hf_client:
         logger.error("hf_client not initialized in chat_with_assistant")
@@ -99,10 +197,17 @@ async def chat_with_assistant(user_message: str, chat_history: List[Message], is
     kag_response_content = ""
     insights_for_response = [] # This will hold the KAG response if applicable
 
+    # Large expense lists are reduced to a fixed-size summary so prompt size does not grow with row count
+    expense_summary = None
+    if is_smart_assistant_query and expenses:
+        expense_summary = await asyncio.to_thread(summarize_expenses, expenses)
+        logger.info(f"Aggregated {expense_summary['count']} expenses into a summary for the smart assistant prompt.")
+
     if user_message:
         query_for_retrieval = user_message
         if is_smart_assistant_query and expenses:
-            expense_summary_for_query = "User has provided expense data. "
+            top_categories = ", ".join(c["category"] for c in expense_summary["categories"][:3])
+            expense_summary_for_query = f"User has provided expense data (top categories: {top_categories}). "
             query_for_retrieval = expense_summary_for_query + user_message
         elif is_smart_assistant_query and not expenses:
             query_for_retrieval = "General Malaysian tax tips or financial advice. " + user_message
@@ -111,11 +216,12 @@ async def chat_with_assistant(user_message: str, chat_history: List[Message], is
             logger.info(f"Retrieving context from KAG for query: {query_for_retrieval[:100]}...")
             # Use the KAG retriever's retrieve method
             # The KAG retriever's `retrieve` method is async as per kg_retriever.py
-            kag_response_content = await tax_retriever.retrieve(natural_language_query=query_for_retrieval)
+            with observe_stage("kag_retrieval"):
+                kag_response_content = await tax_retriever.retrieve(natural_language_query=query_for_retrieval)
             
             if kag_response_content and isinstance(kag_response_content, str):
                 retrieved_context_str = f"\n\nRelevant Information from Knowledge Base (for assistant's reference only, do not directly quote to user unless asked):\n{kag_response_content}\n"
-                logger.info(f"KAG Retrieved context: {retrieved_context_str[:300]}...")
+                log_payload(logger, "KAG Retrieved context", retrieved_context_str)
                 # For now, let's assume the KAG response itself can be an "insight"
                 # This might need adjustment based on how KAG's response is structured
                 insights_for_response = [kag_response_content] 
@@ -133,6 +239,7 @@ async def chat_with_assistant(user_message: str, chat_history: List[Message], is
     else:
         logger.info("No user message provided for KAG retrieval.")
 
+    assembly_started = time.perf_counter()
     system_instruction = ""
     if is_smart_assistant_query:
         system_instruction = (
@@ -150,45 +257,60 @@ async def chat_with_assistant(user_message: str, chat_history: List[Message], is
             "Only use lists/bullet points if the user EXPLICITLY asks for them (e.g., 'list the types of...')."
         )
 
+    if expense_summary:
+        system_instruction += f"\n\n{format_expense_summary(expense_summary)}"
+
     if retrieved_context_str: # This now comes from KAG
         system_instruction += f"\n\nUse the following retrieved information to inform your answer:\n{retrieved_context_str}"
 
-    full_conversation_text = ""
-    for msg in chat_history:
-        if msg.role == 'user':
-            full_conversation_text += f"User: {msg.content}\n"
-        elif msg.role == 'assistant':
-            full_conversation_text += f"Assistant: {msg.content}\n"
-    full_conversation_text += f"User: {user_message}"
+    # Keep the whole prompt within PROMPT_TOKEN_BUDGET: newest turns verbatim, older ones summarized or dropped
+    history_token_budget = PROMPT_TOKEN_BUDGET - count_tokens(system_instruction)
+    full_conversation_text, conversation_tokens, omitted_turns = assemble_conversation(
+        chat_history, user_message, history_token_budget, summary_token_budget=HISTORY_SUMMARY_TOKEN_BUDGET
+    )
+    if omitted_turns:
+        logger.info(f"Prompt history trimmed to {conversation_tokens} tokens; {omitted_turns} older turns summarized or dropped.")
 
     final_prompt = f"[INST] {system_instruction}\n\nConversation History and Current Question:\n{full_conversation_text}\n\nAssistant: [/INST]"
+    PROMPT_TOKENS.labels(query_type_label(is_smart_assistant_query)).inc(count_tokens(final_prompt))
+    STAGE_LATENCY.labels("prompt_assembly").observe(time.perf_counter() - assembly_started)
 
     logger.info(f"Sending prompt to Mistral. Smart assistant: {is_smart_assistant_query}. Model: {MISTRAL_MODEL_ID}")
 
     try:
-        completion = hf_client.text_generation(
-            prompt=final_prompt,
-            max_new_tokens=500 if not is_smart_assistant_query else 150, 
-            temperature=0.7 if not is_smart_assistant_query else 0.2, 
-            do_sample=True, 
-            return_full_text=False 
+        completion = await asyncio.wait_for(
+            _generate(final_prompt, is_smart_assistant_query), timeout=LLM_REQUEST_TIMEOUT
         )
         response_content = completion.strip()
-        logger.info(f"Mistral Raw Response: {response_content}")
+        log_payload(logger, "Mistral Raw Response", response_content)
         # insights_for_response now contains the KAG response string as a list item
-        return response_content, insights_for_response 
+        return response_content, insights_for_response, True
 
+    except asyncio.TimeoutError:
+        logger.error(f"Hugging Face LLM call exceeded the {LLM_REQUEST_TIMEOUT}s request timeout.")
+        error_message = "The AI model took too long to respond. Please try again."
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping Hugging Face LLM call: {e}")
+        error_message = "The AI model is temporarily unavailable. Please try again in a little while."
+        if kag_response_content and not is_smart_assistant_query:
+            # Degraded answer: the knowledge-base context on its own is still useful to the user
+            error_message += f" In the meantime, here is the most relevant information from the knowledge base:\n\n{kag_response_content}"
     except Exception as e:
         logger.error(f"Error during Hugging Face LLM call: {e}", exc_info=True)
         error_message = f"Error communicating with the AI model: {str(e)}"
-        if is_smart_assistant_query:
-            return json.dumps([error_message]), insights_for_response # Return KAG insights even if LLM fails
-        else:
-            return error_message, insights_for_response
+
+    if is_smart_assistant_query:
+        return json.dumps([error_message]), insights_for_response, False # Return KAG insights even if LLM fails
+    else:
+        return error_message, insights_for_response, False
 
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """Endpoint to receive chat messages and return assistant's response."""
+    with REQUEST_LATENCY.labels(query_type_label(request.is_smart_assistant_query)).time():
+        return await _handle_chat(request)
+
+async def _handle_chat(request: ChatRequest):
     if not HUGGING_FACE_API_TOKEN or not hf_client:
         logger.error("HUGGING_FACE_API_TOKEN not set or hf_client not initialized in chat_endpoint.")
         raise HTTPException(status_code=500, detail="AI service not configured.")
@@ -205,42 +327,87 @@ async def chat_endpoint(request: ChatRequest):
         else:
             raise HTTPException(status_code=422, detail="No query provided for chat.")
 
+    # Regular chat runs inside a server-side session; smart-assistant queries are one-shot
+    session = None
+    session_reset = False
+    chat_history = request.history
+    if not request.is_smart_assistant_query:
+        if request.session_id and not request.history and session_store.get(request.session_id) is None:
+            # Answering without the earlier turns would lose the conversation; the client resends them
+            raise HTTPException(status_code=409, detail="Chat session expired or unknown; resend the message with the full history.")
+        session, session_reset = session_store.get_or_create(request.session_id, seed_history=request.history)
+        chat_history = session.turns
+
+    use_semantic_cache = semantic_cache is not None and not request.is_smart_assistant_query
+    if use_semantic_cache:
+        kb_version = tax_retriever.knowledge_base_version()
+        history_fingerprint = semantic_cache.history_fingerprint(chat_history)
+        try:
+            cached_content = await semantic_cache.lookup(user_query_to_send, history_fingerprint, kb_version)
+            if cached_content is not None:
+                session_store.append(session, "user", user_query_to_send)
+                session_store.append(session, "assistant", cached_content["assistant_reply"])
+                return JSONResponse(content={**cached_content, "session_id": session.session_id, "session_reset": session_reset})
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed, answering without it: {e}", exc_info=True)
+
     try:
-        response_content, insights_from_kag = await chat_with_assistant(
-            user_query_to_send, 
-            request.history, 
-            request.is_smart_assistant_query, 
-            request.expenses
+        # Bursts of identical requests (e.g. the smart assistant firing on every screen load) share one KAG+LLM run
+        history_snapshot = list(chat_history)
+        coalesce_key = await asyncio.to_thread(
+            payload_fingerprint, user_query_to_send, history_snapshot, request.is_smart_assistant_query, request.expenses
+        )
+        response_content, insights_from_kag, llm_ok = await chat_single_flight.do(
+            coalesce_key,
+            lambda: admitted_chat_with_assistant(
+                user_query_to_send, 
+                history_snapshot, 
+                request.is_smart_assistant_query, 
+                request.expenses
+            ),
+            should_cache=lambda result: result[2], # Never reuse an LLM error reply
         )
         
         if request.is_smart_assistant_query:
-            try:
-                insights = json.loads(response_content)
-                if not isinstance(insights, list) or not all(isinstance(item, str) for item in insights):
-                    logger.warning(f"LLM response for smart assistant is not a list of strings: {response_content}")
-                    insights = ["Received non-standard insight format. Please try refreshing.", response_content]
+            with observe_stage("json_repair"):
+                # Fences, stray quotes, trailing commas and cut-off lists are repaired locally, without another LLM call
+                insights = parse_insight_list(response_content)
+                if insights is None:
+                    logger.warning(f"Could not recover an insight list from smart assistant response: {response_content}")
+                    return JSONResponse(content=["AI response was not valid JSON. Raw: " + response_content])
                 return JSONResponse(content=insights)
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to decode LLM response as JSON for smart assistant: {response_content}")
-                if response_content.startswith('[') and response_content.endswith(']'):
-                    try:
-                        cleaned_response = response_content.replace("'", "\"")
-                        insights = json.loads(cleaned_response)
-                        if isinstance(insights, list) and all(isinstance(item, str) for item in insights):
-                            return JSONResponse(content=insights)
-                    except Exception as parse_err:
-                        logger.error(f"Could not manually parse cleaned smart assistant response: {parse_err}")
-                return JSONResponse(content=["AI response was not valid JSON. Raw: " + response_content])
         else:
             # For regular chat, include KAG insights (which is the KAG response string in a list)
-            return JSONResponse(content={"assistant_reply": response_content, "retrieved_info_snippets": insights_from_kag})
+            response_payload = {"assistant_reply": response_content, "retrieved_info_snippets": insights_from_kag}
+            if llm_ok:
+                session_store.append(session, "user", user_query_to_send)
+                session_store.append(session, "assistant", response_content)
+            if use_semantic_cache and llm_ok:
+                try:
+                    await semantic_cache.store(user_query_to_send, history_fingerprint, kb_version, response_payload)
+                except Exception as e:
+                    logger.error(f"Failed to store answer in semantic cache: {e}", exc_info=True)
+            return JSONResponse(content={**response_payload, "session_id": session.session_id, "session_reset": session_reset})
 
-    except HTTPException as http_exc: 
-        raise http_exc
+    except (HTTPException, AdmissionRejected): 
+        raise
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+@app.get("/metrics")
+async def metrics():
+    """Per-stage latency histograms and token counters in Prometheus text format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Counters for the semantic response cache and for request coalescing."""
+    return {
+        "semantic_cache": {"enabled": True, **semantic_cache.stats()} if semantic_cache else {"enabled": False},
+        "request_coalescing": chat_single_flight.stats(),
+    }
+
 if __name__ == "__main__":
     if not hf_client or not tax_retriever:
         logger.critical("One or more critical services (HF Client, KAG Retriever) failed to initialize. Server cannot start.")
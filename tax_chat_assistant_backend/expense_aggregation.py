@@ -0,0 +1,128 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Indicative Malaysian personal relief caps (RM per year of assessment) for the expense categories
+# produced by the receipt backend. Categories sharing a relief share its cap.
+RELIEF_CAPS = {
+    "Lifestyle": {
+        "cap": 2500.0,
+        "categories": ["Books & Publications", "Computer & IT Equipment", "Software & Subscriptions",
+                       "Utilities (Electricity, Water, Internet)"],
+    },
+    "Medical expenses": {"cap": 10000.0, "categories": ["Healthcare & Medical"]},
+    "Education fees (self)": {"cap": 7000.0, "categories": ["Education & Training"]},
+    "Education & medical insurance": {"cap": 3000.0, "categories": ["Insurance"]},
+}
+
+# Keeps the prompt the same size whether a user has 10 expenses or 10,000
+MAX_CATEGORIES_IN_SUMMARY = 8
+MAX_MONTHS_IN_SUMMARY = 6
+MAX_MERCHANTS_IN_SUMMARY = 5
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+def _grouped_totals(labels: List[str], amounts: np.ndarray):
+    """Sums `amounts` per distinct label; returns (labels, totals, counts) sorted by total descending."""
+    unique_labels, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    totals = np.bincount(inverse, weights=amounts, minlength=len(unique_labels))
+    counts = np.bincount(inverse, minlength=len(unique_labels))
+    order = np.argsort(-totals, kind="stable")
+    return unique_labels[order], totals[order], counts[order]
+
+def summarize_expenses(expenses: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Reduces raw expense rows (as sent by the Flutter Expense.toJson) to a fixed-size summary:
+    per-category and per-month totals, deductible vs non-deductible split, progress against
+    relief caps and the top merchants.
+    """
+    if not expenses:
+        return {"count": 0}
+
+    amounts = np.fromiter((_to_float(e.get("amount")) for e in expenses), dtype=np.float64, count=len(expenses))
+    deductible = np.fromiter((_to_bool(e.get("is_deductible")) for e in expenses), dtype=bool, count=len(expenses))
+    categories = [str(e.get("category") or "Other") for e in expenses]
+    months = [str(e.get("date") or "")[:7] or "unknown" for e in expenses]
+    merchants = [str(e.get("merchant") or "Unknown").strip() or "Unknown" for e in expenses]
+
+    category_labels, category_totals, category_counts = _grouped_totals(categories, amounts)
+    month_labels, month_totals, _ = _grouped_totals(months, amounts)
+    merchant_labels, merchant_totals, merchant_counts = _grouped_totals(merchants, amounts)
+
+    # Months are reported chronologically (most recent last), keeping only the latest few
+    month_order = np.argsort(month_labels)[-MAX_MONTHS_IN_SUMMARY:]
+
+    deductible_by_category = {}
+    if deductible.any():
+        deductible_categories = [category for category, is_deductible in zip(categories, deductible) if is_deductible]
+        labels, totals, _ = _grouped_totals(deductible_categories, amounts[deductible])
+        deductible_by_category = dict(zip(labels.tolist(), totals.tolist()))
+
+    relief_progress = []
+    for relief_name, relief in RELIEF_CAPS.items():
+        claimed = sum(deductible_by_category.get(category, 0.0) for category in relief["categories"])
+        if claimed <= 0:
+            continue
+        relief_progress.append({
+            "relief": relief_name,
+            "claimed": round(claimed, 2),
+            "cap": relief["cap"],
+            "remaining": round(max(0.0, relief["cap"] - claimed), 2),
+            "percent_used": round(min(100.0, 100.0 * claimed / relief["cap"]), 1),
+        })
+
+    return {
+        "count": len(expenses),
+        "total": round(float(amounts.sum()), 2),
+        "deductible_total": round(float(amounts[deductible].sum()), 2),
+        "non_deductible_total": round(float(amounts[~deductible].sum()), 2),
+        "categories": [
+            {"category": label, "total": round(float(total), 2), "count": int(count)}
+            for label, total, count in zip(category_labels[:MAX_CATEGORIES_IN_SUMMARY],
+                                           category_totals[:MAX_CATEGORIES_IN_SUMMARY],
+                                           category_counts[:MAX_CATEGORIES_IN_SUMMARY])
+        ],
+        "other_categories_count": max(0, len(category_labels) - MAX_CATEGORIES_IN_SUMMARY),
+        "months": [
+            {"month": str(month_labels[i]), "total": round(float(month_totals[i]), 2)} for i in month_order
+        ],
+        "relief_progress": relief_progress,
+        "top_merchants": [
+            {"merchant": label, "total": round(float(total), 2), "count": int(count)}
+            for label, total, count in zip(merchant_labels[:MAX_MERCHANTS_IN_SUMMARY],
+                                           merchant_totals[:MAX_MERCHANTS_IN_SUMMARY],
+                                           merchant_counts[:MAX_MERCHANTS_IN_SUMMARY])
+        ],
+    }
+
+def format_expense_summary(summary: Dict[str, Any]) -> str:
+    """Renders a summary from summarize_expenses() as compact prompt text."""
+    if not summary.get("count"):
+        return "The user has not provided any expenses."
+
+    lines = [
+        f"User expense summary ({summary['count']} expenses, total RM{summary['total']:.2f}; "
+        f"deductible RM{summary['deductible_total']:.2f}, non-deductible RM{summary['non_deductible_total']:.2f}):",
+        "By category: " + "; ".join(
+            f"{c['category']} RM{c['total']:.2f} ({c['count']})" for c in summary["categories"]
+        ) + (f"; plus {summary['other_categories_count']} smaller categories" if summary["other_categories_count"] else ""),
+        "By month: " + "; ".join(f"{m['month']} RM{m['total']:.2f}" for m in summary["months"]),
+        "Top merchants: " + "; ".join(
+            f"{m['merchant']} RM{m['total']:.2f} ({m['count']})" for m in summary["top_merchants"]
+        ),
+    ]
+    if summary["relief_progress"]:
+        lines.append("Relief cap progress: " + "; ".join(
+            f"{r['relief']} RM{r['claimed']:.2f} of RM{r['cap']:.0f} ({r['percent_used']}% used, RM{r['remaining']:.2f} left)"
+            for r in summary["relief_progress"]
+        ))
+    return "\n".join(lines)
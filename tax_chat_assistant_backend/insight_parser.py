@@ -0,0 +1,166 @@
+import json
+import re
+from typing import Any, List, Optional
+
+# Quote characters the model uses for insight strings, mapped to the character that closes them
+_QUOTE_PAIRS = {'"': '"', "'": "'", "“": "”", "‘": "’"}
+_BULLET_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+(.+)$")
+
+class InsightListParser:
+    """
+    Incremental scanner for the smart assistant's `["insight", ...]` reply. Tokens are fed as they
+    stream in; once the top-level list closes, `complete` is set and `text` holds the reply up to the
+    closing bracket, so the caller can stop generation instead of paying for trailing chatter.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self._chunks: List[str] = []
+        self._length = 0
+        self._depth = 0
+        self._quote: Optional[str] = None # Closing character of the string being scanned
+        self._escaped = False
+        self._last_significant = "" # Last non-whitespace character outside strings
+        self._end = None
+
+    @property
+    def text(self) -> str:
+        joined = "".join(self._chunks)
+        return joined[:self._end] if self._end is not None else joined
+
+    def feed(self, chunk: str) -> bool:
+        """Consumes one streamed chunk; returns True once a complete top-level list has been seen."""
+        if self.complete:
+            return True
+        offset = self._length
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        for i, char in enumerate(chunk):
+            if self._quote is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+            elif self._depth == 0:
+                if char == "[":
+                    self._depth = 1
+            elif char in _QUOTE_PAIRS and (char != "'" or self._last_significant in "[,"):
+                # An apostrophe only opens a string right after '[' or ',', not inside a bare word
+                self._quote = _QUOTE_PAIRS[char]
+            elif char == "[":
+                self._depth += 1
+            elif char == "]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end = offset + i + 1
+                    self.complete = True
+                    return True
+            if self._quote is None and not char.isspace():
+                self._last_significant = char
+        return False
+
+def _scan_items(body: str) -> List[str]:
+    """
+    Lenient scan of everything after the opening '[': collects quoted items (double, single or
+    typographic quotes, with apostrophes allowed inside) and bare comma-separated items. An
+    unterminated final string, left by a cut-off generation, is kept only if it is the sole item.
+    """
+    items: List[str] = []
+    truncated_item = None
+    i, n = 0, len(body)
+    while i < n:
+        char = body[i]
+        if char in " \t\r\n,":
+            i += 1
+        elif char == "]":
+            break
+        elif char in _QUOTE_PAIRS:
+            closing = _QUOTE_PAIRS[char]
+            j = i + 1
+            buffer = []
+            closed = False
+            while j < n:
+                if body[j] == "\\" and j + 1 < n:
+                    buffer.append(body[j:j + 2])
+                    j += 2
+                    continue
+                if body[j] == closing:
+                    following = body[j + 1:].lstrip()
+                    # A quote followed by more words is an apostrophe or inner quote, not the end of the item
+                    if not following or following[0] in ",]":
+                        closed = True
+                        break
+                buffer.append(body[j])
+                j += 1
+            raw = "".join(buffer)
+            try:
+                value = json.loads(f'"{raw}"')
+            except json.JSONDecodeError:
+                value = raw.replace('\\"', '"').replace("\\'", "'")
+            if closed:
+                items.append(value.strip())
+                i = j + 1
+            else:
+                truncated_item = value.strip()
+                break
+        else:
+            j = i
+            while j < n and body[j] not in ",]":
+                j += 1
+            items.append(body[i:j].strip())
+            i = j
+    if not items and truncated_item:
+        items.append(truncated_item)
+    return [item for item in items if item]
+
+def _coerce_items(value: List[Any]) -> List[str]:
+    insights = []
+    for item in value:
+        if isinstance(item, str):
+            insights.append(item)
+        elif isinstance(item, dict):
+            # e.g. [{"insight": "..."}]: keep the text fields
+            insights.extend(str(v) for v in item.values() if isinstance(v, str))
+        elif item is not None:
+            insights.append(str(item))
+    return [insight.strip() for insight in insights if insight.strip()]
+
+def parse_insight_list(response_text: str) -> Optional[List[str]]:
+    """
+    Turns the smart assistant's reply into a list of insight strings, repairing the usual defects
+    locally: markdown fences, prose around the list, single or typographic quotes, trailing
+    commas, a list cut off by the token limit, and bulleted lines instead of JSON.
+    Returns None when nothing usable can be recovered.
+    """
+    text = (response_text or "").strip()
+    try:
+        value = json.loads(text)
+        if isinstance(value, list):
+            insights = _coerce_items(value)
+            if insights:
+                return insights
+    except json.JSONDecodeError:
+        pass
+
+    start = text.find("[")
+    if start != -1:
+        parser = InsightListParser()
+        parser.feed(text[start:])
+        candidate = parser.text
+        if parser.complete:
+            try:
+                value = json.loads(re.sub(r",\s*]$", "]", candidate))
+                if isinstance(value, list):
+                    insights = _coerce_items(value)
+                    if insights:
+                        return insights
+            except json.JSONDecodeError:
+                pass
+        insights = _scan_items(candidate[1:])
+        if insights:
+            return insights
+
+    bullets = [match.group(1).strip() for match in map(_BULLET_RE.match, text.splitlines()) if match]
+    return bullets or None
@@ -0,0 +1,76 @@
+"""
+Concurrent load test for the /chat endpoint of chatbot_server.py.
+
+Fires a fixed number of chat requests with a bounded number in flight and reports
+throughput and latency percentiles, so we can confirm that one server process keeps
+serving many chats at once instead of handling them one at a time.
+
+Usage (with the server already running on port 8003):
+    python load_test.py --concurrency 40 --requests 200
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+DEFAULT_URL = "http://localhost:8003/chat"
+DEFAULT_MESSAGES = [
+    "Is my laptop claimable under lifestyle relief?",
+    "What is the limit for medical expenses relief?",
+    "Can I claim my parents' medical bills?",
+    "Are gym memberships tax deductible in Malaysia?",
+]
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+async def run_load_test(url: str, concurrency: int, total_requests: int, timeout: float):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    status_counts = {}
+
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one_request(i: int):
+            payload = {
+                "message": DEFAULT_MESSAGES[i % len(DEFAULT_MESSAGES)],
+                "history": [],
+                "expenses": [],
+                "is_smart_assistant_query": False,
+            }
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                status_counts[status] = status_counts.get(status, 0) + 1
+
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(one_request(i) for i in range(total_requests)))
+        wall_elapsed = time.perf_counter() - wall_started
+
+    latencies.sort()
+    print("\n--- /chat Load Test Results ---")
+    print(f"URL: {url}")
+    print(f"Requests: {total_requests}, concurrency: {concurrency}")
+    print(f"Wall time: {wall_elapsed:.2f}s, throughput: {total_requests / wall_elapsed:.2f} req/s")
+    print(f"Latency p50: {percentile(latencies, 50):.3f}s, p95: {percentile(latencies, 95):.3f}s, "
+          f"p99: {percentile(latencies, 99):.3f}s, max: {latencies[-1]:.3f}s")
+    print(f"Status codes: {status_counts}")
+    print("-------------------------------")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chatbot /chat endpoint.")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+    asyncio.run(run_load_test(args.url, args.concurrency, args.requests, args.timeout))
@@ -0,0 +1,51 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+# Buckets span fast local stages (milliseconds) up to full LLM generations (tens of seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# Per-stage /chat latency. Stages: queue_wait, kag_retrieval, prompt_assembly, llm_ttft, llm_generation, json_repair
+STAGE_LATENCY = Histogram(
+    "chatbot_stage_duration_seconds",
+    "Time spent in each stage of a /chat request.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+REQUEST_LATENCY = Histogram(
+    "chatbot_request_duration_seconds",
+    "End-to-end /chat handling time.",
+    ["query_type"],
+    buckets=LATENCY_BUCKETS,
+)
+
+PROMPT_TOKENS = Counter(
+    "chatbot_llm_prompt_tokens",
+    "Prompt tokens sent to the LLM (tiktoken cl100k_base estimate).",
+    ["query_type"],
+)
+
+COMPLETION_TOKENS = Counter(
+    "chatbot_llm_completion_tokens",
+    "Completion tokens streamed back from the LLM.",
+    ["query_type"],
+)
+
+EARLY_STOPS = Counter(
+    "chatbot_llm_early_stops",
+    "Smart-assistant generations cut off once a complete JSON insight list had streamed in.",
+)
+
+def query_type_label(is_smart_assistant_query: bool) -> str:
+    return "smart_assistant" if is_smart_assistant_query else "chat"
+
+@contextmanager
+def observe_stage(stage: str):
+    """Records the duration of the enclosed block under STAGE_LATENCY{stage=...}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+def payload_fingerprint(message: str, history: List[Any], is_smart_assistant_query: bool,
+                        expenses: Optional[List[Dict[str, Any]]]) -> str:
+    """
+    Hash of everything that determines a /chat answer. Whitespace and case in the message are
+    normalized and expense rows are order-independent, so repeated smart-assistant loads of
+    the same expense set map to the same key.
+    """
+    normalized_message = re.sub(r"\s+", " ", (message or "").strip().lower())
+    turns = [(getattr(msg, "role", ""), getattr(msg, "content", "")) for msg in history]
+    expense_rows = sorted(json.dumps(row, sort_keys=True, default=str) for row in (expenses or []))
+    canonical = json.dumps([normalized_message, turns, bool(is_smart_assistant_query), expense_rows], ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent computations: the first caller for a key starts the work and
+    every caller arriving while it runs awaits the same task. Successful results are also kept
+    for `result_ttl_seconds` so a burst arriving just after completion is absorbed too.
+    The shared task is shielded, so a caller disconnecting does not cancel it for the others.
+    """
+
+    def __init__(self, result_ttl_seconds: float = 30.0, max_results: int = 1000):
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_results = max_results
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._results: "OrderedDict[str, tuple]" = OrderedDict() # key -> (stored_at, result)
+        self._stats = {"executions": 0, "joined": 0, "result_cache_hits": 0}
+
+    def _cached_result(self, key: str):
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        stored_at, result = cached
+        if time.monotonic() - stored_at > self.result_ttl_seconds:
+            del self._results[key]
+            return None
+        return cached
+
+    def _store_result(self, key: str, result: Any):
+        if self.result_ttl_seconds <= 0:
+            return
+        self._results[key] = (time.monotonic(), result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]],
+                 should_cache: Callable[[Any], bool] = lambda result: True) -> Any:
+        """Returns fn()'s result, sharing one execution among all concurrent callers with the same key."""
+        cached = self._cached_result(key)
+        if cached is not None:
+            self._stats["result_cache_hits"] += 1
+            logger.info(f"Request {key[:12]} served from the short-lived result cache.")
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["joined"] += 1
+            logger.info(f"Request {key[:12]} joined an identical in-flight request.")
+        else:
+            self._stats["executions"] += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+
+            def _on_done(finished: asyncio.Task):
+                self._inflight.pop(key, None)
+                if not finished.cancelled() and finished.exception() is None and should_cache(finished.result()):
+                    self._store_result(key, finished.result())
+
+            task.add_done_callback(_on_done)
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "in_flight": len(self._inflight), "cached_results": len(self._results)}
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CacheEntry:
+    question: str
+    fingerprint: str
+    answer: Any
+    created_at: float
+
+class SemanticResponseCache:
+    """
+    In-memory answer cache for /chat keyed by question meaning rather than exact text.
+
+    Normalized questions are embedded and kept in a FAISS inner-product index over unit
+    vectors (i.e. cosine similarity). A lookup returns the stored answer of the closest
+    neighbour whose similarity clears the threshold and whose history fingerprint matches,
+    so "is laptop claimable" can reuse the answer to "can I claim my laptop" but never an
+    answer given in a different conversation. Entries expire after a TTL, the least
+    recently used entry is evicted when the cache is full, and everything is dropped when
+    the knowledge base version changes.
+    """
+
+    def __init__(self, embed_fn: Callable[[str], List[float]], similarity_threshold: float = 0.92,
+                 max_entries: int = 2000, ttl_seconds: float = 3600.0, search_k: int = 8):
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.search_k = search_k
+
+        self._index = None # Created on the first embedding, once the dimension is known
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._next_id = 0
+        self._kb_version: Optional[str] = None
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @staticmethod
+    def normalize_question(text: str) -> str:
+        """Lowercases, drops punctuation and collapses whitespace."""
+        text = re.sub(r"[^\w\s]", " ", text.lower())
+        return re.sub(r"\s+", " ", text).strip()
+
+    @staticmethod
+    def history_fingerprint(history: List[Any]) -> str:
+        """Stable hash of the prior conversation; only answers given after the same history are reused."""
+        turns = [(getattr(msg, "role", ""), getattr(msg, "content", "")) for msg in history]
+        return hashlib.sha256(json.dumps(turns, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def _embed(self, normalized_question: str) -> np.ndarray:
+        vector = await asyncio.to_thread(self.embed_fn, normalized_question)
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+        return vector
+
+    def _check_kb_version(self, kb_version: str):
+        if self._kb_version is not None and kb_version != self._kb_version and self._entries:
+            logger.info(f"Knowledge base version changed ({self._kb_version} -> {kb_version}). Invalidating {len(self._entries)} cached answers.")
+            self.clear()
+            self._stats["invalidations"] += 1
+        self._kb_version = kb_version
+
+    def _remove(self, entry_ids: List[int]):
+        if not entry_ids:
+            return
+        for entry_id in entry_ids:
+            self._entries.pop(entry_id, None)
+        self._index.remove_ids(np.asarray(entry_ids, dtype=np.int64))
+
+    def _purge_expired(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry.created_at < cutoff]
+        self._remove(expired)
+        self._stats["expirations"] += len(expired)
+
+    async def lookup(self, question: str, fingerprint: str, kb_version: str) -> Optional[Any]:
+        """Returns the cached answer for a semantically equivalent question, or None on a miss."""
+        self._check_kb_version(kb_version)
+        if not self._entries:
+            self._stats["misses"] += 1
+            return None
+
+        vector = await self._embed(self.normalize_question(question))
+        self._purge_expired()
+        if self._index.ntotal == 0:
+            self._stats["misses"] += 1
+            return None
+
+        scores, ids = self._index.search(vector, min(self.search_k, self._index.ntotal))
+        for score, entry_id in zip(scores[0], ids[0]):
+            if entry_id < 0 or score < self.similarity_threshold:
+                break # Results are sorted by similarity, nothing further can match
+            entry = self._entries.get(int(entry_id))
+            if entry and entry.fingerprint == fingerprint:
+                self._entries.move_to_end(int(entry_id))
+                self._stats["hits"] += 1
+                logger.info(f"Semantic cache hit (similarity {score:.3f}) for '{question[:80]}' -> cached '{entry.question[:80]}'")
+                return entry.answer
+
+        self._stats["misses"] += 1
+        return None
+
+    async def store(self, question: str, fingerprint: str, kb_version: str, answer: Any):
+        """Caches an answer, evicting the least recently used entries beyond max_entries."""
+        self._check_kb_version(kb_version)
+        normalized_question = self.normalize_question(question)
+        vector = await self._embed(normalized_question)
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+        self._entries[entry_id] = CacheEntry(normalized_question, fingerprint, answer, time.monotonic())
+        self._stats["stores"] += 1
+
+        overflow = len(self._entries) - self.max_entries
+        if overflow > 0:
+            lru_ids = list(self._entries.keys())[:overflow]
+            self._remove(lru_ids)
+            self._stats["evictions"] += overflow
+
+    def clear(self):
+        self._entries.clear()
+        if self._index is not None:
+            self._index.reset()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "size": len(self._entries),
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "kb_version": self._kb_version,
+        }
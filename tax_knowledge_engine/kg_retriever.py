@@ -1,4 +1,5 @@
 import os
+import hashlib
 import logging # <-- ADD THIS
 # Placeholder for graph database querying libraries and LLM libraries
 # from neo4j import GraphDatabase # Example for Neo4j
@@ -44,6 +45,19 @@ class KnowledgeGraphAgenticRetriever:
         # print("KnowledgeGraphAgenticRetriever connections closed.")
         pass
 
+    def knowledge_base_version(self) -> str:
+        """
+        Returns a fingerprint of the knowledge graph files on disk.
+        It changes whenever the graph is rebuilt, so callers caching answers derived from it know to invalidate.
+        """
+        if not os.path.isdir(KG_DATABASE_PATH):
+            return "no-kg-database"
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(KG_DATABASE_PATH)):
+            stat = os.stat(os.path.join(KG_DATABASE_PATH, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+        return digest.hexdigest()
+
     def generate_logical_form(self, natural_language_query: str):
         """
         Converts a natural language query into a logical form or a graph query.
@@ -1,10 +1,13 @@
 import os
+import logging
 from langchain_community.embeddings import HuggingFaceEmbeddings 
 from langchain_community.vectorstores import FAISS
 
 VECTOR_STORE_DIR = os.path.join(os.path.dirname(__file__), 'vector_store', 'faiss_index') 
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2" 
 
+logger = logging.getLogger(__name__)
+
 class TaxGuidelineRetriever:
     def __init__(self):
         self.vector_store = None
@@ -36,20 +39,19 @@ class TaxGuidelineRetriever:
     async def search_guidelines(self, query_text, top_k=3):
         """Searches for relevant guidelines in the vector store."""
         if not self.vector_store:
-            print("Vector store not loaded. Cannot perform search.")
+            logger.warning("Vector store not loaded. Cannot perform search. Attempting to reload dependencies...")
             # Attempt to reload if it wasn't loaded initially
-            print("Attempting to reload dependencies...")
             self._load_dependencies()
             if not self.vector_store:
                  return ["Error: Vector store not available. Please process documents and ensure retriever is correctly initialized."]
         
         try:
-            print(f"Performing similarity search for: '{query_text}', top_k={top_k}")
+            logger.debug(f"Performing similarity search for: '{query_text}', top_k={top_k}")
             docs = self.vector_store.similarity_search(query_text, k=top_k)
-            print(f"Found {len(docs)} relevant documents.")
+            logger.debug(f"Found {len(docs)} relevant documents.")
             return [doc.page_content for doc in docs]
         except Exception as e:
-            print(f"Error during similarity search: {e}")
+            logger.error(f"Error during similarity search: {e}")
             return [f"Error during search: {e}"]
 
 async def main():